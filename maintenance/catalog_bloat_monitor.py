@@ -1,46 +1,246 @@
 import sys
 import time
+import sqlite3
 from datetime import datetime
+from multiprocessing import Pool
 try:
     from gppylib.db import dbconn
     from pygresql.pg import DatabaseError
+    from optparse import Option, OptionParser
+    from gppylib.gpparseopts import OptParser, OptChecker
 except ImportError, e:
     sys.exit('Cannot import modules. Please check that you have sourced greenplum_path.sh.  Detail: ' + str(e))
 
-def executeForSingleInt(dburl, query):
-    res = -1
+CATALOGS = ['pg_class', 'pg_attribute', 'pg_namespace', 'pg_type', 'pg_depend',
+            'pg_index', 'pg_proc', 'pg_appendonly', 'gp_fastsequence']
+
+# All the catalogs are counted by a single statement
+COUNT_QUERY = '\nunion all\n'.join(["select '%s', count(*) from pg_catalog.%s" % (c, c) for c in CATALOGS])
+
+def parseargs():
+    parser = OptParser(option_class=OptChecker)
+    parser.remove_option('-h')
+    parser.add_option('-h', '-?', '--help', action='store_true')
+    parser.add_option('-d', '--database', type='string')
+    parser.add_option('-u', '--username', type='string')
+    parser.add_option('-n', '--nthreads', type='int')
+    parser.add_option('-i', '--interval', type='int')
+    parser.add_option('-o', '--once',     action='store_true')
+    parser.add_option('-s', '--store',    type='string')
+    parser.add_option('-r', '--retention', type='int')
+    parser.add_option('-t', '--threshold', type='float')
+    parser.add_option('--horizon',        type='float')
+    parser.add_option('--report',         action='store_true')
+    parser.add_option('--needvacuum',     action='store_true')
+    (options, args) = parser.parse_args()
+    if options.help:
+        print """
+Script monitors the amount of visible and total (including invisible) rows in
+the catalog tables of each database of the cluster
+Usage:
+python catalog_bloat_monitor.py [-d database_name] [-u username] [-n threads]
+                                [-i interval_seconds] [-o]
+                                [-s store_file [-r retention_days]]
+python catalog_bloat_monitor.py -s store_file --report | --needvacuum
+                                [-d database_name] [-t threshold] [--horizon hours]
+    -d | --database - monitor only this database (default is all the databases
+                      allowing connections)
+    -u | --username - user to connect to the databases (default is gpadmin)
+    -n | --nthreads - number of databases sampled in parallel (default is 4)
+    -i | --interval - seconds between the samples (default is 600)
+    -o | --once     - take a single sample and exit
+    -s | --store    - SQLite file to keep the samples in
+    -r | --retention - days to keep the samples for (default is 90)
+    -t | --threshold - ratio of invisible to visible rows considered as bloat
+                      (default is 0.5)
+    --horizon       - with --needvacuum, also list catalogs forecasted to cross
+                      the threshold within this number of hours (default is 0)
+    --report        - print invisible/visible ratio, its growth per day and the
+                      forecasted time of crossing the threshold for each catalog
+    --needvacuum    - print the catalogs which need VACUUM now
+Growth rate is the least squares slope of the ratio over the samples taken
+since the last time the total number of rows went down, e.g. after a VACUUM.
+Each database is sampled over a single connection with one statement counting
+visible rows and one statement counting all the rows of the catalogs:
+%s
+Output is written to stdout, one line per database and catalog:
+Timestamp|Database|Catalog|Rows visible|Rows total
+""" % ', '.join(CATALOGS)
+        sys.exit(0)
+    # Database name as the only argument is accepted as before
+    if not options.database and len(args) > 0:
+        options.database = args[0]
+    if not options.username:
+        options.username = 'gpadmin'
+    if not options.nthreads:
+        options.nthreads = 4
+    if not options.interval:
+        options.interval = 600
+    if not options.retention:
+        options.retention = 90
+    if not options.threshold:
+        options.threshold = 0.5
+    if not options.horizon:
+        options.horizon = 0.0
+    if (options.report or options.needvacuum) and not options.store:
+        sys.stderr.write('You must specify the store file (-s) for --report and --needvacuum\n')
+        sys.exit(1)
+    return options
+
+def getDbUrl(dbname, username):
+    return dbconn.DbURL(hostname = '127.0.0.1',
+                        port     = 5432,
+                        dbname   = dbname,
+                        username = username)
+
+def getDatabases(username):
+    conn = dbconn.connect(getDbUrl('template1', username))
+    curs = dbconn.execSQL(conn, "select datname from pg_database where datallowconn order by 1")
+    rows = curs.fetchall()
+    conn.close()
+    return [ r[0] for r in rows ]
+
+def collectDatabase(args):
+    dbname, username = args
+    res = []
     try:
-        conn = dbconn.connect(dburl)
-        curs = dbconn.execSQL(conn, query)
-        rows = curs.fetchall()
+        conn = dbconn.connect(getDbUrl(dbname, username))
+        curs = dbconn.execSQL(conn, "set gp_select_invisible=off; " + COUNT_QUERY)
+        visible = dict([ (r[0], int(r[1])) for r in curs.fetchall() ])
+        curs = dbconn.execSQL(conn, "set gp_select_invisible=on; " + COUNT_QUERY)
+        total   = dict([ (r[0], int(r[1])) for r in curs.fetchall() ])
         conn.commit()
         conn.close()
-        res = int(rows[0][0])
+        for c in CATALOGS:
+            res.append((dbname, c, visible.get(c, -1), total.get(c, -1)))
     except Exception as ex:
-        sys.stderr.write ('Exception during execute: %s' % str(ex))
+        sys.stderr.write ('Exception during execute on database %s: %s\n' % (dbname, str(ex)))
         pass
     return res
 
-def collectStat():
-    ts = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-    dburl = dbconn.DbURL(hostname = '127.0.0.1',
-                         port     = 5432,
-                         dbname   = sys.argv[1],
-                         username = 'gpadmin')
-    pgav  = executeForSingleInt (dburl, "set gp_select_invisible=off; select count(*) from pg_attribute;")
-    pgat  = executeForSingleInt (dburl, "set gp_select_invisible=on; select count(*) from pg_attribute;")
-    pgcv  = executeForSingleInt (dburl, "set gp_select_invisible=off; select count(*) from pg_class;")
-    pgct  = executeForSingleInt (dburl, "set gp_select_invisible=on; select count(*) from pg_class;")
-    pgnv  = executeForSingleInt (dburl, "set gp_select_invisible=off; select count(*) from pg_namespace;")
-    pgnt  = executeForSingleInt (dburl, "set gp_select_invisible=on; select count(*) from pg_namespace;")
-    sys.stdout.write('%s|%d|%d|%d|%d|%d|%d\n' % (ts, pgav, pgat, pgcv, pgct, pgnv, pgnt))
+def openStore(filename):
+    store = sqlite3.connect(filename)
+    store.execute("""
+        create table if not exists samples (
+            ts       integer,
+            dbname   text,
+            catalog  text,
+            visible  integer,
+            total    integer
+        )""")
+    store.execute("create index if not exists samples_idx on samples (dbname, catalog, ts)")
+    return store
+
+def storeStat(store, ts, rows, retention):
+    epoch = int(time.mktime(ts.timetuple()))
+    store.executemany("insert into samples values (?, ?, ?, ?, ?)",
+                      [ (epoch, dbname, catalog, visible, total) for dbname, catalog, visible, total in rows
+                        if visible >= 0 and total >= 0 ])
+    store.execute("delete from samples where ts < ?", (epoch - retention * 86400,))
+    store.commit()
+    return
+
+def collectStat(pool, databases, username, store, retention):
+    now = datetime.now()
+    ts  = now.strftime('%Y-%m-%d %H:%M:%S')
+    res = pool.map(collectDatabase, [ (db, username) for db in databases ])
+    rows = []
+    for dbres in res:
+        for dbname, catalog, visible, total in dbres:
+            sys.stdout.write('%s|%s|%s|%d|%d\n' % (ts, dbname, catalog, visible, total))
+            rows.append((dbname, catalog, visible, total))
     sys.stdout.flush()
+    if store is not None:
+        storeStat(store, now, rows, retention)
+    return
 
-sys.stdout.write('Timestamp|Rows pg_attribute visible|Rows pg_attribute total|Rows pg_class visible|Rows pg_class total|Rows pg_namespace visible|Rows pg_namespace total\n')
-while True:
-    try:
-        collectStat()
-        time.sleep(600)
-    except Exception as ex:
-        sys.stderr.write ('Exception during main cycle: %s' % str(ex))
-        pass
+def analyzeSeries(samples, threshold):
+    # samples is a list of (ts, visible, total) ordered by ts
+    start = 0
+    for i in range(1, len(samples)):
+        if samples[i][2] < samples[i-1][2]:
+            start = i
+    series = [ (float(ts), float(total - visible) / max(visible, 1)) for ts, visible, total in samples[start:] ]
+    ts, visible, total = samples[-1]
+    ratio = series[-1][1]
+    slope = 0.0
+    if len(series) >= 2:
+        n    = len(series)
+        mx   = sum([x for x, y in series]) / n
+        my   = sum([y for x, y in series]) / n
+        sxx  = sum([(x - mx) ** 2 for x, y in series])
+        if sxx > 0:
+            slope = sum([(x - mx) * (y - my) for x, y in series]) / sxx * 86400
+    eta = None
+    if ratio >= threshold:
+        eta = ts
+    elif slope > 0:
+        eta = ts + (threshold - ratio) / slope * 86400
+    return visible, total, ratio, slope, eta
+
+def getSeries(store, dbname):
+    query = "select dbname, catalog, ts, visible, total from samples"
+    args  = ()
+    if dbname:
+        query += " where dbname = ?"
+        args   = (dbname,)
+    series = dict()
+    for db, catalog, ts, visible, total in store.execute(query + " order by dbname, catalog, ts", args):
+        series.setdefault((db, catalog), []).append((ts, visible, total))
+    return series
+
+def formatTs(epoch):
+    if epoch is None:
+        return 'never'
+    return datetime.fromtimestamp(epoch).strftime('%Y-%m-%d %H:%M:%S')
+
+def report(store, dbname, threshold):
+    sys.stdout.write('Database|Catalog|Last sample|Rows visible|Rows total|Invisible ratio|Ratio growth per day|Threshold crossing\n')
+    series = getSeries(store, dbname)
+    for key in sorted(series.keys()):
+        visible, total, ratio, slope, eta = analyzeSeries(series[key], threshold)
+        sys.stdout.write('%s|%s|%s|%d|%d|%f|%f|%s\n' % (key[0], key[1], formatTs(series[key][-1][0]),
+                         visible, total, ratio, slope, formatTs(eta)))
+    return
+
+def needVacuum(store, dbname, threshold, horizon):
+    limit  = time.time() + horizon * 3600
+    series = getSeries(store, dbname)
+    for key in sorted(series.keys()):
+        visible, total, ratio, slope, eta = analyzeSeries(series[key], threshold)
+        if eta is not None and eta <= limit:
+            sys.stdout.write('%s|%s|%f|%s\n' % (key[0], key[1], ratio, formatTs(eta)))
+    return
+
+def main():
+    options = parseargs()
+    store = None
+    if options.store:
+        store = openStore(options.store)
+    if options.report:
+        report(store, options.database, options.threshold)
+        return
+    if options.needvacuum:
+        needVacuum(store, options.database, options.threshold, options.horizon)
+        return
+    # Bounded pool keeps the number of connections constant with any number of databases
+    pool = Pool(processes=options.nthreads)
+    sys.stdout.write('Timestamp|Database|Catalog|Rows visible|Rows total\n')
+    while True:
+        try:
+            if options.database:
+                databases = [ options.database ]
+            else:
+                databases = getDatabases(options.username)
+            collectStat(pool, databases, options.username, store, options.retention)
+        except Exception as ex:
+            sys.stderr.write ('Exception during main cycle: %s\n' % str(ex))
+            pass
+        if options.once:
+            break
+        time.sleep(options.interval)
+    pool.close()
+    pool.join()
+    return
+
+main()
@@ -0,0 +1,209 @@
+#!/usr/bin/python
+#
+# This script runs the catalog maintenance (VACUUM, VACUUM FULL, REINDEX)
+# only for the catalog tables which are bloated, processing a number of
+# databases in parallel within a time budget
+#
+# Usage:
+# ./catalog_maintenance.py [-d dbname] [-n thread_number] [-b budget_minutes]
+#                          [-t vacuum_ratio] [-f vacuum_full_ratio] [-i index_ratio]
+#                          [--dryrun]
+#
+import sys, time
+
+try:
+    from optparse import Option, OptionParser
+    from gppylib.gpparseopts import OptParser, OptChecker
+    from gppylib.gplog import *
+    from pygresql import pg
+    from pygresql.pg import DatabaseError
+    from multiprocessing import Process
+except ImportError, e:
+    sys.exit('Cannot import modules. Please check that you have sourced greenplum_path.sh.  Detail: ' + str(e))
+
+# Catalogs maintained by the system itself which should never be rewritten
+EXCLUDED = "c.relname not like 'gp_persistent%' and c.relname not in ('gp_relation_node', 'gp_global_sequence')"
+
+def parseargs():
+    parser = OptParser(option_class=OptChecker)
+    parser.remove_option('-h')
+    parser.add_option('-h', '-?', '--help',   action='store_true')
+    parser.add_option('-d', '--dbname',       type='string')
+    parser.add_option('-u', '--user',         type='string')
+    parser.add_option('-n', '--nthreads',     type='int')
+    parser.add_option('-b', '--budget',       type='float')
+    parser.add_option('-t', '--vacuum',       type='float')
+    parser.add_option('-f', '--vacuumfull',   type='float')
+    parser.add_option('-i', '--indexratio',   type='float')
+    parser.add_option('--dryrun',             action='store_true')
+    (options, args) = parser.parse_args()
+    if options.help:
+        print """Script measures the bloat of the catalog tables and runs VACUUM,
+VACUUM FULL or REINDEX only for the tables above the thresholds, processing
+a number of databases in parallel within a time budget
+Usage:
+./catalog_maintenance.py [-d dbname] [-u user] [-n thread_number] [-b budget_minutes]
+                         [-t vacuum_ratio] [-f vacuum_full_ratio] [-i index_ratio]
+                         [--dryrun]
+Parameters:
+    -d | --dbname     - process only this database (default is all the databases
+                        allowing connections)
+    -u | --user       - user to connect to the databases (default is gpadmin)
+    -n | --nthreads   - number of databases processed in parallel (default is 2)
+    -b | --budget     - time budget in minutes, no new command is started after
+                        it is exhausted (default is no limit)
+    -t | --vacuum     - ratio of invisible to visible rows to run VACUUM (default is 0.2)
+    -f | --vacuumfull - ratio of invisible to visible rows to run VACUUM FULL
+                        followed by REINDEX (default is 1.0)
+    -i | --indexratio - ratio of the indexes size to the size of live rows of
+                        the table to run REINDEX (default is 2.0)
+    --dryrun          - only report the measured bloat and planned commands
+Tables are processed from the most bloated to the least bloated. Shared catalogs
+are processed only in the first database. Persistent tables are never touched."""
+        sys.exit(0)
+    if not options.user:
+        options.user = 'gpadmin'
+    if not options.nthreads:
+        options.nthreads = 2
+    if not options.vacuum:
+        options.vacuum = 0.2
+    if not options.vacuumfull:
+        options.vacuumfull = 1.0
+    if not options.indexratio:
+        options.indexratio = 2.0
+    if options.vacuumfull < options.vacuum:
+        logger.error('VACUUM FULL ratio (-f) should not be lower than VACUUM ratio (-t)')
+        sys.exit(1)
+    return options
+
+def connect(dbname, user):
+    # Classic interface works in autocommit mode, which VACUUM requires
+    return pg.DB(dbname=dbname, host='127.0.0.1', port=5432, user=user)
+
+def get_databases(options):
+    if options.dbname:
+        return [ options.dbname ]
+    db = connect('template1', options.user)
+    rows = db.query("select datname from pg_database where datallowconn order by datname = 'postgres' desc, datname").getresult()
+    db.close()
+    return [ r[0] for r in rows ]
+
+def measure_bloat(db, include_shared):
+    query = """
+        select  c.relname,
+                pg_relation_size(c.oid),
+                coalesce((select sum(pg_relation_size(i.indexrelid))
+                              from pg_index as i
+                              where i.indrelid = c.oid), 0)
+            from pg_class as c,
+                 pg_namespace as n
+            where c.relnamespace = n.oid
+                and n.nspname = 'pg_catalog'
+                and c.relkind = 'r'
+                and %s""" % EXCLUDED
+    if not include_shared:
+        query += "\n                and not c.relisshared"
+    tables = db.query(query).getresult()
+    count_query = '\nunion all\n'.join(["select '%s', count(*) from pg_catalog.%s" % (t[0], t[0]) for t in tables])
+    db.query('set gp_select_invisible=off')
+    visible = dict(db.query(count_query).getresult())
+    db.query('set gp_select_invisible=on')
+    total   = dict(db.query(count_query).getresult())
+    db.query('set gp_select_invisible=off')
+    res = []
+    for relname, relsize, idxsize in tables:
+        vis = int(visible.get(relname, 0))
+        tot = int(total.get(relname, 0))
+        ratio = float(tot - vis) / max(vis, 1)
+        live_size = float(relsize) * vis / max(tot, 1)
+        idxratio  = float(idxsize) / max(live_size, 8192)
+        res.append((relname, vis, tot, int(relsize), int(idxsize), ratio, idxratio))
+    return res
+
+def plan_commands(bloat, options):
+    commands = []
+    for relname, vis, tot, relsize, idxsize, ratio, idxratio in bloat:
+        table = 'pg_catalog.' + relname
+        if ratio >= options.vacuumfull:
+            commands.append((ratio, relname, ['VACUUM FULL %s' % table, 'REINDEX TABLE %s' % table]))
+        elif ratio >= options.vacuum:
+            cmd = ['VACUUM %s' % table]
+            if idxratio >= options.indexratio:
+                cmd.append('REINDEX TABLE %s' % table)
+            commands.append((ratio, relname, cmd))
+        elif idxratio >= options.indexratio:
+            commands.append((ratio, relname, ['REINDEX TABLE %s' % table]))
+    # The most bloated tables go first to get the most out of the time budget
+    commands.sort(reverse=True)
+    return commands
+
+def process_database(dbname, include_shared, deadline, options):
+    try:
+        db = connect(dbname, options.user)
+        n1 = time.time()
+        bloat = measure_bloat(db, include_shared)
+        logger.info('[%s] measured bloat of %d catalog tables in %.3f seconds' % (dbname, len(bloat), time.time() - n1))
+        for relname, vis, tot, relsize, idxsize, ratio, idxratio in bloat:
+            if ratio >= options.vacuum or idxratio >= options.indexratio:
+                logger.info('[%s]   %s: %d visible, %d total rows, invisible ratio %.3f, table %d bytes, indexes %d bytes, index ratio %.3f'
+                            % (dbname, relname, vis, tot, ratio, relsize, idxsize, idxratio))
+        commands = plan_commands(bloat, options)
+        logger.info('[%s] %d catalog tables need maintenance' % (dbname, len(commands)))
+        for ratio, relname, cmds in commands:
+            for cmd in cmds:
+                if deadline is not None and time.time() >= deadline:
+                    logger.warning('[%s] time budget is exhausted, skipping: %s' % (dbname, cmd))
+                    continue
+                if options.dryrun:
+                    logger.info('[%s] would run: %s' % (dbname, cmd))
+                    continue
+                n1 = time.time()
+                db.query(cmd)
+                logger.info('[%s] %s took %.3f seconds' % (dbname, cmd, time.time() - n1))
+        db.close()
+    except DatabaseError, ex:
+        logger.error('[%s] Failed to execute the statement on the database. Please, check log file for errors.' % dbname)
+        logger.error(ex)
+        sys.exit(3)
+    return
+
+def orchestrator(options):
+    databases = get_databases(options)
+    deadline  = None
+    if options.budget:
+        deadline = time.time() + options.budget * 60
+    logger.info('=== Processing %d databases in %d threads ===' % (len(databases), options.nthreads))
+    running   = []
+    error_cnt = 0
+    first     = True
+    while len(databases) > 0 or len(running) > 0:
+        for pid in running[:]:
+            if pid.is_alive() is False:
+                running.remove(pid)
+                pid.join()
+                if pid.exitcode != 0:
+                    logger.error ('Processing of one of the databases has failed')
+                    error_cnt += 1
+        if len(running) < options.nthreads and len(databases) > 0:
+            dbname = databases.pop(0)
+            pid = Process(target=process_database, name='Catalog maintenance', args=(dbname, first, deadline, options))
+            running.append(pid)
+            pid.start()
+            first = False
+        else:
+            time.sleep(1)
+    logger.info ('=== Processing complete ===')
+    if error_cnt > 0:
+        logger.warning ('There were %d errors during the processing. Check the log' % error_cnt)
+    return
+
+#------------------------------- Mainline --------------------------------
+
+#Initialization
+logger = get_default_logger()
+
+#Parse input parameters and check for validity
+options = parseargs()
+
+#Run the maintenance
+orchestrator(options)
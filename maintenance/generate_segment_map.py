@@ -2,7 +2,7 @@ import sys
 try:
     from optparse import Option, OptionParser
     from gppylib.gpparseopts import OptParser, OptChecker
-#    from gppylib.db import dbconn
+    from gppylib.db import dbconn
     from gppylib.gplog import *
 #    from gppylib import userinput
 #    from pygresql.pg import DatabaseError
@@ -30,6 +30,18 @@ def parseargs():
     parser.add_option('-a', '--added',       type='int')
     parser.add_option('-C', '--maxcontent',  type='int')
     parser.add_option('-D', '--maxdbid',     type='int')
+    parser.add_option('-P', '--policy',      type='string')
+    parser.add_option('-g', '--groupsize',   type='int')
+    parser.add_option('-S', '--simulate',    action='store_true')
+    parser.add_option('-f', '--mapfile',     type='string')
+    parser.add_option('--dbname',            type='string')
+    parser.add_option('-u', '--username',    type='string')
+    parser.add_option('--dirdepth',          type='int')
+    parser.add_option('-R', '--redistribution', action='store_true')
+    parser.add_option('-T', '--throughput',  type='float')
+    parser.add_option('--priority',          type='string')
+    parser.add_option('--planfile',          type='string')
+    parser.add_option('--rankfile',          type='string')
     (options, args) = parser.parse_args()
     if options.help:
         print """
@@ -44,24 +56,115 @@ python generate_segment_map.py -s number_of_segment_hosts -d number_of_dbs_per_h
                               [-i | --initsystem]
                               [-e -a number_of_hosts_added --maxcontent max_content
                                     --maxdbid max_dbid]
+                              [-P group | spread] [-g group_size]
+                              [-S [--dirdepth depth]]
+                              [-R --dbname database [-u username] [-T throughput]
+                                    [--priority list] [--planfile file] [--rankfile file]]
+python generate_segment_map.py -S -f map_file | --dbname database [-u username]
+                              [--dirdepth depth] [-o outfile]
     -s | --seghosts    - Number of segment hosts in the system
     -d | --segdbs      - Number of segment databases per host
     -o | --outfile     - Output file
     -p | --primarydirs - Colon-separated list of primary segment directories
     -m | --mirrordirs  - Colon-separated list of mirror segment directories
+                         Each directory can be followed by comma-separated capacity
+                         weight, throughput weight and device id of its mount:
+                         /data1/primary,4,2,sda (defaults are 1, 1 and the
+                         directory itself). Directories with the same device id
+                         share its capacity and throughput, so they should
+                         give the same weights
     -i | --initsystem  - Generate map file for system initialization
     -e | --expansion   - Generate map file for system expansion
     -a | --added       - Number of segment hosts added during expansion
     -C | --maxcontent  - Maximal number of content in existing GPDB
     -D | --maxdbid     - Maximal number of dbid in existing GPDB
+    -P | --policy      - Mirroring policy (default is group):
+                         group  - hosts are split into redundancy groups and the
+                                  mirrors of each host are placed on the other
+                                  hosts of its group
+                         spread - mirrors of each host are spread across all the
+                                  other hosts of the system (or of the added
+                                  hosts in expansion mode)
+    -g | --groupsize   - Number of hosts in redundancy group (default is 4). If the
+                         number of hosts is not divisible by it, the remaining
+                         hosts join the last group
+    -S | --simulate    - Simulate failures of every single host and every pair of
+                         hosts and report the number of acting primaries per host
+                         and per data directory. Simulated is the map generated by
+                         the same call (report goes to stderr), the map file or
+                         the segment configuration of the running system
+    -f | --mapfile     - gpinitsystem or gpexpand map file to simulate
+    --dbname           - Database to read gp_segment_configuration from to simulate
+                         the existing system (preferred roles are used)
+    -u | --username    - User to connect to the database (default is gpadmin)
+    --dirdepth         - Number of leading path components identifying the data
+                         directory, e.g. /data1 for /data1/primary/gpseg0 with the
+                         default of 1
+    -R | --redistribution - In expansion mode plan the redistribution of the tables
+                         of all the databases of the system, connecting to --dbname
+    -T | --throughput  - Redistribution throughput of the whole system in MB/s used
+                         to estimate the duration (default is 500)
+    --priority         - Comma-separated list of tables, schemas or databases to
+                         redistribute first, in the order of the list. Other
+                         tables go from the largest to the smallest
+    --planfile         - File for the redistribution plan (default is stderr)
+    --rankfile         - File for the statements setting the rank of the tables in
+                         gpexpand.status_detail according to the plan
+Mirrors are placed so that after a failure of any single host each surviving
+host runs the minimal possible number of extra primaries, which is the number of
+segment databases per host divided by the number of other hosts in the group
+rounded up. The achieved value is reported to stderr.
+Segments are assigned to the directories so that the maximum over the devices of
+the number of segments (primaries and mirrors together) per unit of capacity and
+per unit of throughput is minimal. Without the weights directories are used in
+round-robin and the number of segment databases per host should be divisible by
+the number of directories. Resulting load of each device is reported to stderr.
+Failure simulation output has one line per failure level and number of failed
+hosts:
+Level|Failed hosts|Scenarios|Scenarios with unavailable data|Max acting primaries|Mean max acting primaries|Mean acting primaries|Worst scenario
+where max is taken over the hosts (directories) of one scenario and then over all
+the scenarios, mean max is the average of the per-scenario maximum and mean is the
+average number of acting primaries per surviving host (directory). Scenarios with
+unavailable data are the ones where both primary and mirror of some content fail
+Redistribution plan has one line per table in the order of redistribution:
+Rank|Database|Table|Distribution|Size MB|Moved MB|Duration seconds|Finished after seconds
+Moved is the size of the rows changing their segment: with hash distribution the
+row stays if the hash modulo the old and the new number of segments match, with
+random distribution almost all the rows move. Duration is estimated from the full
+size of the table, as redistribution rewrites the whole table.
 Examples:
     1. Initialize system with 16 segment servers and 4 segments per host:
     python generate_segment_map.py -s 16 -d 4 -i > gpinitsystem_map
     2. Prepare expansion map to add 8 segment servers to existing system with
         16 segment servers and 4 segment databases per host:
     python generate_segment_map.py -s 16 -d 4 -e -a 8 --maxcontent 100 --maxdbid 100 > gpexpand_map
+    3. Initialize system with 40 segment servers, 8 segments per host and mirrors
+        spread across all the hosts:
+    python generate_segment_map.py -s 40 -d 8 -i -P spread > gpinitsystem_map
+    4. Compare the load after host failures of the existing system with the
+        new initialization map:
+    python generate_segment_map.py --dbname postgres -S
+    python generate_segment_map.py -S -f gpinitsystem_map
+    5. Prepare expansion map and the plan of the redistribution at 800 MB/s with
+        the tables of schema sales going first:
+    python generate_segment_map.py -s 16 -d 4 -e -a 8 --maxcontent 63 --maxdbid 130 -R --dbname postgres -T 800 --priority sales --rankfile rank.sql > gpexpand_map
 """
         sys.exit(0)
+    if not options.username:
+        options.username = 'gpadmin'
+    if not options.dirdepth:
+        options.dirdepth = 1
+    if not options.throughput:
+        options.throughput = 500.0
+    if options.redistribution:
+        if not options.expansion or not options.dbname:
+            raise_err('Redistribution plan (-R) requires expansion mode (-e) and the database to connect to (--dbname)')
+    elif options.mapfile or options.dbname:
+        if not options.simulate:
+            raise_err('Map file (-f) and database (--dbname) are used only for failure simulation (-S) and redistribution plan (-R)')
+        if options.mapfile and options.dbname:
+            raise_err('You should either specify map file (-f) or database (--dbname) to simulate')
+        return options
     if not options.seghosts or not options.segdbs:
         raise_err('You must specify both number of segment hosts (-s) and number of segment databases on each host (-d)')
     if (options.primarydirs and not options.mirrordirs) or (not options.primarydirs and options.mirrordirs):
@@ -70,109 +173,479 @@ Examples:
         raise_err('You should either specify init system mode ( -i ) or expansion mode ( -e )')
     if options.expansion and not options.added:
         raise_err('In expansion mode you must specify number of segment servers added')
+    if not options.policy:
+        options.policy = 'group'
+    if options.policy not in ('group', 'spread'):
+        raise_err('Mirroring policy (-P) should be either "group" or "spread"')
+    if not options.groupsize:
+        options.groupsize = 4
     return options
 
 def validate_options(options):
     seghosts = int(options.seghosts)
     segdbs   = int(options.segdbs)
     num_prim = 2
+    weighted = False
     if options.primarydirs:
-        num_prim = options.primarydirs.count(':') + 1
-        num_mirr = options.mirrordirs.count(':')  + 1
-        if num_prim <> num_mirr:
+        weighted = ',' in options.primarydirs + options.mirrordirs
+        primarydirs = parse_dirs(options.primarydirs)
+        mirrordirs  = parse_dirs(options.mirrordirs)
+        num_prim = len(primarydirs)
+        num_mirr = len(mirrordirs)
+        if num_prim <> num_mirr and not weighted:
             raise_err('Number of directories for primaries (%d) should be the same as the number of directories for mirrors (%d)' % (num_prim, num_mirr))
-        prim = set(options.primarydirs.split(':'))
-        mirr = set(options.mirrordirs.split(':'))
+        prim = set([ d[0] for d in primarydirs ])
+        mirr = set([ d[0] for d in mirrordirs ])
         if len(prim & mirr) > 0:
             raise_err('Primaries and mirrors cannot be put to the same directory. The overlapping ones are: %s' % ', '.join([x for x in prim & mirr]))
         if len(prim) != num_prim:
             raise_err('List of primary directories contain non-unique entries, while only unique entries are allowed')
         if len(mirr) != num_mirr:
             raise_err('List of mirror directories contain non-unique entries, while only unique entries are allowed')
-    if (seghosts >= 4 and seghosts % 4 != 0 and options.initsystem):
-        raise_err('This script creates initialization map for GPDB with redundancy groups of 4 segment hosts. The amount of servers you passed (%d) cannot be splitted in a number of groups of 4 servers' % seghosts)
-    if (seghosts < 4 and options.expansion):
-        raise_err('Cannot expand the system with less than 4 servers')
+    if options.groupsize < 2:
+        raise_err('Redundancy group should contain at least 2 segment hosts, %d specified' % options.groupsize)
+    if (seghosts < 2 and options.initsystem):
+        raise_err('Cannot place mirrors on less than 2 segment hosts')
     if options.expansion:
         addedhosts = int(options.added)
-        if (options.expansion and addedhosts % 4 != 0):
-            raise_err('You can expand the system only with a chunks of 4 servers, now trying to make it run with %d segment servers added' % addedhosts)
-    if segdbs % num_prim != 0:
+        if addedhosts < 2:
+            raise_err('Mirrors of the added hosts are placed on the added hosts, so at least 2 servers should be added, now trying to add %d' % addedhosts)
+    if segdbs % num_prim != 0 and not weighted:
         raise_err('%d segment databases cannot be evenly distributed in %d directories' % (segdbs, num_prim))
     return
 
-def find_min(mirrors, mir_prim, j):
-    mir_len = [ len(x) for x in mirrors ]
-    xmax, pmax, xi = 100, 100, 0
-    for i in range(4):
-        if i <> j:
-            if (xmax > mir_len[i]) or (xmax == mir_len[i] and pmax > mir_prim[j][i]):
-                xmax, pmax, xi = mir_len[i], mir_prim[j][i], i
-    return xi
-
-def generate_small_cluster(seghosts, host, dbid, content, segdbs, primarydirs, mirrordirs):
-    def find_min_simple(mirrors, seghosts, j):
-        mir_len = [ len(x) for x in mirrors ]
-        xmax, xi = 100, 0
-        for i in range(seghosts):
-            if i <> j:
-                if (xmax > mir_len[i]):
-                    xmax, xi = mir_len[i], i
-        return xi
-    hostnames = [ 'sdw' + str(x) for x in range(host, host+4) ]
-    primaries = [ [] for x in range(seghosts) ]
-    for i in range(seghosts):
+def parse_dirs(spec):
+    # Each directory is path[,capacity[,throughput[,device]]]
+    dirs = []
+    for entry in spec.split(':'):
+        f = entry.split(',')
+        try:
+            capacity   = float(f[1]) if len(f) > 1 and f[1] else 1.0
+            throughput = float(f[2]) if len(f) > 2 and f[2] else 1.0
+        except ValueError:
+            raise_err('Capacity and throughput weights of directory %s should be numbers' % entry)
+        if capacity <= 0 or throughput <= 0:
+            raise_err('Capacity and throughput weights of directory %s should be positive' % entry)
+        device = f[3] if len(f) > 3 and f[3] else f[0]
+        dirs.append([ f[0], capacity, throughput, device ])
+    return dirs
+
+def device_loads(primarydirs, mirrordirs, counts, capacity, throughput):
+    segments = dict([ (dev, 0) for dev in capacity ])
+    for dirs, count in ((primarydirs, counts[0]), (mirrordirs, counts[1])):
+        for i in range(len(dirs)):
+            segments[dirs[i][3]] += count[i]
+    return sorted([ max(segments[dev] / capacity[dev], segments[dev] / throughput[dev]) for dev in segments ], reverse=True)
+
+def plan_directories(primarydirs, mirrordirs, segdbs):
+    # Every host runs segdbs primaries and receives segdbs mirrors, so the same
+    # directory plan fits all the hosts. Number of segments in each directory is
+    # chosen to minimize the loads of the devices, the highest one first, where
+    # the load is the number of segments per unit of capacity or throughput.
+    # Weights belong to the device, so its directories should give the same ones
+    capacity   = dict()
+    throughput = dict()
+    for d in primarydirs + mirrordirs:
+        if d[3] in capacity and (capacity[d[3]], throughput[d[3]]) != (d[1], d[2]):
+            raise_err('Directories on device %s have different capacity and throughput weights' % d[3])
+        capacity[d[3]]   = d[1]
+        throughput[d[3]] = d[2]
+    counts = [ [0] * len(primarydirs), [0] * len(mirrordirs) ]
+    # Greedy placement of primaries and mirrors one by one, ties go to the least
+    # filled directory and then to the order of the list
+    for j in range(segdbs):
+        for role, dirs in ((0, primarydirs), (1, mirrordirs)):
+            best = None
+            for i in range(len(dirs)):
+                counts[role][i] += 1
+                key = (device_loads(primarydirs, mirrordirs, counts, capacity, throughput),
+                       counts[role][i] / dirs[i][1], i)
+                counts[role][i] -= 1
+                if best is None or key < best:
+                    best = key
+            counts[role][best[2]] += 1
+    # Greedy choice for the early segments can be wrong for the later ones, so
+    # single segments are moved between the directories while it helps
+    current  = device_loads(primarydirs, mirrordirs, counts, capacity, throughput)
+    improved = True
+    while improved:
+        improved = False
+        for role in (0, 1):
+            for a in range(len(counts[role])):
+                for b in range(len(counts[role])):
+                    if a == b or counts[role][a] == 0:
+                        continue
+                    counts[role][a] -= 1
+                    counts[role][b] += 1
+                    loads = device_loads(primarydirs, mirrordirs, counts, capacity, throughput)
+                    if loads < current:
+                        current  = loads
+                        improved = True
+                    else:
+                        counts[role][a] += 1
+                        counts[role][b] -= 1
+    # Directories are interleaved in proportion to their number of segments, which
+    # is round-robin for equal counts
+    plan = ([], [])
+    for role, dirs in ((0, primarydirs), (1, mirrordirs)):
+        used = [0] * len(dirs)
         for j in range(segdbs):
-            primaries[i].append(
-                # host, dbid, content, port, replication_port, directory
-                [ hostnames[i], dbid, content, 1025+j, 1089+j, primarydirs[j%len(primarydirs)] + '/gpseg' + str(content) ]
-                )
-            dbid    += 1
-            content += 1
-    mirrors  = [ [] for x in range(seghosts) ]
-    for i in range(segdbs):
-        for j in range(seghosts):
-            cont = primaries[j][i][2]
-            m = find_min_simple(mirrors, seghosts, j)
-            mirrors[m].append(
-                # host, dbid, content, port, replication_port, directory
-                [ hostnames[m], dbid, cont, 1153+i, 1217+i, mirrordirs[i%len(mirrordirs)] + '/gpseg' + str(cont) ]
-                )
-            dbid    += 1
-    return primaries, mirrors
-    
-def generate_next_4_hosts (host, dbid, content, segdbs, primarydirs, mirrordirs):
-    hostnames = [ 'sdw' + str(x) for x in range(host, host+4) ]
-    primaries = [ [], [], [], [] ]
-    for i in range(4):
+            i = min([ ((used[i] + 1.0) / counts[role][i], i) for i in range(len(dirs)) if counts[role][i] > used[i] ])[1]
+            used[i] += 1
+            plan[role].append(dirs[i][0])
+    segments = dict([ (dev, [0, 0]) for dev in capacity ])
+    for role, dirs in ((0, primarydirs), (1, mirrordirs)):
+        for i in range(len(dirs)):
+            segments[dirs[i][3]][role] += counts[role][i]
+    for dev in sorted(segments.keys()):
+        total = segments[dev][0] + segments[dev][1]
+        sys.stderr.write('Device %s: %d primaries, %d mirrors per host, %.3f segments per capacity unit, %.3f per throughput unit\n' % (
+                         dev, segments[dev][0], segments[dev][1], total / capacity[dev], total / throughput[dev]))
+    return plan
+
+def build_groups(hostnames, policy, groupsize):
+    nhosts = len(hostnames)
+    if policy == 'spread' or nhosts <= groupsize:
+        return [ hostnames ]
+    full   = nhosts - nhosts % groupsize
+    groups = [ hostnames[i:i+groupsize] for i in range(0, full, groupsize) ]
+    groups[-1] = groups[-1] + hostnames[full:]
+    return groups
+
+def generate_group(hostnames, dbid, content, segdbs, primaryplan, mirrorplan):
+    nhosts    = len(hostnames)
+    primaries = [ [] for x in range(nhosts) ]
+    for i in range(nhosts):
         for j in range(segdbs):
             primaries[i].append(
                 # host, dbid, content, port, replication_port, directory
-                [ hostnames[i], dbid, content, 1025+j, 1089+j, primarydirs[j%len(primarydirs)] + '/gpseg' + str(content) ]
+                [ hostnames[i], dbid, content, 1025+j, 1089+j, primaryplan[j] + '/gpseg' + str(content) ]
                 )
             dbid    += 1
             content += 1
-    mirrors  = [ [], [], [], [] ]
-    mir_prim = [ [0 for x in range(4)] for y in range(4) ]
-    for i in range(segdbs):
-        for j in range(4):
-            cont = primaries[j][i][2]
-            m = find_min(mirrors, mir_prim, j)
+    # Mirror of the primary j of host i goes to the host i+1+(j mod (n-1)), so each
+    # host receives the same number of mirrors and the mirrors of any host are
+    # spread evenly over all the other hosts of the group
+    mirrors  = [ [] for x in range(nhosts) ]
+    for j in range(segdbs):
+        for i in range(nhosts):
+            cont = primaries[i][j][2]
+            m    = (i + 1 + j % (nhosts - 1)) % nhosts
+            k    = len(mirrors[m])
             mirrors[m].append(
                 # host, dbid, content, port, replication_port, directory
-                [ hostnames[m], dbid, cont, 1153+i, 1217+i, mirrordirs[i%len(mirrordirs)] + '/gpseg' + str(cont)]
+                [ hostnames[m], dbid, cont, 1153+k, 1217+k, mirrorplan[k] + '/gpseg' + str(cont) ]
                 )
-            mir_prim[j][m] += 1
             dbid    += 1
     return primaries, mirrors, dbid, content
-    
+
+def failover_load(prim, mirr):
+    # Maximal number of extra primaries any host runs after a single host failure
+    mirror_host = dict()
+    for host in mirr:
+        for seg in host:
+            mirror_host[seg[2]] = seg[0]
+    worst = 0
+    for host in prim:
+        load = dict()
+        for seg in host:
+            load[mirror_host[seg[2]]] = load.get(mirror_host[seg[2]], 0) + 1
+        if len(load) > 0:
+            worst = max(worst, max(load.values()))
+    return worst
+
+def read_map_file(filename):
+    # Segments are returned as (content, role, host, directory). Accepted are
+    # gpinitsystem map (host:port:dir:dbid:content:replport lines inside of
+    # PRIMARY_ARRAY and MIRROR_ARRAY) and gpexpand map
+    # (host:address:port:dir:dbid:content:role:replport lines)
+    segs = []
+    role = None
+    for line in open(filename):
+        line = line.strip()
+        if line.startswith('declare'):
+            role = 'm' if 'MIRROR_ARRAY' in line else 'p'
+            continue
+        if line.startswith(')'):
+            role = None
+            continue
+        f = line.split(':')
+        if len(f) == 8 and f[6] in ('p', 'm'):
+            segs.append((int(f[5]), f[6], f[0], f[3]))
+        elif len(f) == 6 and role is not None:
+            segs.append((int(f[4]), role, f[0], f[2]))
+    if len(segs) == 0:
+        raise_err('No segments found in the map file %s' % filename)
+    return segs
+
+def read_catalog(dbname, username):
+    query = """
+            SELECT  gpsc.content,
+                    gpsc.preferred_role,
+                    gpsc.hostname,
+                    pgfse.fselocation
+                FROM pg_filespace             as pgfs,
+                     pg_filespace_entry       as pgfse,
+                     gp_segment_configuration as gpsc
+            WHERE   pgfse.fsefsoid = pgfs.oid
+                AND  pgfse.fsedbid = gpsc.dbid
+                AND    pgfs.fsname = 'pg_system'
+                AND   gpsc.content <> -1
+        """
+    try:
+        dburl = dbconn.DbURL(hostname='127.0.0.1', port=5432, dbname=dbname, username=username)
+        conn  = dbconn.connect(dburl)
+        rows  = dbconn.execSQL(conn, query).fetchall()
+        conn.close()
+    except Exception, e:
+        raise_err('Cannot read segment configuration from database %s: %s' % (dbname, str(e)))
+    return [ (int(r[0]), r[1], r[2], r[3]) for r in rows ]
+
+def generated_segments(prim, mirr):
+    segs = []
+    for host in prim:
+        for seg in host:
+            segs.append((seg[2], 'p', seg[0], seg[5]))
+    for host in mirr:
+        for seg in host:
+            segs.append((seg[2], 'm', seg[0], seg[5]))
+    return segs
+
+def first_alive(loads, unithost, failed):
+    # loads are sorted descending, so the first unit on a surviving host has the maximum
+    for load, unit in loads:
+        if unithost[unit] not in failed:
+            return load
+    return 0
+
+def failure_stats(segs, unit_of):
+    # Acting primaries per unit (host or data directory) after the failure of
+    # every single host and every pair of hosts. Only the units receiving the
+    # mirrors of a failed host change their load, so a pair of hosts is
+    # evaluated in constant time from the per-host maximums unless the mirrors
+    # of both hosts land on the same unit
+    mirror   = dict([ (s[0], s) for s in segs if s[1] == 'm' ])
+    base     = dict()
+    unithost = dict()
+    for s in segs:
+        unit = unit_of(s)
+        unithost[unit] = s[2]
+        base[unit] = base.get(unit, 0) + (1 if s[1] == 'p' else 0)
+    hosts  = sorted(set(unithost.values()))
+    nunits = dict([ (h, 0) for h in hosts ])
+    for unit in unithost:
+        nunits[unithost[unit]] += 1
+    moved  = dict([ (h, dict()) for h in hosts ])
+    lost   = dict()
+    nprim  = 0
+    for s in segs:
+        if s[1] != 'p':
+            continue
+        nprim += 1
+        m = mirror.get(s[0])
+        if m is None or m[2] == s[2]:
+            # Unmirrored content or mirror on the same host is lost with the host
+            lost[(s[2], s[2])] = lost.get((s[2], s[2]), 0) + 1
+        else:
+            unit = unit_of(m)
+            moved[s[2]][unit] = moved[s[2]].get(unit, 0) + 1
+            lost[(s[2], m[2])] = lost.get((s[2], m[2]), 0) + 1
+    topbase = sorted([ (base[u], u) for u in base ], reverse=True)
+    best    = dict()
+    for h in hosts:
+        best[h] = sorted([ (base[u] + c, u) for u, c in moved[h].items() ], reverse=True)
+    # Pairs of hosts sending mirrors to the same unit need the full evaluation
+    senders = dict()
+    for h in hosts:
+        for unit in moved[h]:
+            senders.setdefault(unit, []).append(h)
+    overlap = set()
+    for unit in senders:
+        for i in range(len(senders[unit])):
+            for j in range(i + 1, len(senders[unit])):
+                overlap.add((senders[unit][i], senders[unit][j]))
+    totalunits = len(unithost)
+    stats = []
+    stats.append([1, 0, topbase[0][0], float(topbase[0][0]), float(nprim) / max(totalunits, 1), 'none'])
+    res = [0, 0, 0, 0.0, 0.0, 'none']
+    for a in hosts:
+        failed = (a,)
+        loss   = lost.get((a, a), 0)
+        mx     = max(first_alive(best[a], unithost, failed), first_alive(topbase, unithost, failed))
+        update_stats(res, mx, nprim - loss, totalunits - nunits[a], loss, failed)
+    stats.append(finish_stats(res))
+    res = [0, 0, 0, 0.0, 0.0, 'none']
+    for i in range(len(hosts)):
+        a = hosts[i]
+        for j in range(i + 1, len(hosts)):
+            b = hosts[j]
+            failed = (a, b)
+            loss   = lost.get((a, a), 0) + lost.get((b, b), 0) + lost.get((a, b), 0) + lost.get((b, a), 0)
+            if (a, b) in overlap:
+                load = dict()
+                for h in failed:
+                    for unit, c in moved[h].items():
+                        if unithost[unit] not in failed:
+                            load[unit] = load.get(unit, base[unit]) + c
+                mx = max(load.values() + [first_alive(topbase, unithost, failed)])
+            else:
+                mx = max(first_alive(best[a], unithost, failed),
+                         first_alive(best[b], unithost, failed),
+                         first_alive(topbase,  unithost, failed))
+            update_stats(res, mx, nprim - loss, totalunits - nunits[a] - nunits[b], loss, failed)
+    stats.append(finish_stats(res))
+    return stats
+
+def update_stats(res, mx, acting, units, loss, failed):
+    # res is [scenarios, unavailable, max, sum of max, sum of mean, worst scenario]
+    res[0] += 1
+    if loss > 0:
+        res[1] += 1
+    if mx > res[2] or res[0] == 1:
+        res[2] = mx
+        res[5] = ','.join(failed)
+    res[3] += mx
+    res[4] += float(acting) / max(units, 1)
+    return
+
+def finish_stats(res):
+    n = max(res[0], 1)
+    return [ res[0], res[1], res[2], res[3] / n, res[4] / n, res[5] ]
+
+def simulate(segs, dirdepth, f):
+    def by_host(s):
+        return s[2]
+    def by_directory(s):
+        return (s[2], '/'.join(s[3].rstrip('/').split('/')[:dirdepth+1]))
+    f.write('Level|Failed hosts|Scenarios|Scenarios with unavailable data|Max acting primaries|Mean max acting primaries|Mean acting primaries|Worst scenario\n')
+    for level, unit_of in (('host', by_host), ('directory', by_directory)):
+        stats = failure_stats(segs, unit_of)
+        for nfailed in range(len(stats)):
+            f.write('%s|%d|%d|%d|%d|%.3f|%.3f|%s\n' % tuple([level, nfailed] + stats[nfailed]))
+    return
+
+def get_databases(dburl):
+    conn = dbconn.connect(dburl)
+    rows = dbconn.execSQL(conn, "select datname from pg_database where datallowconn order by 1").fetchall()
+    conn.close()
+    return [ r[0] for r in rows ]
+
+def read_tables(dburl):
+    # Partitioned tables are redistributed as a whole, so the size of the root
+    # includes all its partitions and the partitions are not listed themselves.
+    # Names are quoted the same way as fq_name of gpexpand.status_detail
+    query = """
+        select  quote_ident(t.nspname),
+                quote_ident(t.relname),
+                case when d.attrnums is null then 'random' else 'hash' end,
+                pg_total_relation_size(t.oid)
+                    + coalesce((select sum(pg_total_relation_size((quote_ident(p.partitionschemaname)
+                                                                   || '.' || quote_ident(p.partitiontablename))::regclass))
+                                    from pg_partitions as p
+                                    where p.schemaname = t.nspname
+                                        and p.tablename = t.relname), 0)
+            from (
+                    select c.oid,
+                           n.nspname,
+                           c.relname
+                        from pg_class as c,
+                             pg_namespace as n
+                        where c.relnamespace = n.oid
+                            and c.relkind = 'r'
+                            and c.relstorage in ('h', 'a', 'c')
+                            and n.nspname not in ('pg_catalog', 'information_schema', 'gp_toolkit', 'gpexpand')
+                            and n.nspname not like 'pg_temp%'
+                 ) as t
+                 inner join gp_distribution_policy as d
+                    on d.localoid = t.oid
+                 left join pg_partitions as p
+                    on p.partitiontablename = t.relname
+                    and p.partitionschemaname = t.nspname
+            where p.partitiontablename is null"""
+    conn = dbconn.connect(dburl)
+    rows = dbconn.execSQL(conn, query).fetchall()
+    conn.close()
+    return [ (r[0], r[1], r[2], int(r[3])) for r in rows ]
+
+def moved_fraction(policy, oldsegs, newsegs):
+    # Random distribution sends each row to a random segment. Hash distribution
+    # maps the hash to the segment modulo the number of segments, so the row
+    # stays only if both modulos match. The pattern repeats with the period of
+    # the least common multiple of the numbers of segments, and within it both
+    # modulos are equal to r only for the hash equal to r, so the rows of
+    # min(oldsegs, newsegs) hashes of the period stay
+    if policy == 'random':
+        return 1.0 - 1.0 / newsegs
+    a, b = oldsegs, newsegs
+    while b:
+        a, b = b, a % b
+    period = oldsegs * newsegs / a
+    return 1.0 - float(min(oldsegs, newsegs)) / period
+
+def plan_redistribution(options):
+    dburl = dbconn.DbURL(hostname='127.0.0.1', port=5432, dbname=options.dbname, username=options.username)
+    try:
+        conn = dbconn.connect(dburl)
+        oldsegs = int(dbconn.execSQL(conn, "select count(*) from gp_segment_configuration where content >= 0 and role = 'p'").fetchall()[0][0])
+        conn.close()
+        tables = []
+        for dbname in get_databases(dburl):
+            dburl = dbconn.DbURL(hostname='127.0.0.1', port=5432, dbname=dbname, username=options.username)
+            for schema, table, policy, size in read_tables(dburl):
+                tables.append((dbname, schema + '.' + table, policy, size))
+    except Exception, e:
+        raise_err('Cannot read tables from the database: %s' % str(e))
+    newsegs   = oldsegs + int(options.added) * int(options.segdbs)
+    priority  = []
+    if options.priority:
+        priority = options.priority.split(',')
+    fractions = dict()
+    plan = []
+    for dbname, fq_name, policy, size in tables:
+        if policy not in fractions:
+            fractions[policy] = moved_fraction(policy, oldsegs, newsegs)
+        # Tables listed by name, schema or database go first in the order of the list
+        prio = len(priority)
+        for i in range(len(priority)):
+            if priority[i] in (fq_name, fq_name.split('.')[0], dbname):
+                prio = i
+                break
+        plan.append((prio, -size, dbname, fq_name, policy, size, size * fractions[policy]))
+    plan.sort()
+    if options.planfile:
+        f = open(options.planfile, 'w')
+    else:
+        f = sys.stderr
+    f.write('Redistribution from %d to %d primary segments, %d tables, throughput %.1f MB/s\n' % (
+            oldsegs, newsegs, len(plan), options.throughput))
+    f.write('Rank|Database|Table|Distribution|Size MB|Moved MB|Duration seconds|Finished after seconds\n')
+    total = 0.0
+    rank  = 0
+    for prio, nsize, dbname, fq_name, policy, size, moved in plan:
+        rank += 1
+        # The whole table is rewritten by the redistribution, not only the moved rows
+        duration = size / 1048576.0 / options.throughput
+        total   += duration
+        f.write('%d|%s|%s|%s|%.1f|%.1f|%.1f|%.1f\n' % (rank, dbname, fq_name, policy,
+                size / 1048576.0, moved / 1048576.0, duration, total))
+    f.write('Total: %.1f MB, %.1f MB moved, %.1f seconds\n' % (sum([p[5] for p in plan]) / 1048576.0,
+            sum([p[6] for p in plan]) / 1048576.0, total))
+    if options.rankfile:
+        r = open(options.rankfile, 'w')
+        rank = 0
+        for prio, nsize, dbname, fq_name, policy, size, moved in plan:
+            rank += 1
+            r.write("update gpexpand.status_detail set rank = %d where dbname = '%s' and fq_name = '%s';\n" % (rank, dbname.replace("'", "''"), fq_name.replace("'", "''")))
+        r.close()
+    return
+
 def generate_map (options):
     if options.primarydirs:
-        primarydirs = options.primarydirs.split(':')
-        mirrordirs  = options.mirrordirs.split(':')
+        primarydirs = parse_dirs(options.primarydirs)
+        mirrordirs  = parse_dirs(options.mirrordirs)
     else:
-        primarydirs = ['/data1/primary', '/data2/primary']
-        mirrordirs  = ['/data1/mirror',  '/data2/mirror']
+        primarydirs = parse_dirs('/data1/primary:/data2/primary')
+        mirrordirs  = parse_dirs('/data1/mirror:/data2/mirror')
     if options.initsystem:
         host     = 1
         dbid     = 2
@@ -183,18 +656,20 @@ def generate_map (options):
         host     = int(options.seghosts)   + 1
         dbid     = int(options.maxdbid)    + 1
         content  = int(options.maxcontent) + 1
-        seghosts = host + int(options.added)
+        seghosts = host + int(options.added) - 1
         segdbs   = int(options.segdbs)
+    hostnames = [ 'sdw' + str(x) for x in range(host, seghosts + 1) ]
+    primaryplan, mirrorplan = plan_directories(primarydirs, mirrordirs, segdbs)
     resmap_prim = []
     resmap_mirr = []
-    if seghosts < 4:
-        resmap_prim, resmap_mirr = generate_small_cluster(seghosts, host, dbid, content, segdbs, primarydirs, mirrordirs)
-    else:
-        while host < seghosts:
-            new_prim, new_mirr, dbid, content = generate_next_4_hosts(host, dbid, content, segdbs, primarydirs, mirrordirs)
-            resmap_prim.extend(new_prim)
-            resmap_mirr.extend(new_mirr)
-            host = host + 4
+    groups = build_groups(hostnames, options.policy, options.groupsize)
+    for group in groups:
+        new_prim, new_mirr, dbid, content = generate_group(group, dbid, content, segdbs, primaryplan, mirrorplan)
+        resmap_prim.extend(new_prim)
+        resmap_mirr.extend(new_mirr)
+    smallest = min([ len(g) for g in groups ])
+    sys.stderr.write('Maximal number of extra primaries on a host after single host failure: %d (optimum %d)\n' % (
+                     failover_load(resmap_prim, resmap_mirr), (segdbs + smallest - 2) / (smallest - 1)))
     return resmap_prim, resmap_mirr
 
 def output_map (options, prim, mirr):
@@ -243,8 +718,23 @@ declare -a MIRROR_ARRAY=(
 
 def main():
     options = parseargs()
+    if (options.mapfile or options.dbname) and not options.redistribution:
+        if options.mapfile:
+            segs = read_map_file(options.mapfile)
+        else:
+            segs = read_catalog(options.dbname, options.username)
+        if options.outfile:
+            f = open(options.outfile, 'w')
+        else:
+            f = sys.stdout
+        simulate(segs, options.dirdepth, f)
+        return
     validate_options(options)
     prim, mirr = generate_map(options)
     output_map(options, prim, mirr)
+    if options.simulate:
+        simulate(generated_segments(prim, mirr), options.dirdepth, sys.stderr)
+    if options.redistribution:
+        plan_redistribution(options)
 
 main()
\ No newline at end of file
@@ -1,6 +1,12 @@
 import datetime as dt
 import sys
+import os
+import json
+import re
 import random
+import time
+import hashlib
+from multiprocessing import Process
 try:
     from gppylib.db import dbconn
     from pygresql.pg import DatabaseError
@@ -22,6 +28,16 @@ def parseargs():
     parser.add_option('-p', '--password',   type='string')
     parser.add_option('-l', '--logfile',    type='string')
     parser.add_option('-n', '--nrows',      type='int')
+    parser.add_option('-w', '--workload',   type='string')
+    parser.add_option('-t', '--tags',       type='string')
+    parser.add_option('-x', '--explainfile', type='string')
+    parser.add_option('--explaindiff',      type='string', nargs=2)
+    parser.add_option('-s', '--scalefactor', type='float')
+    parser.add_option('-j', '--jobs',       type='int')
+    parser.add_option('-k', '--keep',       action='store_true')
+    parser.add_option('--schema',           type='string')
+    parser.add_option('--skew',             action='store_true')
+    parser.add_option('--skewthreshold',    type='float')
     
     (options, args) = parser.parse_args()
     if options.help:
@@ -32,21 +48,84 @@ python performance_baseline.py -d database_name
                                [-u username -p password]
                                [-l logfile]
                                [-n number_of_rows]
+                               [-w workload_file] [-t tag1,tag2,...]
+                               [-x explain_file]
+                               [-s scale_factor [-j jobs] [-k] [--schema schema_name]]
+                               [--skew [--skewthreshold ratio]]
+python performance_baseline.py --explaindiff base_explain_file new_explain_file
+                               [-l logfile]
     -d | --database   - name of the database to run the test
     -u | --username   - name of the user to be used for testing (default is $PGUSER)
     -p | --password   - password of the user used for testing   (default is $PGPASSWORD)
     -l | --logfile    - performance test output file (default is stdout)
     -n | --nrows      - number of rows generated in test table (default is 5000)
+    -w | --workload   - JSON file with the workload definition (default is
+                        performance_baseline_workload.json next to this script)
+    -t | --tags       - comma-separated list of tags, only the timed queries
+                        having at least one of them are run (default is all)
+    -x | --explainfile - run each timed query once more under EXPLAIN ANALYZE and
+                        store per-node, per-slice and statement statistics in
+                        this file, one JSON record per line
+    --explaindiff      - compare two files produced by -x node by node
+    -s | --scalefactor - generate scale_factor millions of rows in each table of
+                        the "generate" phase with parallel sessions instead of
+                        running "setup", "scale" and "teardown" phases
+    -j | --jobs        - number of parallel sessions generating data (default is 4)
+    -k | --keep        - keep generated tables after the run and reuse them in
+                        the next runs if their fingerprint and row count match
+    --schema           - schema for the generated tables (default is perf_baseline)
+    --skew             - run the segment-local workloads of the "skew" phase on
+                        all the segments at once and report per-segment
+                        processing times, skew ratios and outlier hosts
+    --skewthreshold    - ratio to the median processing time above which a
+                        segment or a host is reported as outlier (default is 1.25)
+Workload file is a JSON object with four lists of steps: "setup", "scale",
+"queries" and "teardown", executed in this order. Each step has a "name" and
+"sql" (string or list of lines), optionally "repetitions" (default is 1),
+"tags" and "cleanup" (untimed statement run after each repetition). Timed
+queries report average time among their repetitions. Placeholders {nrows} and
+{base_rows} (nrows/64) are substituted in the SQL text. Steps of the "generate"
+phase are used with -s and have the "ddl" creating the table {table} and the
+"sql" inserting ids from {start} to {end} into it, each session inserts its own
+range of ids. Queries find generated tables through the search_path. Steps of
+the "skew" phase return one row per segment with the segment id, number of rows
+processed and epoch of the first and the last row processed on the segment,
+taken with clock_timestamp(). Processing time of the segment is between its own
+first and last row, so it does not depend on the clocks of the hosts.
+Example - quick smoke baseline:
+python performance_baseline.py -d testdb -t smoke
 """
         sys.exit(0)
+    if options.explaindiff:
+        return options
     if not options.nrows:
         options.nrows = 5000
+    if options.scalefactor:
+        if options.scalefactor <= 0:
+            raise_err('Scale factor should be positive')
+        options.nrows = int(options.scalefactor * 1000000)
+    elif options.jobs or options.keep or options.schema:
+        raise_err('Options -j, -k and --schema can be used only with scale factor (-s)')
+    if not options.jobs:
+        options.jobs = 4
+    if not options.schema:
+        options.schema = 'perf_baseline'
+    if not options.skewthreshold:
+        options.skewthreshold = 1.25
+    if options.skewthreshold <= 1:
+        raise_err('Skew threshold should be greater than 1')
     if options.nrows < 5000:
         raise_err('Number of rows should be 5000 or more')
     if not options.database:
         raise_err('You must specify database name (-d)')
     if (options.password and not options.username) or (not options.password and options.username):
         raise_err('You should either specify both username and password or not specify them both')
+    if not options.workload:
+        options.workload = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'performance_baseline_workload.json')
+    if options.tags:
+        options.tags = [x.strip() for x in options.tags.split(',') if x.strip() <> '']
+    else:
+        options.tags = []
     return options
     
 def execute_for_timing(conn, query):
@@ -62,142 +141,451 @@ def execute_for_timing(conn, query):
         print ex
         sys.exit(3)
         
-def run_test(dbURL, nrows, outfile):
-    prep_queries = [
-            ['Preparation Step 1',
-             """create temporary table test1 (a bigint, b bigint, c varchar)
-                    with (appendonly=true, compresstype=quicklz)
-                    on commit drop
-                distributed by (a);"""],
-            ['Preparation Step 2',
-             """insert into test1 (a, b, c)
-                    select id, id*2, md5('text' || id::varchar)
-                        from generate_series(1,%d) as id;""" % (nrows/64)],
-            ['Preparation Step 3',
-             """create temporary table test2 (a bigint, b bigint, c numeric, d varchar)
-                    with (appendonly=true, compresstype=quicklz)
-                    on commit drop
-                distributed by (a);"""],
-            ['Preparation Step 4',
-             """insert into test2 (a, b, c, d)
-                    select id*2, id*3, id::numeric*random(), md5('text' || id::varchar)
-                        from generate_series(1,%d) as id;""" % (nrows/64)]
-        ]
-    multiplier = [
-            ['Multiplier 1',
-             """insert into test1 (a, b, c)
-                    select t1.a + t2.max_id,
-                           t1.b + t3.max_id,
-                           md5('text' || (t1.a + t2.max_id)::varchar)
-                        from (select * from test1) as t1,
-                             (select max(a) as max_id from test1) as t2,
-                             (select max(b) as max_id from test1) as t3;"""],
-            ['Multiplier 2',
-             """insert into test2 (a, b, c, d)
-                    select  t1.a + t2.max_id,
-                            t1.b + t3.max_id,
-                            (t1.a + t2.max_id)::numeric * random(),
-                            md5('text' || ((t1.a + t2.max_id) / 2)::varchar)
-                        from (select * from test1) as t1,
-                             (select max(a) as max_id from test2) as t2,
-                             (select max(b) as max_id from test2) as t3"""]
-        ]
-    queries = [
-            ['Co-located join',
-             """select count(*)
-                    from (
-                        select *
-                            from test1 as t1
-                                inner join test2 as t2
-                                on t1.a = t2.a            
-                        ) as q;"""],
-            ['Join with single redistribute',
-             """select count(*)
-                    from (
-                        select *
-                            from test1 as t1
-                                inner join test2 as t2
-                                on t1.a = t2.b
-                        ) as q;"""],        
-            ['Join with 2 redistributions',
-             """select count(*)
-                    from (
-                        select *
-                            from test1 as t1
-                                inner join test2 as t2
-                                on t1.b = t2.b
-                        ) as q;"""],
-            ['Double redistribution and join on non-unique field',
-             """select count(*)
-                    from (
-                        select *
-                            from test1 as t1
-                                inner join test2 as t2
-                                on t1.b = t2.c::bigint
-                        ) as q;"""],
-            ['Double redistribution and join on text fields',
-             """select count(*)
-                    from (
-                        select *
-                            from test1 as t1
-                                inner join test2 as t2
-                                on t1.c = t2.d
-                        ) as q;"""],
-            ['CPU-intensive workload of MD5 hashing',
-             """select count(*)
-                    from (
-                        select md5(a::varchar || '|' || b::varchar || '|' || c::varchar || '|' || d)
-                            from test2
-                        ) as q;"""],
-            ['Sorts and redistributions with all the segments involved',
-             """select count(*)
-                    from (
-                        select  a, b, c, d,
-                                max(a) over (partition by (c/100)::bigint) as v1
-                            from test2
-                        ) as q;"""],
-            ['Write test after co-located join',
-             """create temporary table test3 
-                        with (appendonly=true, compresstype=quicklz)
-                        on commit drop
-                        as
-                    select t1.a, t1.b, t1.c, t2.b as b2, t2.c as c2, t2.d
-                        from test1 as t1
-                            inner join test2 as t2
-                            on t1.a = t2.a;"""],
-            ['Write test after redistribution',
-             """create temporary table test4
-                        with (appendonly=true, compresstype=quicklz)
-                        on commit drop
-                        as
-                    select t1.a, t1.b, t1.c, t2.b as b2, t2.c as c2, t2.d
-                        from test1 as t1
-                            inner join test2 as t2
-                            on t1.b = t2.a;"""],
-            ['Cleanup test3 table',
-             'drop table test3;'],
-            ['Cleanup test4 table',
-             'drop table test4;']
-        ]
+def load_workload(filename, nrows, tags):
+    def statement(step):
+        sql = step['sql']
+        if isinstance(sql, list):
+            sql = '\n'.join(sql)
+        for key, value in params.items():
+            sql = sql.replace('{%s}' % key, str(value))
+        return sql
+    params = { 'nrows'     : nrows,
+               'base_rows' : nrows/64 }
+    try:
+        wl = json.load(open(filename, 'r'))
+    except (IOError, ValueError), ex:
+        raise_err('Cannot read workload file %s: %s' % (filename, str(ex)))
+    workload = dict()
+    for phase in ['setup', 'scale', 'generate', 'queries', 'skew', 'teardown']:
+        workload[phase] = []
+        for step in wl.get(phase, []):
+            if not 'name' in step or not 'sql' in step:
+                raise_err('Each step of the phase "%s" in %s should have "name" and "sql"' % (phase, filename))
+            step_tags = step.get('tags', [])
+            if phase == 'queries' and tags and len(set(tags) & set(step_tags)) == 0:
+                continue
+            cleanup = step.get('cleanup')
+            if cleanup is not None:
+                cleanup = statement({'sql': cleanup})
+            ddl = step.get('ddl')
+            if phase == 'generate':
+                if ddl is None:
+                    raise_err('Each step of the phase "generate" in %s should have "ddl"' % filename)
+                ddl = statement({'sql': ddl})
+            workload[phase].append({
+                    'name'        : step['name'],
+                    'sql'         : statement(step),
+                    'repetitions' : int(step.get('repetitions', 1)),
+                    'tags'        : step_tags,
+                    'cleanup'     : cleanup,
+                    'ddl'         : ddl
+                })
+    if len(workload['queries']) == 0:
+        raise_err('No timed queries left in %s after filtering by tags %s' % (filename, ','.join(tags)))
+    return workload
+
+def run_steps(conn, steps, outfile):
+    for q in steps:
+        for i in range(q['repetitions']):
+            t = execute_for_timing(conn, q['sql'])
+            if q['repetitions'] > 1:
+                outfile.write ('%s - run %d|%f\n' % (q['name'], i+1, t))
+            else:
+                outfile.write ('%s|%f\n' % (q['name'], t))
+    return
+
+def size_kb(value, unit):
+    # Greenplum prints memory as "4K bytes", "12345 bytes" or "128000kB"
+    if unit is not None and unit.lower().startswith('k'):
+        return float(value)
+    return float(value) / 1024.
+
+def parse_explain(query_name, plan_lines):
+    re_node     = re.compile(r'^(\s*)(->\s+)?(.+?)\s+\(cost=')
+    re_slice    = re.compile(r'\(slice(\d+)(?:; segments: (\d+))?\)')
+    re_actual   = re.compile(r'\(actual time=([\d.]+)\.\.([\d.]+) rows=(\d+) loops=(\d+)\)')
+    re_rows     = re.compile(r'Rows out:\s+(\d+) rows')
+    re_avg      = re.compile(r'Avg ([\d.]+) rows x (\d+) workers')
+    re_max      = re.compile(r'Max (\d+) rows \((seg\d+)\)')
+    re_maxlast  = re.compile(r'Max/Last\((seg\d+)[^)]*\) (\d+)/\d+ rows')
+    re_first    = re.compile(r'([\d.]+)(?:/[\d.]+)? ms to first row')
+    re_end      = re.compile(r'([\d.]+)(?:/[\d.]+)? ms to end')
+    re_offset   = re.compile(r'start offset by ([\d.]+)')
+    re_mem      = re.compile(r'Executor memory:\s+([\d.]+)(K)? bytes(?: avg(?: x (\d+) workers)?, ([\d.]+)(K)? bytes max \((seg\d+)\))?', re.I)
+    re_wm_used  = re.compile(r'Work_mem used:\s+([\d.]+)(K)? bytes avg, ([\d.]+)(K)? bytes max', re.I)
+    re_wm_want  = re.compile(r'Work_mem wanted:\s+([\d.]+)(K)? bytes avg, ([\d.]+)(K)? bytes max', re.I)
+    re_spill    = re.compile(r'Workfile: \((\d+) spilling')
+    re_slicest  = re.compile(r'^\s*\(slice(\d+)\)\s+(\*)?')
+    re_slice_wm = re.compile(r'Work_mem: ([\d.]+)(K)? bytes max(?:, ([\d.]+)(K)? bytes wanted)?', re.I)
+    re_runtime  = re.compile(r'(?:Total runtime|Execution time):\s+([\d.]+) ms')
+    re_memused  = re.compile(r'Memory used:\s+([\d.]+)\s*(K|kB)?')
+    nodes  = []
+    slices = []
+    stmt   = { 'record': 'statement', 'query': query_name, 'runtime_ms': None, 'memory_used_kb': None }
+    stack  = []     # (indent, node) for the current path from the plan root
+    for line in plan_lines:
+        m = re_node.match(line)
+        if m and not line.strip().startswith('(slice'):
+            indent = len(m.group(1))
+            while len(stack) > 0 and stack[-1][0] >= indent:
+                stack.pop()
+            if len(stack) > 0:
+                parent = stack[-1][1]
+                parent['children'] += 1
+                path  = '%s.%d' % (parent['path'], parent['children'] - 1)
+                slice = parent['slice']
+                segs  = parent['segments']
+            else:
+                path, slice, segs = '0', 0, None
+            ms = re_slice.search(line)
+            if ms:
+                slice = int(ms.group(1))
+                if ms.group(2):
+                    segs = int(ms.group(2))
+            node = { 'record': 'node', 'query': query_name, 'path': path,
+                     'node_type': re_slice.sub('', m.group(3)).strip(),
+                     'slice': slice, 'segments': segs,
+                     'rows_avg': None, 'workers': None, 'rows_max': None, 'max_seg': None,
+                     'first_row_ms': None, 'end_ms': None, 'offset_ms': None,
+                     'executor_mem_kb': None, 'executor_mem_max_kb': None,
+                     'work_mem_used_kb': None, 'work_mem_used_max_kb': None,
+                     'work_mem_wanted_kb': None, 'spilling_workers': 0,
+                     'children': 0 }
+            ma = re_actual.search(line)
+            if ma:
+                node['first_row_ms'] = float(ma.group(1))
+                node['end_ms']       = float(ma.group(2))
+                node['rows_max']     = int(ma.group(3))
+            nodes.append(node)
+            stack.append((indent, node))
+            continue
+        if line.strip().startswith(('Slice statistics', 'Statement statistics', 'Settings',
+                                    'Planning time', 'Optimizer', 'Total runtime', 'Execution time')):
+            stack = []
+        mr = re_runtime.search(line)
+        if mr:
+            stmt['runtime_ms'] = float(mr.group(1))
+            continue
+        mss = re_slicest.match(line)
+        if mss:
+            sl = { 'record': 'slice', 'query': query_name, 'slice': int(mss.group(1)),
+                   'work_mem_exceeded': mss.group(2) is not None,
+                   'executor_mem_kb': None, 'executor_mem_max_kb': None, 'workers': None,
+                   'max_seg': None, 'work_mem_max_kb': None, 'work_mem_wanted_kb': None }
+            mm = re_mem.search(line)
+            if mm:
+                sl['executor_mem_kb'] = size_kb(mm.group(1), mm.group(2))
+                if mm.group(4):
+                    sl['workers']             = int(mm.group(3)) if mm.group(3) else None
+                    sl['executor_mem_max_kb'] = size_kb(mm.group(4), mm.group(5))
+                    sl['max_seg']             = mm.group(6)
+            mw = re_slice_wm.search(line)
+            if mw:
+                sl['work_mem_max_kb'] = size_kb(mw.group(1), mw.group(2))
+                if mw.group(3):
+                    sl['work_mem_wanted_kb'] = size_kb(mw.group(3), mw.group(4))
+            slices.append(sl)
+            stack = []
+            continue
+        if len(stack) == 0:
+            mu = re_memused.search(line)
+            if mu:
+                stmt['memory_used_kb'] = size_kb(mu.group(1), mu.group(2))
+            continue
+        node = stack[-1][1]
+        if 'Rows out:' in line:
+            mv = re_avg.search(line)
+            if mv:
+                node['rows_avg'] = float(mv.group(1))
+                node['workers']  = int(mv.group(2))
+            mx = re_max.search(line)
+            ml = re_maxlast.search(line)
+            mp = re_rows.search(line)
+            if mx:
+                node['rows_max'], node['max_seg'] = int(mx.group(1)), mx.group(2)
+            elif ml:
+                node['rows_max'], node['max_seg'] = int(ml.group(2)), ml.group(1)
+            elif mp:
+                node['rows_max'] = int(mp.group(1))
+            for attr, rx in [('first_row_ms', re_first), ('end_ms', re_end), ('offset_ms', re_offset)]:
+                mt = rx.search(line)
+                if mt:
+                    node[attr] = float(mt.group(1))
+            continue
+        mm = re_mem.search(line)
+        if mm:
+            node['executor_mem_kb'] = size_kb(mm.group(1), mm.group(2))
+            if mm.group(4):
+                node['executor_mem_max_kb'] = size_kb(mm.group(4), mm.group(5))
+            continue
+        mw = re_wm_used.search(line)
+        if mw:
+            node['work_mem_used_kb']     = size_kb(mw.group(1), mw.group(2))
+            node['work_mem_used_max_kb'] = size_kb(mw.group(3), mw.group(4))
+        mw = re_wm_want.search(line)
+        if mw:
+            node['work_mem_wanted_kb'] = size_kb(mw.group(3), mw.group(4))
+        msp = re_spill.search(line)
+        if msp:
+            node['spilling_workers'] = int(msp.group(1))
+    for node in nodes:
+        del node['children']
+    return nodes + slices + [stmt]
+
+def capture_explain(conn, queries, explainfile):
+    fout = open(explainfile, 'w')
+    for q in queries:
+        try:
+            curs = dbconn.execSQL(conn, 'explain analyze ' + q['sql'])
+            plan = [row[0] for row in curs.fetchall()]
+        except DatabaseError, ex:
+            print 'Failed to capture EXPLAIN ANALYZE for "%s"' % q['name']
+            print ex
+            sys.exit(3)
+        if q['cleanup']:
+            execute_for_timing(conn, q['cleanup'])
+        for rec in parse_explain(q['name'], plan):
+            fout.write(json.dumps(rec, sort_keys=True) + '\n')
+    fout.close()
+    return
+
+def diff_explain(base_file, new_file, outfile):
+    def load(filename):
+        records = dict()
+        for line in open(filename, 'r'):
+            if line.strip() == '':
+                continue
+            rec = json.loads(line)
+            if rec['record'] == 'node':
+                key = (rec['query'], 'node', rec['path'])
+            elif rec['record'] == 'slice':
+                key = (rec['query'], 'slice', str(rec['slice']))
+            else:
+                key = (rec['query'], 'statement', '')
+            records[key] = rec
+        return records
+    def fmt(value):
+        if value is None:
+            return ''
+        if isinstance(value, float):
+            return '%.3f' % value
+        return str(value)
+    base = load(base_file)
+    new  = load(new_file)
+    outfile.write('Query|Record|Path|Node|Slice|Base end ms|New end ms|Delta ms|Base rows max|New rows max|Base spilling|New spilling|Base mem KB|New mem KB|Note\n')
+    for key in sorted(set(base.keys()) | set(new.keys())):
+        b = base.get(key, {})
+        n = new.get(key, {})
+        note = ''
+        if len(b) == 0:
+            note = 'only in new'
+        elif len(n) == 0:
+            note = 'only in base'
+        elif key[1] == 'node' and b['node_type'] <> n['node_type']:
+            note = 'plan changed: %s -> %s' % (b['node_type'], n['node_type'])
+        if key[1] == 'statement':
+            bt, nt = b.get('runtime_ms'), n.get('runtime_ms')
+            bm, nm = b.get('memory_used_kb'), n.get('memory_used_kb')
+        else:
+            bt, nt = b.get('end_ms'), n.get('end_ms')
+            bm = b.get('executor_mem_max_kb') or b.get('executor_mem_kb')
+            nm = n.get('executor_mem_max_kb') or n.get('executor_mem_kb')
+        delta = None
+        if bt is not None and nt is not None:
+            delta = nt - bt
+        outfile.write('%s\n' % '|'.join([ key[0], key[1], key[2],
+                fmt(n.get('node_type', b.get('node_type'))),
+                fmt(n.get('slice', b.get('slice'))),
+                fmt(bt), fmt(nt), fmt(delta),
+                fmt(b.get('rows_max')), fmt(n.get('rows_max')),
+                fmt(b.get('spilling_workers', b.get('work_mem_exceeded'))),
+                fmt(n.get('spilling_workers', n.get('work_mem_exceeded'))),
+                fmt(bm), fmt(nm), note ]))
+    return
+
+def generate_chunk(dbURL, query):
+    try:
+        conn = dbconn.connect(dbURL)
+        dbconn.execSQL(conn, query)
+        conn.commit()
+        conn.close()
+    except DatabaseError, ex:
+        print 'Failed to generate data on the database. Please, check log file for errors.'
+        print ex
+        sys.exit(3)
+    return
+
+def table_fingerprint(step, nrows):
+    return hashlib.md5('%s\n%s\n%d' % (step['ddl'], step['sql'], nrows)).hexdigest()
+
+def reuse_table(conn, schema, step, nrows):
+    curs = dbconn.execSQL(conn, """
+        select obj_description(c.oid, 'pg_class')
+            from pg_class as c,
+                 pg_namespace as n
+            where c.relnamespace = n.oid
+                and n.nspname = '%s'
+                and c.relname = '%s'""" % (schema, step['name']))
+    rows = curs.fetchall()
+    if len(rows) == 0:
+        return False
+    if rows[0][0] <> 'performance_baseline fingerprint %s' % table_fingerprint(step, nrows):
+        return False
+    curs = dbconn.execSQL(conn, 'select count(*) from %s.%s' % (schema, step['name']))
+    return int(curs.fetchall()[0][0]) == nrows
+
+def generate_data(dbURL, steps, nrows, jobs, schema, keep, outfile):
     conn = dbconn.connect(dbURL)
-    for q in prep_queries:
-        t = execute_for_timing(conn, q[1])
-        outfile.write ('%s|%f\n' % (q[0], t))
-    # 2 4 8 16 32 64
-    for q in multiplier:
-        for i in range(6):
-            t = execute_for_timing(conn, q[1])
-            outfile.write ('%s - run %d|%f\n' % (q[0], i+1, t))
-    avg_perf = dict(zip([x[0] for x in queries], [ [] for _ in queries ] ))
-    # Average among 3 runs
-    for _ in range(3):
+    if len(dbconn.execSQL(conn, "select 1 from pg_namespace where nspname = '%s'" % schema).fetchall()) == 0:
+        dbconn.execSQL(conn, 'create schema %s' % schema)
+    chunks   = []
+    tables   = []
+    for step in steps:
+        table = '%s.%s' % (schema, step['name'])
+        if keep and reuse_table(conn, schema, step, nrows):
+            outfile.write ('Reusing %s|%f\n' % (table, 0.0))
+            continue
+        dbconn.execSQL(conn, 'drop table if exists %s' % table)
+        dbconn.execSQL(conn, step['ddl'].replace('{table}', table))
+        tables.append((table, step))
+        # Each session inserts its own range of ids
+        chunk = nrows / jobs + 1
+        for start in range(1, nrows + 1, chunk):
+            end = min(start + chunk - 1, nrows)
+            chunks.append(step['sql'].replace('{table}', table).replace('{start}', str(start)).replace('{end}', str(end)))
+    conn.commit()
+    n1 = dt.datetime.now()
+    running = []
+    while len(chunks) > 0 or len(running) > 0:
+        for p in running[:]:
+            if not p.is_alive():
+                running.remove(p)
+                if p.exitcode != 0:
+                    for other in running:
+                        other.terminate()
+                    raise_err('Data generation failed in one of the sessions')
+        if len(running) < jobs and len(chunks) > 0:
+            p = Process(target=generate_chunk, args=(dbURL, chunks.pop(0)))
+            p.start()
+            running.append(p)
+        else:
+            time.sleep(0.1)
+    n2 = dt.datetime.now()
+    if len(tables) > 0:
+        outfile.write ('Parallel data generation|%f\n' % (((n2-n1).seconds*1e6 + (n2-n1).microseconds) / 1e6))
+    for table, step in tables:
+        t = execute_for_timing(conn, 'analyze %s' % table)
+        outfile.write ('Analyze %s|%f\n' % (table, t))
+        if keep:
+            dbconn.execSQL(conn, "comment on table %s is 'performance_baseline fingerprint %s'" % (table, table_fingerprint(step, nrows)))
+    conn.commit()
+    conn.close()
+    return
+
+def drop_generated(dbURL, steps, schema):
+    conn = dbconn.connect(dbURL)
+    for step in steps:
+        dbconn.execSQL(conn, 'drop table if exists %s.%s' % (schema, step['name']))
+    conn.commit()
+    conn.close()
+    return
+
+def median(values):
+    values = sorted(values)
+    n = len(values)
+    if n % 2 == 1:
+        return values[n/2]
+    return (values[n/2-1] + values[n/2]) / 2.
+
+def run_skew(conn, steps, threshold, outfile):
+    curs  = dbconn.execSQL(conn, """
+        select content, hostname
+            from gp_segment_configuration
+            where role = 'p'
+                and content >= 0""")
+    hosts = dict([(int(r[0]), r[1]) for r in curs.fetchall()])
+    outfile.write ('Skew|Workload|Segment|Host|Rows|Processing seconds|Rows per second\n')
+    for q in steps:
+        completion = dict()
+        nrows      = dict()
+        for i in range(q['repetitions']):
+            try:
+                curs = dbconn.execSQL(conn, q['sql'])
+                rows = curs.fetchall()
+            except DatabaseError, ex:
+                print 'Failed to execute the statement on the database. Please, check log file for errors.'
+                print ex
+                sys.exit(3)
+            if len(rows) == 0:
+                continue
+            # Segments run on different hosts, so the time of each segment is
+            # taken from its own clock only: from its first to its last row
+            for r in rows:
+                seg = int(r[0])
+                completion.setdefault(seg, []).append(float(r[3]) - float(r[2]))
+                nrows[seg] = int(r[1])
+        if len(completion) == 0:
+            outfile.write ('Skew summary|%s|no segments reported\n' % q['name'])
+            continue
+        seg_time = dict([(seg, sum(v) / len(v)) for seg, v in completion.items()])
+        for seg in sorted(seg_time.keys()):
+            outfile.write ('Skew|%s|%d|%s|%d|%f|%f\n' % (q['name'], seg, hosts.get(seg, ''), nrows[seg],
+                           seg_time[seg], nrows[seg] / max(seg_time[seg], 1e-6)))
+        med = median(seg_time.values())
+        avg = sum(seg_time.values()) / len(seg_time)
+        slowest = max(seg_time.keys(), key=lambda x: seg_time[x])
+        outfile.write ('Skew summary|%s|min %f|median %f|max %f|max/median %f|max/avg %f|slowest segment %d|host %s\n' % (
+                       q['name'], min(seg_time.values()), med, seg_time[slowest],
+                       seg_time[slowest] / max(med, 1e-6), seg_time[slowest] / max(avg, 1e-6),
+                       slowest, hosts.get(slowest, '')))
+        for seg in sorted(seg_time.keys()):
+            if seg_time[seg] > med * threshold:
+                outfile.write ('Skew outlier segment|%s|%d|%s|%f\n' % (q['name'], seg, hosts.get(seg, ''), seg_time[seg] / max(med, 1e-6)))
+        host_time = dict()
+        for seg, t in seg_time.items():
+            host_time.setdefault(hosts.get(seg, ''), []).append(t)
+        host_time = dict([(h, sum(v) / len(v)) for h, v in host_time.items()])
+        host_med  = median(host_time.values())
+        for host in sorted(host_time.keys()):
+            if host_time[host] > host_med * threshold:
+                outfile.write ('Skew outlier host|%s|%s|%f\n' % (q['name'], host, host_time[host] / max(host_med, 1e-6)))
+    return
+
+def run_test(dbURL, workload, outfile, options):
+    if options.scalefactor:
+        generate_data(dbURL, workload['generate'], options.nrows, options.jobs, options.schema, options.keep, outfile)
+        conn = dbconn.connect(dbURL)
+        dbconn.execSQL(conn, 'set search_path to %s, public' % options.schema)
+    else:
+        conn = dbconn.connect(dbURL)
+        run_steps(conn, workload['setup'], outfile)
+        # 2 4 8 16 32 64
+        run_steps(conn, workload['scale'], outfile)
+    queries  = workload['queries']
+    avg_perf = dict(zip([x['name'] for x in queries], [ [] for _ in queries ] ))
+    # Average among the runs, interleaving the queries the same way for each run
+    for run in range(max([x['repetitions'] for x in queries])):
         for q in queries:
-            t = execute_for_timing(conn, q[1])
-            avg_perf[q[0]].append(t)
+            if run < q['repetitions']:
+                t = execute_for_timing(conn, q['sql'])
+                avg_perf[q['name']].append(t)
+                if q['cleanup']:
+                    execute_for_timing(conn, q['cleanup'])
     for q in queries:
-        avg = sum(avg_perf[q[0]]) / len(avg_perf[q[0]])
-        outfile.write ('%s|%f\n' % (q[0], avg))
-    conn.close()
+        avg = sum(avg_perf[q['name']]) / len(avg_perf[q['name']])
+        outfile.write ('%s|%f\n' % (q['name'], avg))
+    # One extra run of each timed query to collect its execution statistics
+    if options.explainfile:
+        capture_explain(conn, queries, options.explainfile)
+    if options.skew:
+        run_skew(conn, workload['skew'], options.skewthreshold, outfile)
+    if options.scalefactor:
+        conn.close()
+        if not options.keep:
+            drop_generated(dbURL, workload['generate'], options.schema)
+    else:
+        run_steps(conn, workload['teardown'], outfile)
+        conn.close()
     return
     
 def main():
@@ -207,13 +595,22 @@ def main():
         outfile = open(options.logfile, 'w')
     else:
         outfile = sys.stdout
+    if options.explaindiff:
+        diff_explain(options.explaindiff[0], options.explaindiff[1], outfile)
+        if options.logfile:
+            outfile.close()
+        return
     dbURL = dbconn.DbURL(hostname = '127.0.0.1',
                          port     = 5432,
                          dbname   = options.database,
                          username = options.username,
                          password = options.password)
-    nrows = options.nrows
-    run_test(dbURL, nrows, outfile)
+    workload = load_workload(options.workload, options.nrows, options.tags)
+    if options.scalefactor and len(workload['generate']) == 0:
+        raise_err('Workload file %s has no "generate" phase required for scale factor (-s)' % options.workload)
+    if options.skew and len(workload['skew']) == 0:
+        raise_err('Workload file %s has no "skew" phase required for skew mode (--skew)' % options.workload)
+    run_test(dbURL, workload, outfile, options)
     if options.logfile:
         outfile.close()
     return
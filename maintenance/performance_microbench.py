@@ -0,0 +1,394 @@
+import datetime as dt
+import sys
+try:
+    from gppylib.db import dbconn
+    from pygresql.pg import DatabaseError
+    from optparse import Option, OptionParser
+    from gppylib.gpparseopts import OptParser, OptChecker
+except ImportError, e:
+    sys.exit('Cannot import modules. Please check that you have sourced greenplum_path.sh.  Detail: ' + str(e))
+
+BENCHMARKS = ['scan', 'write', 'redistribute', 'broadcast', 'gather']
+
+def raise_err(message):
+    print 'ERROR: %s' % message
+    sys.exit(1)
+
+def parseargs():
+    parser = OptParser(option_class=OptChecker)
+    parser.remove_option('-h')
+    parser.add_option('-h', '-?', '--help', action='store_true')
+    parser.add_option('-d', '--database',   type='string')
+    parser.add_option('-u', '--username',   type='string')
+    parser.add_option('-p', '--password',   type='string')
+    parser.add_option('-l', '--logfile',    type='string')
+    parser.add_option('-r', '--segrows',    type='int')
+    parser.add_option('-w', '--widths',     type='string')
+    parser.add_option('-c', '--compress',   type='string')
+    parser.add_option('-b', '--benchmarks', type='string')
+    (options, args) = parser.parse_args()
+    if options.help:
+        print """
+Script executes micro-benchmarks of the separate subsystems of the cluster and
+reports throughput in MB/s for each primary segment, so the slowest host or
+interconnect link stands out
+Usage:
+python performance_microbench.py -d database_name
+                                 [-u username -p password]
+                                 [-l logfile]
+                                 [-r rows_per_segment]
+                                 [-w width1,width2,...]
+                                 [-c compression1,compression2,...]
+                                 [-b benchmark1,benchmark2,...]
+    -d | --database   - name of the database to run the test
+    -u | --username   - name of the user to be used for testing (default is $PGUSER)
+    -p | --password   - password of the user used for testing   (default is $PGPASSWORD)
+    -l | --logfile    - benchmark output file (default is stdout)
+    -r | --segrows    - number of rows generated for each segment (default is 1000000)
+    -w | --widths     - payload widths in bytes for Motion benchmarks (default is 64,256,1024)
+    -c | --compress   - AO compression types for write benchmark, with optional
+                        level after the colon (default is none,quicklz,zlib:1,zlib:5)
+    -b | --benchmarks - benchmarks to run (default is all of them):
+                        scan         - sequential scan of the segment-local data
+                        write        - append-only write with each compression type
+                        redistribute - Redistribute Motion for each payload width
+                        broadcast    - Broadcast Motion for each payload width
+                        gather       - Gather Motion for each payload width
+Each segment stamps its rows with clock_timestamp() while processing them, the
+time between the first and the last stamp of the segment is its elapsed time.
+Motion benchmarks are timed on the sending side, where interconnect flow control
+holds the sender back to the speed of the receivers. The legacy planner is used
+for Motion benchmarks, a benchmark is reported as skipped if the plan does not
+contain the expected Motion. The scan benchmark reads from the OS cache unless
+the segment data is larger than the memory of the segment host.
+"""
+        sys.exit(0)
+    if not options.database:
+        raise_err('You must specify database name (-d)')
+    if (options.password and not options.username) or (not options.password and options.username):
+        raise_err('You should either specify both username and password or not specify them both')
+    if not options.segrows:
+        options.segrows = 1000000
+    if not options.widths:
+        options.widths = '64,256,1024'
+    try:
+        options.widths = [int(x) for x in options.widths.split(',')]
+    except ValueError:
+        raise_err('Payload widths should be a comma-separated list of integers')
+    if min(options.widths) <= 0:
+        raise_err('Payload widths should be positive')
+    if not options.compress:
+        options.compress = 'none,quicklz,zlib:1,zlib:5'
+    options.compress = options.compress.split(',')
+    if options.benchmarks:
+        options.benchmarks = options.benchmarks.split(',')
+        badbench = set(options.benchmarks) - set(BENCHMARKS)
+        if len(badbench) > 0:
+            raise_err('Unknown benchmarks: %s' % ', '.join(badbench))
+    else:
+        options.benchmarks = BENCHMARKS
+    return options
+
+def execute(conn, query):
+    try:
+        curs = dbconn.execSQL(conn, query)
+        if query.lower().strip()[:6] in ('select', 'explai'):
+            return curs.fetchall()
+        return []
+    except DatabaseError, ex:
+        print 'Failed to execute the statement on the database. Please, check log file for errors.'
+        print ex
+        sys.exit(3)
+
+def execute_for_timing(conn, query):
+    n1 = dt.datetime.now()
+    rows = execute(conn, query)
+    n2 = dt.datetime.now()
+    return rows, ((n2-n1).seconds*1e6 + (n2-n1).microseconds) / 1e6
+
+class MicroBenchmark:
+    conn       = None
+    outfile    = None
+    segrows    = 0
+    maxwidth   = 0
+    nsegments  = 0
+    hosts      = dict()
+    has_orca   = False
+    benchmarks = []
+
+    def __init__(self, conn, outfile, segrows, widths):
+        self.conn       = conn
+        self.outfile    = outfile
+        self.segrows    = segrows
+        self.maxwidth   = max(widths)
+        self.hosts      = dict()
+        self.benchmarks = []
+        return
+
+    def get_segments(self):
+        rows = execute(self.conn, """
+            select content, hostname
+                from gp_segment_configuration
+                where role = 'p'
+                    and content >= 0""")
+        for row in rows:
+            self.hosts[int(row[0])] = row[1]
+        self.nsegments = len(self.hosts)
+        rows = execute(self.conn, "select count(*) from pg_settings where name = 'optimizer'")
+        self.has_orca = int(rows[0][0]) > 0
+        return
+
+    def prepare(self):
+        nrows = self.segrows * self.nsegments
+        # Payload of the maximal width, the benchmarks cut it with substr()
+        payload = "repeat(md5(id::varchar), %d)" % (self.maxwidth / 32 + 1)
+        execute(self.conn, 'drop table if exists perf_microbench_src')
+        execute(self.conn, 'drop table if exists perf_microbench_keys')
+        execute(self.conn, 'drop table if exists perf_microbench_wide')
+        _, t = execute_for_timing(self.conn, """
+            create table perf_microbench_src
+                    with (appendonly=true)
+                    as
+                select  id,
+                        (id * 7919) %% %d + 1 as rkey,
+                        substr(%s, 1, %d) as payload
+                    from generate_series(1, %d) as id
+                distributed by (id)""" % (nrows, payload, self.maxwidth, nrows))
+        self.outfile.write('Preparation|source table with %d rows|%f\n' % (nrows, t))
+        _, t = execute_for_timing(self.conn, """
+            create table perf_microbench_keys
+                    with (appendonly=true)
+                    as
+                select id as rkey
+                    from generate_series(1, %d) as id
+                distributed by (rkey)""" % nrows)
+        self.outfile.write('Preparation|key table with %d rows|%f\n' % (nrows, t))
+        if 'broadcast' in self.benchmarks:
+            # Wider than the source, so the planner prefers to broadcast the source
+            _, t = execute_for_timing(self.conn, """
+                create table perf_microbench_wide
+                        with (appendonly=true, compresstype=zlib, compresslevel=1)
+                        as
+                    select id as rkey, repeat('x', %d) as filler
+                        from generate_series(1, %d) as id
+                    distributed randomly""" % (self.maxwidth + 64, nrows))
+            self.outfile.write('Preparation|wide table with %d rows|%f\n' % (nrows, t))
+        execute(self.conn, 'analyze perf_microbench_src')
+        execute(self.conn, 'analyze perf_microbench_keys')
+        if 'broadcast' in self.benchmarks:
+            execute(self.conn, 'analyze perf_microbench_wide')
+        self.conn.commit()
+        return
+
+    def cleanup(self):
+        execute(self.conn, 'drop table if exists perf_microbench_src')
+        execute(self.conn, 'drop table if exists perf_microbench_keys')
+        execute(self.conn, 'drop table if exists perf_microbench_wide')
+        self.conn.commit()
+        return
+
+    def relation_sizes(self, table):
+        rows = execute(self.conn, """
+            select gp_segment_id, pg_relation_size('%s')
+                from gp_dist_random('gp_id')""" % table)
+        return dict([(int(r[0]), int(r[1])) for r in rows])
+
+    def report(self, benchmark, variant, stats, query_time, fanout=1):
+        # stats is a list of (segment, bytes, seconds)
+        rates = []
+        for seg, nbytes, seconds in sorted(stats):
+            mb   = float(nbytes) * fanout / 1048576.
+            rate = mb / max(float(seconds), 1e-6)
+            rates.append((rate, seg))
+            self.outfile.write('%s|%s|%d|%s|%f|%f|%f\n' % (benchmark, variant, seg, self.hosts.get(seg, ''), mb, seconds, rate))
+        if len(rates) == 0:
+            return
+        host_rates = dict()
+        for rate, seg in rates:
+            host_rates.setdefault(self.hosts.get(seg, ''), []).append(rate)
+        slowest_host = min(host_rates.keys(), key=lambda h: sum(host_rates[h]) / len(host_rates[h]))
+        min_rate, min_seg = min(rates)
+        self.outfile.write('Summary|%s|%s|%f|%f|%f|%d|%s|%s|%f\n' % (
+                benchmark, variant,
+                min_rate, sum([r[0] for r in rates]) / len(rates), max(rates)[0],
+                min_seg, self.hosts.get(min_seg, ''), slowest_host, query_time))
+        return
+
+    def segment_stats(self, query):
+        rows, t = execute_for_timing(self.conn, query)
+        return [ (int(r[0]), int(r[1]), float(r[2])) for r in rows ], t
+
+    def plan_has(self, query, motion):
+        plan = execute(self.conn, 'explain ' + query)
+        return len([r for r in plan if motion in r[0]]) > 0
+
+    def run_scan(self):
+        sizes = self.relation_sizes('perf_microbench_src')
+        stats, t = self.segment_stats("""
+            select  gp_segment_id,
+                    sum(len),
+                    extract(epoch from max(ts) - min(ts))
+                from (
+                    select gp_segment_id, length(payload) as len, clock_timestamp() as ts
+                        from perf_microbench_src
+                    ) as q
+                group by gp_segment_id""")
+        self.report('Sequential scan', 'on-disk', [ (seg, sizes.get(seg, 0), sec) for seg, _, sec in stats ], t)
+        return
+
+    def run_write(self, compress):
+        for comp in compress:
+            if comp == 'none':
+                storage = 'appendonly=true'
+            elif ':' in comp:
+                ctype, clevel = comp.split(':')
+                storage = 'appendonly=true, compresstype=%s, compresslevel=%s' % (ctype, clevel)
+            else:
+                storage = 'appendonly=true, compresstype=%s' % comp
+            execute(self.conn, 'drop table if exists perf_microbench_write')
+            # Co-located insert, the rows do not leave the segment
+            _, t = execute_for_timing(self.conn, """
+                create table perf_microbench_write
+                        with (%s)
+                        as
+                    select id, payload, clock_timestamp() as ts
+                        from perf_microbench_src
+                    distributed by (id)""" % storage)
+            stats, _ = self.segment_stats("""
+                select  gp_segment_id,
+                        sum(length(payload)),
+                        extract(epoch from max(ts) - min(ts))
+                    from perf_microbench_write
+                    group by gp_segment_id""")
+            sizes = self.relation_sizes('perf_microbench_write')
+            self.report('AO write', comp + ' raw', stats, t)
+            self.report('AO write', comp + ' on-disk', [ (seg, sizes.get(seg, 0), sec) for seg, _, sec in stats ], t)
+            execute(self.conn, 'drop table perf_microbench_write')
+            self.conn.commit()
+        return
+
+    def set_planner(self, segments_for_planner):
+        if self.has_orca:
+            execute(self.conn, 'set optimizer = off')
+        execute(self.conn, 'set gp_segments_for_planner = %d' % segments_for_planner)
+        return
+
+    def reset_planner(self):
+        if self.has_orca:
+            execute(self.conn, 'reset optimizer')
+        execute(self.conn, 'reset gp_segments_for_planner')
+        return
+
+    def run_motion(self, benchmark, motion, widths, query, fanout, segments_for_planner):
+        if segments_for_planner is not None:
+            self.set_planner(segments_for_planner)
+        for width in widths:
+            q = query % width
+            if not self.plan_has(q, motion):
+                self.outfile.write('Summary|%s|%d bytes|skipped, the plan has no %s\n' % (benchmark, width, motion))
+                continue
+            stats, t = self.segment_stats(q)
+            self.report(benchmark, '%d bytes' % width, stats, t, fanout)
+        if segments_for_planner is not None:
+            self.reset_planner()
+        return
+
+    def run_redistribute(self, widths):
+        # Planner redistributes the source to the key table distribution, as
+        # broadcasting the key table looks expensive with many segments
+        query = """
+            select  src_seg,
+                    sum(length(payload)),
+                    extract(epoch from max(ts) - min(ts))
+                from (
+                    select  gp_segment_id as src_seg,
+                            clock_timestamp() as ts,
+                            rkey,
+                            substr(payload, 1, %d) as payload
+                        from perf_microbench_src
+                    ) as s
+                    inner join perf_microbench_keys as k
+                    on s.rkey = k.rkey
+                group by src_seg"""
+        self.run_motion('Redistribute Motion', 'Redistribute Motion', widths, query, 1, 1000000)
+        return
+
+    def run_broadcast(self, widths):
+        # The wide table is randomly distributed and larger than the source,
+        # so the planner broadcasts the source to every segment
+        query = """
+            select  src_seg,
+                    sum(length(payload)),
+                    extract(epoch from max(ts) - min(ts))
+                from (
+                    select  gp_segment_id as src_seg,
+                            clock_timestamp() as ts,
+                            rkey,
+                            substr(payload, 1, %d) as payload
+                        from perf_microbench_src
+                    ) as s
+                    inner join perf_microbench_wide as w
+                    on s.rkey = w.rkey
+                where length(w.filler) > 0
+                group by src_seg"""
+        self.run_motion('Broadcast Motion', 'Broadcast Motion', widths, query, self.nsegments, 1)
+        return
+
+    def run_gather(self, widths):
+        # The limit has to be applied on master, so all the rows are gathered
+        query = """
+            select  src_seg,
+                    sum(length(payload)),
+                    extract(epoch from max(ts) - min(ts))
+                from (
+                    select  gp_segment_id as src_seg,
+                            clock_timestamp() as ts,
+                            substr(payload, 1, %d) as payload
+                        from perf_microbench_src
+                        limit 9223372036854775807
+                    ) as q
+                group by src_seg"""
+        self.run_motion('Gather Motion', 'Gather Motion', widths, query, 1, None)
+        return
+
+    def run(self, benchmarks, widths, compress):
+        self.benchmarks = benchmarks
+        self.get_segments()
+        if self.nsegments == 0:
+            raise_err('No primary segments found in gp_segment_configuration')
+        self.prepare()
+        self.outfile.write('Benchmark|Variant|Segment|Host|MB|Seconds|MB/s\n')
+        self.outfile.write('Summary|Benchmark|Variant|Min MB/s|Avg MB/s|Max MB/s|Slowest segment|Slowest segment host|Slowest host|Query seconds\n')
+        if 'scan' in benchmarks:
+            self.run_scan()
+        if 'write' in benchmarks:
+            self.run_write(compress)
+        if 'redistribute' in benchmarks:
+            self.run_redistribute(widths)
+        if 'broadcast' in benchmarks:
+            self.run_broadcast(widths)
+        if 'gather' in benchmarks:
+            self.run_gather(widths)
+        self.cleanup()
+        return
+
+def main():
+    options = parseargs()
+    if options.logfile:
+        outfile = open(options.logfile, 'w')
+    else:
+        outfile = sys.stdout
+    dbURL = dbconn.DbURL(hostname = '127.0.0.1',
+                         port     = 5432,
+                         dbname   = options.database,
+                         username = options.username,
+                         password = options.password)
+    conn = dbconn.connect(dbURL)
+    mb = MicroBenchmark(conn, outfile, options.segrows, options.widths)
+    mb.run(options.benchmarks, options.widths, options.compress)
+    conn.close()
+    if options.logfile:
+        outfile.close()
+    return
+
+main()
@@ -2,31 +2,85 @@ import datetime as dt
 import time
 import sys
 import random
-from multiprocessing import Process
+import hashlib
+import itertools
+from multiprocessing import Process, Queue as ProcessQueue, Value, Event
+import Queue
 import subprocess
 import os
+import re
 import json
+import socket
+import threading
+import stresstest_histogram
+import stresstest_telemetry
+try:
+    from pygresql import pg
+except ImportError, e:
+    sys.exit('Cannot import modules. Please check that you have sourced greenplum_path.sh.  Detail: ' + str(e))
 
-def execute_for_timing(database, username, query=None, sqlfile=None):
+# Failed queries are classified by the SQLSTATE of the error, given by the
+# session executor as "SQLSTATE xxxxx" and by psql in verbose mode after the
+# severity, falling back to the text of the message for the errors without it
+ERROR_CATEGORIES    = ['oom', 'resource_queue', 'deadlock', 'timeout', 'cancel', 'connection', 'other']
+SQLSTATE            = re.compile(r'(?:SQLSTATE |(?:ERROR|FATAL|PANIC):\s+)([0-9A-Z]{5})\b')
+SQLSTATE_CATEGORIES = [ ('53200', 'oom'), ('40P01', 'deadlock'), ('57014', 'cancel'),
+                        ('08', 'connection'), ('57P', 'connection') ]
+MESSAGE_CATEGORIES  = [ ('out of memory', 'oom'), ('vmem', 'oom'), ('vm protect', 'oom'),
+                        ('deadlock', 'deadlock'), ('canceling', 'cancel'),
+                        ('could not connect', 'connection'), ('connection', 'connection'),
+                        ('terminating', 'connection') ]
+# Query still running this number of seconds after its statement timeout is
+# cancelled by the client
+CANCEL_GRACE = 5.0
+# Queries pre-generated for each worker in closed-loop mode, the worker starts
+# over from the first one when it runs all of them
+SCHEDULE_QUERIES = 10000
+
+def classify_error(message):
+    text = message.lower()
+    # Both checked before SQLSTATE as statement timeout is reported as a cancel
+    # (57014) and resource queue errors have general SQLSTATEs
+    if 'statement timeout' in text:
+        return 'timeout'
+    if 'resource queue' in text or 'resource group' in text:
+        return 'resource_queue'
+    m = SQLSTATE.search(message)
+    if m is not None:
+        for prefix, category in SQLSTATE_CATEGORIES:
+            if m.group(1).startswith(prefix):
+                return category
+    for pattern, category in MESSAGE_CATEGORIES:
+        if pattern in text:
+            return category
+    return 'other'
+
+def execute_for_timing(database, username, query=None, sqlfile=None, timeout=None):
     reserr = ''
     resval = 0.0
     if query is not None:
         command = query
     else:
         command = sqlfile
+    # Statement timeout is set for the psql session through PGOPTIONS
+    env = dict(os.environ)
+    if timeout:
+        env['PGOPTIONS'] = (env.get('PGOPTIONS', '') + ' -c statement_timeout=%d' % int(timeout * 1000)).strip()
     try:
         n1 = dt.datetime.now()
         if query is not None:
-            s = subprocess.Popen (""" psql -d %s -U %s -c "%s" """ % (database, username, query),
+            s = subprocess.Popen (""" psql -v VERBOSITY=verbose -d %s -U %s -c "%s" """ % (database, username, query),
                                   stdout=subprocess.PIPE,
                                   stderr=subprocess.PIPE,
-                                  shell=True)
+                                  shell=True,
+                                  env=env)
         else:
             DEVNULL = open(os.devnull, 'wb')
-            s = subprocess.Popen (""" psql -d %s -U %s -f %s """ % (database, username, sqlfile),
+            s = subprocess.Popen (""" psql -v VERBOSITY=verbose -d %s -U %s -f %s """ % (database, username, sqlfile),
                                   stdout=DEVNULL,
                                   stderr=subprocess.PIPE,
-                                  shell=True)
+                                  shell=True,
+                                  env=env)
         stdout, stderr = s.communicate()
         n2 = dt.datetime.now()
         resval = ((n2-n1).seconds*1e6 + (n2-n1).microseconds) / 1e6
@@ -38,69 +92,825 @@ def execute_for_timing(database, username, query=None, sqlfile=None):
         reserr += '%s\n' % str(ex)
     return resval, reserr
 
-def write_benchmark (thread_id, test_name, seconds, database, username, log_dir, sql_files):
-    random.seed()
-    fout = open('%s/%s_write_%d.csv' % (log_dir,test_name,thread_id), 'w')
-    ferr = open('%s/%s_write_%d.err' % (log_dir,test_name,thread_id), 'w')
-    n1 = dt.datetime.now()
-    while (dt.datetime.now() - n1).seconds < seconds:
-        ind = random.randint(0, len(sql_files)-1)
-        now = dt.datetime.now()
-        t, err = execute_for_timing(database, username, sqlfile=sql_files[ind])
+class Session:
+    database  = ''
+    username  = ''
+    timeout   = None
+    db        = None
+    sqlfiles  = dict()
+    cancelled = False
+
+    def __init__(self, database, username, timeout=None):
+        self.database  = database
+        self.username  = username
+        self.timeout   = timeout
+        self.db        = None
+        self.sqlfiles  = dict()
+        self.cancelled = False
+        return
+
+    # Same as execute_for_timing(), but the session is kept open between the
+    # queries and only the execution of the query is timed
+    def execute(self, query=None, sqlfile=None):
+        reserr = ''
+        resval = 0.0
+        if query is not None:
+            command = query
+        else:
+            command = sqlfile
+        try:
+            if query is None:
+                if not sqlfile in self.sqlfiles:
+                    self.sqlfiles[sqlfile] = open(sqlfile, 'r').read()
+                query = self.sqlfiles[sqlfile]
+            if self.db is None:
+                self.db = pg.DB(dbname=self.database, user=self.username)
+                if self.timeout:
+                    self.db.query('set statement_timeout = %d' % int(self.timeout * 1000))
+            # Server cancels the query after the statement timeout, the client
+            # cancels it too if it is still running after the grace period
+            timer = None
+            if self.timeout:
+                self.cancelled = False
+                timer = threading.Timer(self.timeout + CANCEL_GRACE, self.cancel)
+                timer.start()
+            try:
+                n1 = time.time()
+                res = self.db.query(query)
+                if hasattr(res, 'getresult'):
+                    res.getresult()
+                resval = time.time() - n1
+            finally:
+                if timer is not None:
+                    timer.cancel()
+        except Exception, ex:
+            reserr += 'Failed to execute "%s" on the database "%s"\n' % (command, self.database)
+            reserr += '%s\n' % str(ex)
+            if getattr(ex, 'sqlstate', None):
+                reserr += 'SQLSTATE %s\n' % ex.sqlstate
+            if self.cancelled:
+                reserr += 'Cancelled by the client %.0f seconds after the statement timeout\n' % CANCEL_GRACE
+            # Session might be broken or left in the failed transaction, so the
+            # next query opens a new one
+            self.close()
+        return resval, reserr
+
+    def cancel(self):
+        try:
+            self.db.cancel()
+            self.cancelled = True
+        except Exception:
+            pass
+        return
+
+    def close(self):
+        if self.db is not None:
+            try:
+                self.db.close()
+            except Exception:
+                pass
+            self.db = None
+        return
+
+def open_session(executor, database, username, timeout=None):
+    if executor == 'session':
+        return Session(database, username, timeout)
+    return None
+
+def timed_query(session, database, username, query=None, sqlfile=None, timeout=None):
+    if session is not None:
+        return session.execute(query=query, sqlfile=sqlfile)
+    return execute_for_timing(database, username, query=query, sqlfile=sqlfile, timeout=timeout)
+
+def error_policy(section, qclass):
+    # Statement timeout of the class ("timeouts") or of the whole section
+    # ("timeout_seconds"), and the retries of the queries failed with the
+    # errors of "retry_errors" categories, waiting "retry_backoff_seconds"
+    # before the first retry and twice as long before each next one
+    return { 'timeout'      : section.get('timeouts', dict()).get(qclass, section.get('timeout_seconds')),
+             'retries'      : int(section.get('retries', 0)),
+             'retry_errors' : section.get('retry_errors', ['deadlock', 'resource_queue', 'connection']),
+             'backoff'      : float(section.get('retry_backoff_seconds', 1.0)) }
+
+def check_policy(section):
+    timeouts = section.get('timeouts', dict()).values() + [ section.get('timeout_seconds', 1) ]
+    if min(timeouts) <= 0:
+        return 'statement timeouts should be positive'
+    if section.get('retries', 0) < 0 or section.get('retry_backoff_seconds', 0) < 0:
+        return '"retries" and "retry_backoff_seconds" should not be negative'
+    for category in section.get('retry_errors', []):
+        if not category in ERROR_CATEGORIES:
+            return 'unknown error category "%s" in "retry_errors", use %s' % (category, ', '.join(ERROR_CATEGORIES))
+    return None
+
+class OpenLoop:
+    level     = None
+    arrivals  = 'poisson'
+    max_lag   = 0.0
+    late_lag  = 0.0
+    next_time = 0.0
+    scheduled = 0
+    late      = 0
+    dropped   = 0
+    was_late  = False
+
+    def __init__(self, openloop, level):
+        self.level     = level
+        self.arrivals  = openloop['arrivals']
+        self.max_lag   = openloop['max_lag']
+        self.late_lag  = openloop['late']
+        self.scheduled = 0
+        self.late      = 0
+        self.dropped   = 0
+        self.was_late  = False
+        # Random phase keeps the threads with fixed arrivals from firing together
+        self.next_time = time.time()
+        if self.rate() > 0:
+            self.next_time += random.uniform(0, 1.0 / self.rate())
+        return
+
+    # Returns the intended start time of the next arrival, or None while the
+    # arrival rate is zero
+    def arrival(self):
+        if self.rate() <= 0:
+            self.next_time = time.time()
+            return None
+        intended = self.next_time
+        self.next_time += self.gap()
+        return intended
+
+    # Arrival rate of the class at the current load level is split evenly
+    # between the threads of the class running at this level
+    def rate(self):
+        return self.level['class_rate'].value / max(self.level['class_threads'].value, 1)
+
+    def gap(self):
+        if self.arrivals == 'poisson':
+            return random.expovariate(self.rate())
+        return 1.0 / self.rate()
+
+    # Returns the intended start time of the next query, waiting for it if it
+    # is in the future, or None when the test is over or the thread is retired.
+    # Queries lagging behind their intended start by more than max_lag are
+    # dropped, no queries are scheduled while the arrival rate is zero
+    def wait(self, deadline, stop):
+        while True:
+            if stop.is_set():
+                return None
+            intended = self.arrival()
+            if intended is None:
+                if time.time() >= deadline:
+                    return None
+                time.sleep(0.1)
+                continue
+            if intended >= deadline:
+                return None
+            self.scheduled += 1
+            self.was_late   = False
+            now = time.time()
+            if now < intended:
+                time.sleep(intended - now)
+                return intended
+            if now - intended > self.max_lag:
+                self.dropped += 1
+                continue
+            if now - intended > self.late_lag:
+                self.late += 1
+                self.was_late = True
+            return intended
+
+    def write_report(self, filename):
+        f = open(filename, 'w')
+        f.write('%d|%d|%d\n' % (self.scheduled, self.late, self.dropped))
+        f.close()
+        return
+
+class ReplayLoop(OpenLoop):
+    entries = []
+    position = 0
+    start   = 0.0
+    qid     = None
+
+    # Replays the arrivals of the schedule generated by --generate, entries are
+    # the (offset, qid) of the slot of the worker with the offsets from the
+    # start of the test. Entries before the second the worker was started at
+    # belong to the worker retired earlier from the same slot and are skipped,
+    # once all the entries are replayed the worker idles till the deadline
+    def __init__(self, openloop, level, entries):
+        OpenLoop.__init__(self, openloop, level)
+        self.start    = level['start']
+        self.entries  = entries
+        self.position = 0
+        begin = int(time.time() - self.start)
+        while self.position < len(entries) and entries[self.position][0] < begin:
+            self.position += 1
+        return
+
+    def arrival(self):
+        if self.position >= len(self.entries):
+            return None
+        offset, self.qid = self.entries[self.position]
+        self.position += 1
+        return self.start + offset
+
+def open_loop(openloop, level, entries):
+    if entries:
+        return ReplayLoop(openloop, level, entries)
+    return OpenLoop(openloop, level)
+
+def open_loop_config(section):
+    # Open-loop mode is used when the arrival rate of the queries is set, either
+    # for the section or in its load schedule
+    rates = [ section.get('arrival_rate') or 0 ]
+    for segment in section.get('schedule', []):
+        rates += [ segment.get('arrival_rate', 0), segment.get('arrival_rate_to', 0) ]
+    if max(rates) <= 0:
+        return None
+    return { 'arrivals' : section.get('arrivals', 'poisson'),
+             'max_lag'  : float(section.get('max_lag_seconds', 10.0)),
+             'late'     : float(section.get('late_threshold_seconds', 0.1)) }
+
+class LoadSchedule:
+    segments = []
+    last     = (0, 0.0)
+
+    # Load schedule of the readers or writers is the list of segments like
+    #   {"seconds": 60, "threads": 5, "threads_to": 50, "arrival_rate": 10, "arrival_rate_to": 100}
+    # The number of threads and the arrival rate change linearly from the start
+    # value to the "_to" value within the segment (ramp), without the "_to"
+    # value they stay the same (step). Omitted start values continue from the end
+    # of the previous segment, "test_threads_number" and "arrival_rate" of the
+    # section are used before the first segment, and the last values are kept
+    # till the end of the test
+    def __init__(self, section):
+        threads = section.get('test_threads_number') or 0
+        rate    = float(section.get('arrival_rate') or 0)
+        self.segments = []
+        start = 0.0
+        for segment in section.get('schedule', []):
+            t0 = segment.get('threads', threads)
+            r0 = float(segment.get('arrival_rate', rate))
+            threads = segment.get('threads_to', t0)
+            rate    = float(segment.get('arrival_rate_to', r0))
+            self.segments.append((start, float(segment['seconds']), t0, threads, r0, rate))
+            start += segment['seconds']
+        self.last = (threads, rate)
+        return
+
+    # Returns the number of threads and the arrival rate at the given second
+    # of the test
+    def level(self, elapsed):
+        for start, seconds, t0, t1, r0, r1 in self.segments:
+            if elapsed < start + seconds:
+                share = (elapsed - start) / seconds
+                return int(round(t0 + (t1 - t0) * share)), round(r0 + (r1 - r0) * share, 3)
+        return self.last
+
+    def max_threads(self):
+        return max([ max(s[2], s[3]) for s in self.segments ] + [ self.last[0] ])
+
+def check_schedule(section):
+    for segment in section.get('schedule', []):
+        if segment.get('seconds', 0) <= 0:
+            return 'segment %s should have positive "seconds"' % json.dumps(segment)
+        for key in ('threads', 'threads_to', 'arrival_rate', 'arrival_rate_to'):
+            if segment.get(key, 0) < 0:
+                return 'segment %s should have non-negative "%s"' % (json.dumps(segment), key)
+    return None
+
+def check_mix(section):
+    weights = section.get('weights', dict())
+    for name, weight in weights.iteritems():
+        if weight <= 0:
+            return 'weight of "%s" should be positive' % name
+    for name, quota in section.get('concurrency', dict()).iteritems():
+        if not name in weights:
+            return 'concurrency quota of "%s" is given without its weight' % name
+        if quota <= 0:
+            return 'concurrency quota of "%s" should be positive' % name
+    return None
+
+def split_threads(threads, classes):
+    # Splits the threads between the classes (name, weight, quota) in proportion
+    # to their weights. Each class gets a thread first, the heaviest first, so
+    # all the classes run when there are enough threads, then each next thread
+    # goes to the class furthest below its share. Class never gets more threads
+    # than its quota (None is no limit)
+    counts = dict([ (c[0], 0) for c in classes ])
+    for c in sorted(classes, key=lambda c: -c[1])[:threads]:
+        counts[c[0]] = 1
+    for i in range(threads - sum(counts.values())):
+        free = [ c for c in classes if c[2] is None or counts[c[0]] < c[2] ]
+        if len(free) == 0:
+            break
+        counts[min(free, key=lambda c: (counts[c[0]] + 0.5) / c[1])[0]] += 1
+    return counts
+
+def drive_workers(prefix, schedule, seconds, classes, start_worker):
+    # Follows the load schedule for the given seconds, checking it every second.
+    # Threads and arrival rate of the schedule are split between the classes
+    # (name, weight, quota) running at the same time by their weights. Workers
+    # are started by start_worker(qclass, thread_id, slot, seconds, level, stop)
+    # and the latest started ones of the class are retired first by setting
+    # their stop event, slot is the position of the worker among the running
+    # workers of the class. Load level of the test ("threads", "rate") and of
+    # the class ("class_threads", "class_rate") and the start of the test
+    # ("start") are shared with the workers through level. Returns the number
+    # of the workers started per class
+    total   = { 'threads' : Value('i', 0), 'rate' : Value('d', 0.0) }
+    weights = float(sum([ c[1] for c in classes ]))
+    levels  = dict()
+    running = dict()
+    started = dict()
+    start   = time.time()
+    for name, weight, quota in classes:
+        levels[name]  = dict(total, class_threads=Value('i', 0), class_rate=Value('d', 0.0), start=start)
+        running[name] = []
+        started[name] = 0
+    current = None
+    while True:
+        elapsed = time.time() - start
+        if elapsed >= seconds:
+            break
+        threads, rate = schedule.level(elapsed)
+        counts = split_threads(threads, classes)
+        total['threads'].value = threads
+        total['rate'].value    = rate
+        for name, weight, quota in classes:
+            levels[name]['class_threads'].value = counts[name]
+            levels[name]['class_rate'].value    = rate * weight / weights
+        if (threads, rate) != current:
+            split = ''
+            if len(classes) > 1:
+                split = ' (%s)' % ', '.join([ '%s %d' % (c[0], counts[c[0]]) for c in classes ])
+            if rate > 0:
+                print '%s: load level %d threads%s, %.3f queries per second' % (prefix, threads, split, rate)
+            else:
+                print '%s: load level %d threads%s' % (prefix, threads, split)
+            current = (threads, rate)
+        for name, weight, quota in classes:
+            for p, stop in running[name][:]:
+                if not p.is_alive():
+                    p.join()
+                    running[name].remove((p, stop))
+            active = [ (p, stop) for p, stop in running[name] if not stop.is_set() ]
+            for i in range(counts[name] - len(active)):
+                stop = Event()
+                running[name].append((start_worker(name, started[name], len(active) + i, seconds - elapsed, levels[name], stop), stop))
+                started[name] += 1
+            for p, stop in active[counts[name]:]:
+                stop.set()
+        time.sleep(min(1.0, seconds - elapsed))
+    for name in running:
+        for p, stop in running[name]:
+            p.join()
+    return started
+
+def schedule_report(prefix, filenames):
+    scheduled, late, dropped = 0, 0, 0
+    for filename in filenames:
+        try:
+            f = open(filename, 'r')
+            s, l, d = f.read().strip().split('|')
+            f.close()
+        except Exception, ex:
+            print '%s: WARNING: cannot read the schedule report %s: %s' % (prefix, filename, str(ex))
+            continue
+        scheduled += int(s)
+        late      += int(l)
+        dropped   += int(d)
+    print '%s: %d queries scheduled, %d started late, %d dropped' % (prefix, scheduled, late, dropped)
+    return
+
+# With "seed" in the config every worker seeds its random generator from the
+# seed, the test, the class and the slot of the worker, so the runs of the same
+# config choose the same queries at the same intended times
+def worker_seed(seed, test_name, qclass, slot):
+    if seed is None:
+        return None
+    return int(hashlib.md5('%s|%s|%s|%d' % (seed, test_name, qclass, slot)).hexdigest()[:8], 16)
+
+def plan_workers(rng, schedule, seconds, classes, qids, openloop):
+    # Pre-generates the queries of the workers started by drive_workers() for
+    # the classes (name, weight, quota), qids are the query ids of each class.
+    # Returns the (offset, qid) entries per class and slot. In open-loop mode
+    # the arrivals of the class follow its share of the arrival rate at each
+    # second of the schedule and go to the slots running at that second in
+    # turn, in closed-loop mode each slot gets SCHEDULE_QUERIES queries with
+    # no offsets
+    weights = float(sum([ c[1] for c in classes ]))
+    plan    = dict()
+    for name, weight, quota in classes:
+        slots = dict()
+        if openloop is None:
+            n_slots = max([ split_threads(schedule.level(t)[0], classes)[name] for t in range(int(seconds) + 1) ])
+            for slot in range(n_slots):
+                slots[slot] = [ (None, rng.choice(qids[name])) for i in range(SCHEDULE_QUERIES) ]
+        else:
+            t, n = 0.0, 0
+            while t < seconds:
+                threads, rate = schedule.level(int(t))
+                threads = split_threads(threads, classes)[name]
+                rate    = rate * weight / weights
+                if threads == 0 or rate <= 0:
+                    t = int(t) + 1.0
+                    continue
+                if openloop['arrivals'] == 'poisson':
+                    t += rng.expovariate(rate)
+                else:
+                    t += 1.0 / rate
+                if t >= seconds:
+                    break
+                slot = n % threads
+                if not slot in slots:
+                    slots[slot] = []
+                slots[slot].append((t, rng.choice(qids[name])))
+                n += 1
+        plan[name] = slots
+    return plan
+
+def generate_schedule(config, filename):
+    # Writes the queries of all the workers of all the tests to the schedule
+    # file, one line per query:
+    #   test|class|slot|offset|qid
+    # where offset is the intended start in seconds from the start of the test
+    # (empty in closed-loop mode) and qid is the query id of the readers or the
+    # SQL file name of the writers
+    out = open(filename, 'w')
+    for test in config['tests']:
+        test_name = test['test_name']
+        for section_name in ('readers', 'writers'):
+            section = test.get(section_name)
+            if section is None:
+                continue
+            schedule = LoadSchedule(section)
+            openloop = open_loop_config(section)
+            if section_name == 'readers':
+                queries = read_queries(section['stresstest_sqls_file'])
+                runs, seconds = reader_runs(section, test['test_runtime_seconds'])
+                qids = dict([ (t, sorted(queries.get(t, dict()).keys())) for t, w, q in sum(runs, []) ])
+            else:
+                runs, seconds = [ [ ('write', 1, None) ] ], test['test_runtime_seconds']
+                qids = { 'write' : [ os.path.basename(f) for f in writer_files(section['sql_files_directory']) ] }
+            for qclass in qids:
+                if len(qids[qclass]) == 0:
+                    print 'WARNING: no queries of the %s of the test "%s" type "%s", nothing to generate' % (section_name, test_name, qclass)
+            for classes in runs:
+                classes = [ c for c in classes if len(qids[c[0]]) > 0 ]
+                if len(classes) == 0:
+                    continue
+                rng  = random.Random(worker_seed(config.get('seed'), test_name, ','.join([ c[0] for c in classes ]), 0))
+                plan = plan_workers(rng, schedule, seconds, classes, qids, openloop)
+                for qclass in sorted(plan.keys()):
+                    for slot in sorted(plan[qclass].keys()):
+                        for offset, qid in plan[qclass][slot]:
+                            out.write('%s|%s|%d|%s|%s\n' % (test_name, qclass, slot, '' if offset is None else '%.6f' % offset, qid))
+                    print 'test "%s" %s type "%s": %d queries for %d workers' % (test_name, section_name, qclass,
+                          sum([ len(e) for e in plan[qclass].values() ]), len(plan[qclass]))
+    out.close()
+    return
+
+def load_schedule(filename):
+    # Returns the entries of the schedule file per (test, class) and slot
+    schedule = dict()
+    f = open(filename, 'r')
+    for line in f:
+        test_name, qclass, slot, offset, qid = line.rstrip('\r\n').split('|')
+        key = (test_name, qclass)
+        if not key in schedule:
+            schedule[key] = dict()
+        if not int(slot) in schedule[key]:
+            schedule[key][int(slot)] = []
+        if offset == '':
+            schedule[key][int(slot)].append((None, qid))
+        else:
+            schedule[key][int(slot)].append((float(offset), qid))
+    f.close()
+    return schedule
+
+def replay_plan(filename, test_name, qids, openloop):
+    # Returns the entries of the test per class and slot from the schedule file
+    # and None, or None and the description of the problem. Workers in the
+    # slots missing from the schedule choose random queries
+    try:
+        schedule = load_schedule(filename)
+    except Exception, ex:
+        return None, 'cannot read the schedule file %s: %s' % (filename, str(ex))
+    plan = dict()
+    for qclass in qids:
+        plan[qclass] = schedule.get((test_name, qclass), dict())
+        if len(plan[qclass]) == 0:
+            return None, 'schedule file %s has no queries of the test "%s" type "%s"' % (filename, test_name, qclass)
+        for slot, entries in plan[qclass].iteritems():
+            for offset, qid in entries:
+                if not qid in qids[qclass]:
+                    return None, 'query "%s" of the schedule file %s is not in the test "%s" type "%s"' % (qid, filename, test_name, qclass)
+                if (offset is None) != (openloop is None):
+                    return None, 'schedule file %s was generated for the %s mode' % (filename, 'closed-loop' if offset is None else 'open-loop')
+    return plan, None
+
+def query_picker(qids, sched, entries):
+    # Returns the function choosing the next query: the one of the replayed
+    # arrival in open-loop mode, the next one of the replayed sequence in
+    # closed-loop mode or a random one without the schedule
+    if entries and sched is not None:
+        return lambda: sched.qid
+    if entries:
+        return itertools.cycle([ qid for offset, qid in entries ]).next
+    return lambda: qids[random.randint(0, len(qids)-1)]
+
+# In open-loop mode the time is the intended start of the query and the
+# latency is measured from it, the execution time of the query is added
+# as the last field
+def result_fields(intended, start, t):
+    if intended is None:
+        return dt.datetime.fromtimestamp(start).strftime('%Y-%m-%d %H:%M:%S'), t, ''
+    return dt.datetime.fromtimestamp(intended).strftime('%Y-%m-%d %H:%M:%S'), start - intended + t, '|%f' % t
+
+def next_query(sched, deadline, stop):
+    # Returns False when the test is over or the thread is retired, otherwise
+    # the intended start time of the next query in open-loop mode (None in
+    # closed-loop mode)
+    if sched is None:
+        if time.time() >= deadline or stop.is_set():
+            return False
+        return None
+    intended = sched.wait(deadline, stop)
+    if intended is None:
+        return False
+    return intended
+
+class Recorder:
+    queue     = None
+    snapshot  = 10
+    test_name = ''
+    qclass    = ''
+    level     = None
+    intervals = dict()
+    current   = 0
+
+    # Latencies of one thread are aggregated into the histograms of the current
+    # snapshot interval, which are sent to the collector once the interval is
+    # over, so the memory of the thread does not grow with the test duration.
+    # Histograms are kept per query and load level (threads and arrival rate)
+    def __init__(self, results, test_name, qclass, level):
+        self.queue     = results['queue']
+        self.snapshot  = results['snapshot']
+        self.test_name = test_name
+        self.qclass    = qclass
+        self.level     = level
+        self.intervals = dict()
+        self.current   = 0
+        return
+
+    def stats(self, ts, qid):
+        interval = int(ts) / self.snapshot * self.snapshot
+        key = (qid, self.level['threads'].value, self.level['rate'].value)
+        if not interval in self.intervals:
+            self.intervals[interval] = dict()
+        if not key in self.intervals[interval]:
+            self.intervals[interval][key] = stresstest_histogram.new_stats()
+        return self.intervals[interval][key]
+
+    def record(self, ts, qid, latency, late):
+        stats = self.stats(ts, qid)
+        stats[0] += 1
+        if late:
+            stats[2] += 1
+        stats[4].record(latency)
+        return
+
+    # Failures are counted by category for every attempt, errors only for the
+    # queries which failed after all the retries
+    def error(self, ts, qid, message, category, retried=False):
+        stats = self.stats(ts, qid)
+        if not retried:
+            stats[1] += 1
+        stats[5][category] = stats[5].get(category, 0) + 1
+        self.queue.put(('E', ts, self.test_name, self.qclass, qid, category, retried, message))
+        return
+
+    def drop(self, ts, n):
+        self.stats(ts, '-')[3] += n
+        return
+
+    def flush(self, force=False):
+        now = int(time.time()) / self.snapshot * self.snapshot
+        if now == self.current and not force:
+            return
+        self.current = now
+        for interval in sorted(self.intervals.keys()):
+            if interval < now or force:
+                for key, stats in self.intervals[interval].iteritems():
+                    self.queue.put(('H', interval, self.snapshot, (self.test_name, self.qclass) + key, stats))
+                del self.intervals[interval]
+        return
+
+def run_benchmark(session, sched, rec, deadline, stop, database, username, queries, log_query, policy, entries):
+    # Runs random queries or the replayed ones of entries until the deadline or
+    # the stop event, queries is the dictionary of the queries or SQL files by
+    # their id. Failed queries are retried according to the error policy, the
+    # latency of the query includes the failed attempts and the waits between
+    # them
+    pick = query_picker(sorted(queries.keys()), sched, entries)
+    while True:
+        dropped  = 0
+        if sched is not None:
+            dropped = sched.dropped
+        intended = next_query(sched, deadline, stop)
+        if sched is not None and sched.dropped > dropped:
+            rec.drop(time.time(), sched.dropped - dropped)
+        if intended is False:
+            break
+        qid = pick()
+        first = time.time()
+        ts = first
+        if intended is not None:
+            ts = intended
+        attempt = 0
+        while True:
+            start = time.time()
+            if queries[qid][0] == 'file':
+                t, err = timed_query(session, database, username, sqlfile=queries[qid][1], timeout=policy['timeout'])
+            else:
+                t, err = timed_query(session, database, username, query=queries[qid][1], timeout=policy['timeout'])
+            if err is None or err == '':
+                break
+            category = classify_error(err)
+            if attempt >= policy['retries'] or not category in policy['retry_errors'] or time.time() >= deadline or stop.is_set():
+                break
+            rec.error(ts, qid, err, category, retried=True)
+            time.sleep(policy['backoff'] * 2 ** attempt)
+            attempt += 1
+        if not (err is None) and err <> '':
+            rec.error(ts, qid, err, category)
+        else:
+            rec.record(ts, qid, start - ts + t, sched is not None and sched.was_late)
+        log_query(qid, intended, start, t, err)
+        rec.flush()
+    rec.flush(force=True)
+    return
+
+def write_benchmark (thread_id, test_name, seconds, database, username, log_dir, sql_files, executor, openloop, policy, level, stop, results, seed, entries):
+    random.seed(seed)
+    session = open_session(executor, database, username, policy['timeout'])
+    sched   = None
+    if openloop is not None:
+        sched = open_loop(openloop, level, entries)
+    rec = Recorder(results, test_name, 'write', level)
+    files = dict([ (os.path.basename(f), ('file', f)) for f in sql_files ])
+    fout, ferr = None, None
+    if results['raw_logs']:
+        fout = open('%s/%s_write_%d.csv' % (log_dir,test_name,thread_id), 'w')
+        ferr = open('%s/%s_write_%d.err' % (log_dir,test_name,thread_id), 'w')
+    def log_query(qid, intended, start, t, err):
+        if fout is None:
+            return
         if not (err is None) and err <> '':
             ferr.write(err)
         else:
-            fout.write('%s|%s|%d|%f\n' % (now.strftime('%Y-%m-%d %H:%M:%S'),sql_files[ind],thread_id, t))
-    fout.close()
-    ferr.close()
+            ts, latency, extra = result_fields(intended, start, t)
+            fout.write('%s|%s|%d|%f%s\n' % (ts,files[qid][1],thread_id, latency, extra))
+        return
+    run_benchmark(session, sched, rec, time.time() + seconds, stop, database, username, files, log_query, policy, entries)
+    if session is not None:
+        session.close()
+    if fout is not None:
+        if sched is not None:
+            sched.write_report('%s/%s_write_%d.sched' % (log_dir,test_name,thread_id))
+        fout.close()
+        ferr.close()
     return
 
-def read_benchmark(thread_id, test_name, seconds, database, username, log_dir, queries, qtype):
-    random.seed()
-    fout = open('%s/%s_read_%d_%s.csv' % (log_dir,test_name,thread_id,qtype), 'w')
-    ferr = open('%s/%s_read_%d_%s.err' % (log_dir,test_name,thread_id,qtype), 'w')
-    n1 = dt.datetime.now()
-    qids = queries.keys()
-    while (dt.datetime.now() - n1).seconds < seconds:
-        ind = random.randint(0, len(qids)-1)
-        now = dt.datetime.now()
-        t, err = execute_for_timing(database, username, query=queries[qids[ind]])
+def read_benchmark(thread_id, test_name, seconds, database, username, log_dir, queries, qtype, executor, openloop, policy, level, stop, results, seed, entries):
+    random.seed(seed)
+    session = open_session(executor, database, username, policy['timeout'])
+    sched   = None
+    if openloop is not None:
+        sched = open_loop(openloop, level, entries)
+    rec = Recorder(results, test_name, qtype, level)
+    fout, ferr = None, None
+    if results['raw_logs']:
+        fout = open('%s/%s_read_%d_%s.csv' % (log_dir,test_name,thread_id,qtype), 'w')
+        ferr = open('%s/%s_read_%d_%s.err' % (log_dir,test_name,thread_id,qtype), 'w')
+    def log_query(qid, intended, start, t, err):
+        if fout is None:
+            return
         if not (err is None) and err <> '':
             ferr.write(err)
         else:
-            fout.write('%s|%s|%d|%s|%f\n' % (qtype, now.strftime('%Y-%m-%d %H:%M:%S'),thread_id, qids[ind], t))
-    fout.close()
+            ts, latency, extra = result_fields(intended, start, t)
+            fout.write('%s|%s|%d|%s|%f%s\n' % (qtype, ts,thread_id, qid, latency, extra))
+        return
+    run_benchmark(session, sched, rec, time.time() + seconds, stop, database, username,
+                  dict([ (qid, ('query', queries[qid])) for qid in queries ]), log_query, policy, entries)
+    if session is not None:
+        session.close()
+    if fout is not None:
+        if sched is not None:
+            sched.write_report('%s/%s_read_%d_%s.sched' % (log_dir,test_name,thread_id,qtype))
+        fout.close()
+        ferr.close()
+    return
+
+def collector(queue, results_file, errors_file):
+    # Merges the interval histograms of all the threads and appends them to the
+    # results file once the interval is over. Records coming after that are
+    # appended as separate lines and merged when the file is read
+    fres    = open(results_file, 'a')
+    ferr    = open(errors_file, 'a')
+    pending = dict()
+    totals  = dict()
+    while True:
+        try:
+            msg = queue.get(timeout=1)
+        except Queue.Empty:
+            msg = ''
+        if msg is None:
+            break
+        if msg != '' and msg[0] == 'H':
+            h, interval, seconds, key, stats = msg
+            if not (interval, seconds, key) in pending:
+                pending[(interval, seconds, key)] = stresstest_histogram.new_stats()
+            stresstest_histogram.merge_stats(pending[(interval, seconds, key)], stats)
+            # Totals per test, class and load level draw the latency-vs-load curve
+            level = key[:2] + key[3:]
+            if not level in totals:
+                totals[level] = stresstest_histogram.new_stats()
+            stresstest_histogram.merge_stats(totals[level], stats)
+        if msg != '' and msg[0] == 'E':
+            e, ts, test_name, qclass, qid, category, retried, message = msg
+            ferr.write('%s|%s|%s|%s|%s|%s|%s\n' % (dt.datetime.fromtimestamp(ts).strftime('%Y-%m-%d %H:%M:%S'),
+                       test_name, qclass, qid, category, 'retried' if retried else 'failed', ' '.join(message.split())))
+        now = time.time()
+        for k in sorted(pending.keys()):
+            if k[0] + 2 * k[1] < now:
+                fres.write(stresstest_histogram.format_record(k[0], k[1], k[2], pending[k]))
+                del pending[k]
+        fres.flush()
+        ferr.flush()
+    for k in sorted(pending.keys()):
+        fres.write(stresstest_histogram.format_record(k[0], k[1], k[2], pending[k]))
+    fres.close()
     ferr.close()
+    print '========== RESULTS =========='
+    print 'Test|Class|Threads|Rate|Executed|Errors|Late|Dropped|Failures|Mean|p50|p95|p99|Max'
+    for k in sorted(totals.keys()):
+        executed, errors, late, dropped, hist, failures = totals[k]
+        print '%s|%s|%d|%.3f|%d|%d|%d|%d|%s|%.6f|%.6f|%.6f|%.6f|%.6f' % (k[0], k[1], k[2], k[3], executed, errors, late, dropped,
+              stresstest_histogram.encode_failures(failures), hist.mean(), hist.percentile(0.5), hist.percentile(0.95), hist.percentile(0.99), hist.maximum / 1e6)
     return
 
-def readers_main(config, test_number, username, database, log_dir):
-    def read_queries(filename):
-        f = open(filename, 'r')
-        queries = dict()
-        queries['mixed'] = dict()
-        for line in f:
-            type, id, query = line.split('!')
-            if not type in queries:
-                queries[type] = dict()
-            queries[type][id] = query
-            queries['mixed'][type + id] = query
-        return queries
+def read_queries(filename):
+    f = open(filename, 'r')
+    queries = dict()
+    queries['mixed'] = dict()
+    for line in f:
+        type, id, query = line.split('!')
+        if not type in queries:
+            queries[type] = dict()
+        queries[type][id] = query
+        queries['mixed'][type + id] = query
+    return queries
+
+def reader_runs(section, n_seconds):
+    # Returns the runs of the readers as the lists of the classes (name, weight,
+    # quota) running at the same time and the seconds of each run. With
+    # "weights" the tests run at the same time as the classes of the weighted
+    # mix, otherwise "tests_to_run" run one after another
+    weights = section.get('weights')
+    if weights:
+        quotas = section.get('concurrency', dict())
+        return [ [ (t, weights[t], quotas.get(t)) for t in sorted(weights.keys()) ] ], n_seconds
+    tests_to_run = section.get('tests_to_run') or []
+    return [ [ (t, 1, None) ] for t in tests_to_run ], int(n_seconds / max(len(tests_to_run), 1))
+
+def writer_files(directory):
+    return sorted([ directory+'/'+f for f in os.listdir(directory) if os.path.isfile(directory+'/'+f) ])
+
+def readers_main(config, test_number, username, database, log_dir, results):
     n_threads = None
     test_name = config['tests'][test_number]['test_name']
     if 'readers' in config['tests'][test_number]:
-        if 'test_threads_number' in config['tests'][test_number]['readers']:
-            n_threads = config['tests'][test_number]['readers']['test_threads_number']
+        schedule  = LoadSchedule(config['tests'][test_number]['readers'])
+        n_threads = schedule.max_threads()
     if not n_threads is None and n_threads > 0:
-        print 'readers: n_threads = %d' % n_threads
-        n_seconds = config['tests'][test_number]['test_runtime_seconds']
-        n_tests   = len(config['tests'][test_number]['readers'].get('tests_to_run'))
-        if n_tests is None or n_tests == 0:
+        if 'schedule' in config['tests'][test_number]['readers']:
+            print 'readers: load schedule of %d segments, up to %d threads' % (len(schedule.segments), n_threads)
+        else:
+            print 'readers: n_threads = %d' % n_threads
+        weights   = config['tests'][test_number]['readers'].get('weights')
+        runs, n_seconds = reader_runs(config['tests'][test_number]['readers'], config['tests'][test_number]['test_runtime_seconds'])
+        tests_to_run = [ c[0] for classes in runs for c in classes ]
+        n_tests   = len(tests_to_run)
+        if n_tests == 0:
             print 'readers: WARNING: Number of tests specified by "tests_to_run" is zero, readers test is omitted'
         else:
-            n_seconds = int(n_seconds/n_tests)
-            print 'readers: running %d test for %d seconds each' % (n_tests, n_seconds)
-            tests_to_run = config['tests'][test_number]['readers']['tests_to_run']
-            badtests = set(tests_to_run) - set(["cpu", "memory", "disk", "network", "mixed"])
+            if weights:
+                print 'readers: running %d tests at the same time for %d seconds' % (n_tests, n_seconds)
+            else:
+                print 'readers: running %d test for %d seconds each' % (n_tests, n_seconds)
+            badtests = set(tests_to_run) - set(["cpu", "memory", "disk", "network", "selective", "mixed"])
             if len(badtests) > 0:
                 for test in badtests:
                     print 'readers: ERROR: Specified test "%s" is not in the list of available tests and cannot be run'
@@ -121,73 +931,363 @@ def readers_main(config, test_number, username, database, log_dir):
                         for t in tests_to_run:
                             q = len(queries[t])
                             print 'readers:     test "%s" has %d queries specified' % (t, q)
+                        openloop = open_loop_config(config['tests'][test_number]['readers'])
+                        plan = dict()
+                        if config.get('replay_schedule'):
+                            plan, err = replay_plan(config['replay_schedule'], test_name, dict([ (t, queries[t]) for t in tests_to_run ]), openloop)
+                            if err is not None:
+                                print 'readers: ERROR: %s' % err
+                                return
                         print 'readers: ready to start'
-                        for test in tests_to_run:
-                            print 'readers: STARTING THREADS FOR THE TEST "%s" TYPE "%s"' % (test_name, test)
-                            proc_list = []
-                            for i in range(n_threads):
-                                p = Process(target=read_benchmark, args=(i, test_name, n_seconds, database, username, log_dir, queries[test], test))
-                                p.start()
-                                proc_list.append(p)
-                            for p in proc_list:
-                                p.join()
+                        if openloop is not None:
+                            print 'readers: open-loop mode, %s arrivals' % openloop['arrivals']
+                        if weights:
+                            for classes in runs:
+                                for t, weight, quota in classes:
+                                    print 'readers:     test "%s" has weight %s, concurrency quota %s' % (t, weight, quota or 'none')
+                        def start_worker(test, i, slot, seconds, level, stop):
+                            policy = error_policy(config['tests'][test_number]['readers'], test)
+                            p = Process(target=read_benchmark, args=(i, test_name, seconds, database, username, log_dir, queries[test], test, config['executor'], openloop, policy, level, stop, results,
+                                                                     worker_seed(config.get('seed'), test_name, test, slot), plan.get(test, dict()).get(slot)))
+                            p.start()
+                            return p
+                        for classes in runs:
+                            types = ', '.join([ c[0] for c in classes ])
+                            print 'readers: STARTING THREADS FOR THE TEST "%s" TYPE "%s"' % (test_name, types)
+                            started = drive_workers('readers: test "%s" type "%s"' % (test_name, types), schedule, n_seconds, classes, start_worker)
+                            if openloop is not None and results['raw_logs']:
+                                for test in sorted(started.keys()):
+                                    schedule_report('readers: test "%s" type "%s"' % (test_name, test),
+                                                    ['%s/%s_read_%d_%s.sched' % (log_dir,test_name,i,test) for i in range(started[test])])
     else:
         print 'readers: no configuration defined for readers'
     return
 
-def writers_main(config, test_number, username, database, log_dir):
+def writers_main(config, test_number, username, database, log_dir, results):
     n_threads = None
     test_name = config['tests'][test_number]['test_name']
     if 'writers' in config['tests'][test_number]:
-        if 'test_threads_number' in config['tests'][test_number]['writers']:
-            n_threads = config['tests'][test_number]['writers']['test_threads_number']
+        schedule  = LoadSchedule(config['tests'][test_number]['writers'])
+        n_threads = schedule.max_threads()
     if not n_threads is None and n_threads > 0:
-        print 'writers: n_threads = %d' % n_threads
+        if 'schedule' in config['tests'][test_number]['writers']:
+            print 'writers: load schedule of %d segments, up to %d threads' % (len(schedule.segments), n_threads)
+        else:
+            print 'writers: n_threads = %d' % n_threads
         n_seconds = config['tests'][test_number]['test_runtime_seconds']
         print 'writers: n_seconds = %d' % n_seconds
         sql_files_directory = config['tests'][test_number]['writers']['sql_files_directory']
-        sql_files = [sql_files_directory+'/'+f for f in os.listdir(sql_files_directory) if os.path.isfile(sql_files_directory+'/'+f)]
+        sql_files = writer_files(sql_files_directory)
         print 'writers: input files -->'
         for f in sql_files:
             print 'writers:     %s' % f
         if len(sql_files) == 0:
             print 'writers: WARNING: No SQL files found in the directory %s, writers test is omitted' % sql_files_directory
         else:
+            openloop = open_loop_config(config['tests'][test_number]['writers'])
+            if openloop is not None:
+                print 'writers: open-loop mode, %s arrivals' % openloop['arrivals']
+            plan = dict()
+            if config.get('replay_schedule'):
+                plan, err = replay_plan(config['replay_schedule'], test_name, { 'write' : [ os.path.basename(f) for f in sql_files ] }, openloop)
+                if err is not None:
+                    print 'writers: ERROR: %s' % err
+                    return
             print 'writers: ready to start'
             print 'writers: STARTING THREADS FOR THE TEST "%s"' % test_name
-            proc_list = []
-            for i in range(n_threads):
-                p = Process(target=write_benchmark, args=(i, test_name, n_seconds, database, username, log_dir, sql_files))
+            policy = error_policy(config['tests'][test_number]['writers'], 'write')
+            def start_worker(qclass, i, slot, seconds, level, stop):
+                p = Process(target=write_benchmark, args=(i, test_name, seconds, database, username, log_dir, sql_files, config['executor'], openloop, policy, level, stop, results,
+                                                          worker_seed(config.get('seed'), test_name, qclass, slot), plan.get(qclass, dict()).get(slot)))
                 p.start()
-                proc_list.append(p)
-            for p in proc_list:
-                p.join()
+                return p
+            started = drive_workers('writers: test "%s"' % test_name, schedule, n_seconds, [ ('write', 1, None) ], start_worker)
+            if openloop is not None and results['raw_logs']:
+                schedule_report('writers: test "%s"' % test_name,
+                                ['%s/%s_write_%d.sched' % (log_dir,test_name,i) for i in range(started['write'])])
     else:
         print 'writers: no configuration defined for writers'
     return
     
-# Main function invokes separate threads for readers and writers test
+def check_config(config):
+    # Returns the description of the first problem of the config or None
+    if config.get('username_read') is None or config['username_read'] == '':
+        config['username_read'] = config['username']
+    # Queries are sent over the session kept open by each thread ("session") or
+    # by starting psql for each query ("psql")
+    config['executor'] = config.get('executor', 'session')
+    if config['executor'] not in ('session', 'psql'):
+        return 'executor "%s" is not supported, use "session" or "psql"' % config['executor']
+    # Readers and writers with "arrival_rate" run in open-loop mode with "fixed"
+    # or "poisson" arrivals
+    for test in config['tests']:
+        for section in ('readers', 'writers'):
+            if test.get(section, dict()).get('arrivals', 'poisson') not in ('fixed', 'poisson'):
+                return 'arrivals "%s" of the %s of the test "%s" are not supported, use "fixed" or "poisson"' % (
+                       test[section]['arrivals'], section, test['test_name'])
+            # Number of threads and arrival rate can follow the load schedule
+            # made of ramps and steps, see LoadSchedule
+            err = check_schedule(test.get(section, dict()))
+            if err is not None:
+                return 'load schedule of the %s of the test "%s": %s' % (section, test['test_name'], err)
+            # Statement timeouts and retries of the failed queries, see error_policy
+            err = check_policy(test.get(section, dict()))
+            if err is not None:
+                return 'error policy of the %s of the test "%s": %s' % (section, test['test_name'], err)
+        # Readers with "weights" run their tests at the same time, splitting the
+        # threads and arrival rate by the weights within "concurrency" quotas
+        err = check_mix(test.get('readers', dict()))
+        if err is not None:
+            return 'weighted mix of the readers of the test "%s": %s' % (test['test_name'], err)
+    # Runs with "replay_schedule" replay the queries and arrivals of the schedule
+    # file generated by --generate, see generate_schedule
+    if config.get('replay_schedule') and not os.path.isfile(config['replay_schedule']):
+        return 'schedule file "%s" to replay does not exist' % config['replay_schedule']
+    return None
+
+def run_tests(config, results):
+    # Runs separate threads for readers and writers of each test
+    for i in range(len(config['tests'])):
+        print '========== STARTING THE TEST "%s" ==========' % config['tests'][i]['test_name']
+        readers   = Process(target=readers_main, args=(config,i,config['username_read'],config['database'],config['logs_directory'],results))
+        writers   = Process(target=writers_main, args=(config,i,config['username'],     config['database'],config['logs_directory'],results))
+        readers.start()
+        time.sleep(2)
+        writers.start()
+        writers.join()
+        readers.join()
+    return
+
+# Coordinator and agents talk over TCP with the lines "<type>|<payload>":
+#   C|<config as JSON>     coordinator sends the config to run
+#   R|ready or R|<error>   agent accepts or rejects the config
+#   S|<seconds>            coordinator tells to start the tests in that time
+#   H|<results record>     agent sends the histograms of the interval, in the
+#                          format of the results file (stresstest_histogram.py)
+#   E|<error as JSON>      agent sends the failed query
+#   F|<error>              agent failed to run the tests, D follows
+#   D|                     agent has finished the tests
+AGENT_PORT  = 7777
+START_DELAY = 3.0
+
+def send_message(conn, msg, payload):
+    conn.sendall('%s|%s\n' % (msg, payload))
+    return
+
+def read_message(rfile):
+    line = rfile.readline()
+    if line == '':
+        return None, None
+    msg, payload = line.rstrip('\n').split('|', 1)
+    return msg, payload
+
+def agent_tests(config, results):
+    # The end of the results is sent even when the tests fail, otherwise the
+    # agent and the coordinator would wait for it forever
+    try:
+        run_tests(config, results)
+    except Exception, ex:
+        results['queue'].put(('F', str(ex)))
+        raise
+    finally:
+        results['queue'].put(None)
+    return
+
+def serve_coordinator(conn):
+    rfile = conn.makefile('r')
+    msg, payload = read_message(rfile)
+    if msg != 'C':
+        print 'ERROR: expected the config from the coordinator, got "%s"' % msg
+        return
+    config = json.loads(payload)
+    err = check_config(config)
+    if err is not None:
+        print 'ERROR: %s' % err
+        send_message(conn, 'R', err)
+        return
+    send_message(conn, 'R', 'ready')
+    msg, payload = read_message(rfile)
+    if msg != 'S':
+        print 'ERROR: expected the start from the coordinator, got "%s"' % msg
+        return
+    time.sleep(max(float(payload), 0))
+    print '========== AGENT STARTS %d TESTS ==========' % len(config['tests'])
+    results = { 'queue'    : ProcessQueue(),
+                'snapshot' : int(config.get('snapshot_seconds', 10)),
+                'raw_logs' : config.get('raw_logs', False) }
+    runner = Process(target=agent_tests, args=(config, results))
+    runner.start()
+    # Results of the threads are forwarded to the coordinator instead of the
+    # local collector
+    while True:
+        try:
+            m = results['queue'].get(timeout=1)
+        except Queue.Empty:
+            # Runner killed before sending the end of the results
+            if not runner.is_alive():
+                send_message(conn, 'F', 'tests exited with code %s' % runner.exitcode)
+                break
+            continue
+        if m is None:
+            break
+        if m[0] == 'H':
+            send_message(conn, 'H', stresstest_histogram.format_record(m[1], m[2], m[3], m[4]).rstrip('\n'))
+        elif m[0] == 'F':
+            print 'ERROR: tests failed: %s' % m[1]
+            send_message(conn, 'F', ' '.join(m[1].split()))
+        else:
+            send_message(conn, 'E', json.dumps(m[1:]))
+    runner.join()
+    send_message(conn, 'D', '')
+    print '========== AGENT FINISHED THE TESTS =========='
+    return
+
+def agent_main(port):
+    # Agent waits for the coordinator, runs the tests of its config on this host
+    # and sends the results back over the same connection
+    server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    server.bind(('', port))
+    server.listen(1)
+    print '---- AGENT LISTENING ON PORT %d' % port
+    while True:
+        conn, address = server.accept()
+        print '---- COORDINATOR CONNECTED FROM %s' % address[0]
+        try:
+            serve_coordinator(conn)
+        except Exception, ex:
+            print 'ERROR: connection to the coordinator failed: %s' % str(ex)
+        conn.close()
+
+def relay(address, conn, rfile, queue):
+    # Passes the results of the agent to the collector of the coordinator
+    while True:
+        msg, payload = read_message(rfile)
+        if msg is None:
+            print 'WARNING: agent %s closed the connection before the end of the tests' % address
+            break
+        if msg == 'D':
+            print '---- AGENT %s FINISHED THE TESTS' % address
+            break
+        if msg == 'F':
+            print 'ERROR: agent %s failed to run the tests: %s' % (address, payload)
+        if msg == 'H':
+            interval, seconds, key, stats = stresstest_histogram.parse_record(payload)
+            queue.put(('H', interval, seconds, key, stats))
+        elif msg == 'E':
+            ts, test_name, qclass, qid, category, retried, message = [ v.encode('utf-8') if isinstance(v, unicode) else v for v in json.loads(payload) ]
+            queue.put(('E', ts, test_name, qclass, qid, category, retried, message))
+    conn.close()
+    return
+
+def coordinate(config, results):
+    # Each agent runs the whole config, so the load of the tests is multiplied
+    # by the number of the agents. Agents start at the same time and their
+    # results are merged by the collector of the coordinator, the clocks of
+    # the hosts are expected to be in sync (NTP) as the intervals are theirs
+    agent_config = dict(config)
+    del agent_config['agents']
+    agents = []
+    for n, address in enumerate(config['agents']):
+        host, port = (address.split(':') + [AGENT_PORT])[:2]
+        # Agents seeded the same would run the same queries at the same time
+        if config.get('seed') is not None:
+            agent_config['seed'] = '%s/%d' % (config['seed'], n)
+        try:
+            conn = socket.create_connection((host, int(port)))
+            # The same buffered reader is used for all the messages of the
+            # agent, another one could lose the lines buffered by this one
+            rfile = conn.makefile('r')
+            send_message(conn, 'C', json.dumps(agent_config))
+            msg, payload = read_message(rfile)
+        except Exception, ex:
+            msg, payload = None, str(ex)
+        if msg != 'R' or payload != 'ready':
+            print 'ERROR: agent %s cannot run the tests: %s' % (address, payload)
+            for a, c, r in agents:
+                c.close()
+            return
+        print '---- AGENT %s IS READY' % address
+        agents.append((address, conn, rfile))
+    start = time.time() + START_DELAY
+    for address, conn, rfile in agents:
+        send_message(conn, 'S', '%f' % (start - time.time()))
+    print '========== STARTING THE TESTS ON %d AGENTS ==========' % len(agents)
+    relays = []
+    for address, conn, rfile in agents:
+        p = Process(target=relay, args=(address, conn, rfile, results['queue']))
+        p.start()
+        relays.append(p)
+        rfile.close()
+        conn.close()
+    for p in relays:
+        p.join()
+    return
+
 def main():
+    # Agent mode: python stresstest.py --agent [port]
+    if len(sys.argv) > 1 and sys.argv[1] == '--agent':
+        port = AGENT_PORT
+        if len(sys.argv) > 2:
+            port = int(sys.argv[2])
+        agent_main(port)
+        return
     config    = json.load(open(sys.argv[1], 'r'))
     testnum   = len(config['tests'])
     print '========== READ METADATA FOR %d TESTS ==========' % testnum
-    username      = config['username']
-    username_read = config.get('username_read')
-    if username_read is None or username_read == '':
-        username_read = username
+    err = check_config(config)
+    if err is not None:
+        print 'ERROR: %s' % err
+        return
+    # Schedule mode: python stresstest.py config.json --generate schedule_file
+    if len(sys.argv) > 3 and sys.argv[2] == '--generate':
+        print '========== GENERATING THE SCHEDULE "%s" WITH SEED %s ==========' % (sys.argv[3], config.get('seed'))
+        generate_schedule(config, sys.argv[3])
+        return
+    username = config['username']
     database = config['database']
     log_dir  = config['logs_directory']
+    # Latencies are aggregated into histograms per snapshot interval and written
+    # to the single results file, per-thread CSV and .err files are written
+    # only with "raw_logs"
+    results_file = config.get('results_file', log_dir + '/stresstest_results.txt')
+    errors_file  = os.path.splitext(results_file)[0] + '.err'
+    results = { 'queue'    : ProcessQueue(),
+                'snapshot' : int(config.get('snapshot_seconds', 10)),
+                'raw_logs' : config.get('raw_logs', False) }
     print '---- USING DATABASE "%s" UNDER USER "%s" ----' % (database, username)
+    print '---- EXECUTING QUERIES WITH "%s"' % config['executor']
+    if config.get('replay_schedule'):
+        print '---- REPLAYING THE SCHEDULE "%s"' % config['replay_schedule']
+    elif config.get('seed') is not None:
+        print '---- RANDOM SEED %s' % config['seed']
     print '---- LOGGING TO "%s"' % log_dir        
-    for i in range(testnum):
-        print '========== STARTING THE TEST "%s" ==========' % config['tests'][i]['test_name']
-        readers   = Process(target=readers_main, args=(config,i,username_read,database,log_dir))
-        writers   = Process(target=writers_main, args=(config,i,username,     database,log_dir))
-        readers.start()
-        time.sleep(2)
-        writers.start()
-        writers.join()
-        readers.join()
+    print '---- RESULTS TO "%s" EVERY %d SECONDS, ERRORS TO "%s"' % (results_file, results['snapshot'], errors_file)
+    coll = Process(target=collector, args=(results['queue'], results_file, errors_file))
+    coll.start()
+    # With "telemetry" the resource usage of the segment hosts and the number
+    # of the active and waiting sessions are sampled during the tests at the
+    # snapshot intervals, see stresstest_telemetry.py
+    sampler = None
+    if 'telemetry' in config:
+        telemetry = config['telemetry']
+        telemetry_file = telemetry.get('file', os.path.splitext(results_file)[0] + '.telemetry')
+        print '---- TELEMETRY TO "%s"' % telemetry_file
+        stop_sampler = Event()
+        sampler = Process(target=stresstest_telemetry.sampler, args=(database, telemetry.get('username', username), telemetry_file,
+                          int(telemetry.get('interval_seconds', results['snapshot'])), telemetry.get('local', False), stop_sampler))
+        sampler.start()
+    # With "agents" the tests are run by the agents on the listed hosts
+    # ("host:port") and this host only collects the results
+    if config.get('agents'):
+        coordinate(config, results)
+    else:
+        run_tests(config, results)
+    if sampler is not None:
+        stop_sampler.set()
+        sampler.join()
+    results['queue'].put(None)
+    coll.join()
     return
     
 main()
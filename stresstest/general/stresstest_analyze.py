@@ -0,0 +1,401 @@
+import sys
+import os
+import re
+import time
+import json
+from optparse import OptionParser
+import stresstest_histogram
+
+READ_FILE  = re.compile(r'^(?P<test>.+)_read_(?P<thread>\d+)_(?P<qclass>[^_]+)\.(?P<ext>csv|err)$')
+WRITE_FILE = re.compile(r'^(?P<test>.+)_write_(?P<thread>\d+)\.(?P<ext>csv|err)$')
+
+def parseargs():
+    parser = OptionParser()
+    parser.remove_option('-h')
+    parser.add_option('-h', '-?', '--help', action='store_true')
+    parser.add_option('-l', '--logdir',    type='string')
+    parser.add_option('-r', '--results',   type='string')
+    parser.add_option('-t', '--test',      type='string')
+    parser.add_option('-b', '--bucket',    type='int')
+    parser.add_option('-c', '--csvdir',    type='string')
+    parser.add_option('-j', '--json',      type='string')
+    parser.add_option('-m', '--telemetry', type='string')
+    (options, args) = parser.parse_args()
+    if options.help:
+        print """
+Script analyzes the results file of stresstest.py and the .err file next to it,
+or without the results file the per-thread result files written with "raw_logs":
+<test>_read_<thread>_<type>.csv, <test>_write_<thread>.csv and their .err files
+Usage:
+python stresstest_analyze.py -l logs_directory | -r results_file [-t test_name]
+                             [-b bucket_seconds] [-c csv_directory] [-j json_file]
+                             [-m telemetry_file]
+    -l | --logdir - directory with the result files of stresstest.py
+    -r | --results - results file of stresstest.py ("results_file" of its config,
+                    default is stresstest_results.txt in the logs directory)
+    -t | --test   - analyze only this test (default is all the tests found)
+    -b | --bucket - length of the time bucket for the throughput timeline in
+                    seconds (default is 60), the results file has the
+                    histograms per snapshot interval, so the buckets shorter
+                    than the interval are not possible with it
+    -c | --csvdir - directory to write timeline.csv, latency.csv and
+                    interference.csv to for plotting
+    -j | --json   - file to write all the results to in JSON format
+    -m | --telemetry - telemetry file of stresstest.py or stresstest_telemetry.py
+                    to correlate the latency with the resource usage
+Files are read line by line and the latencies are kept in histograms per test,
+class and time bucket, so the memory does not depend on the number of samples.
+Reader-vs-writer interference compares the reader latencies in the time buckets
+when the writers of the same test were running with the ones when they were not,
+and correlates the number of writer queries in a bucket with the mean reader
+latency in it.
+Resource usage is taken per time bucket as the average of the samples of each
+host in the bucket, the busiest host of the bucket is used. Each metric is
+correlated with the mean and p95 latency of each class over the buckets.
+"""
+        sys.exit(0)
+    if not options.logdir and not options.results:
+        sys.exit('You must specify the directory with the result files (-l) or the results file (-r)')
+    if not options.results:
+        options.results = os.path.join(options.logdir, 'stresstest_results.txt')
+    if not options.bucket:
+        options.bucket = 60
+    return options
+
+def find_files(logdir, test):
+    # Returns (test, role, class, extension, filename) for each result file
+    files = []
+    for f in sorted(os.listdir(logdir)):
+        m = READ_FILE.match(f)
+        role = 'read'
+        if m is None:
+            m = WRITE_FILE.match(f)
+            role = 'write'
+        if m is None:
+            continue
+        if test and m.group('test') != test:
+            continue
+        qclass = 'write'
+        if role == 'read':
+            qclass = m.group('qclass')
+        files.append((m.group('test'), role, qclass, m.group('ext'), os.path.join(logdir, f)))
+    return files
+
+class Timestamps:
+    # Lines of one second share the timestamp, so the last parsed ones are kept
+    cache = dict()
+
+    def __init__(self):
+        self.cache = dict()
+        return
+
+    def epoch(self, ts):
+        if not ts in self.cache:
+            if len(self.cache) > 1000:
+                self.cache = dict()
+            self.cache[ts] = int(time.mktime(time.strptime(ts, '%Y-%m-%d %H:%M:%S')))
+        return self.cache[ts]
+
+def read_samples(filename, role, timestamps):
+    # Yields (epoch, query id, latency) of a result file. Reader lines are
+    # type|time|thread|query|latency and writer lines are time|file|thread|latency,
+    # both optionally followed by the execution time in open-loop mode
+    f = open(filename, 'r')
+    for line in f:
+        fields = line.rstrip('\r\n').split('|')
+        try:
+            if role == 'read':
+                yield timestamps.epoch(fields[1]), fields[3], float(fields[4])
+            else:
+                yield timestamps.epoch(fields[0]), os.path.basename(fields[1]), float(fields[3])
+        except (IndexError, ValueError):
+            continue
+    f.close()
+
+def count_errors(filename):
+    # Each failed query starts its message with this line, followed by the
+    # error text of any length
+    n = 0
+    f = open(filename, 'r')
+    for line in f:
+        if line.startswith('Failed to execute'):
+            n += 1
+    f.close()
+    return n
+
+def count_failed(filename, test):
+    # Returns the number of the failed queries per (test, class) from the errors
+    # file next to the results file, lines are
+    # time|test|class|query|category|failed or retried|message
+    errors = dict()
+    f = open(filename, 'r')
+    for line in f:
+        fields = line.rstrip('\r\n').split('|', 6)
+        if len(fields) < 7 or fields[5] != 'failed' or (test and fields[1] != test):
+            continue
+        errors[(fields[1], fields[2])] = errors.get((fields[1], fields[2]), 0) + 1
+    f.close()
+    return errors
+
+def analyze_results(results_file, test, bucket):
+    # Same as analyze() for the results file, where the histograms are already
+    # merged per snapshot interval. Errors are counted from the errors file
+    # when it is there, otherwise taken from the results
+    classes  = dict()
+    timeline = dict()
+    errors   = dict()
+    short    = False
+    for interval, seconds, key, stats in stresstest_histogram.read_results(results_file):
+        if test and key[0] != test:
+            continue
+        role = 'write' if key[1] == 'write' else 'read'
+        k = (key[0], role, key[1])
+        if not k in classes:
+            classes[k] = [0, stresstest_histogram.Histogram()]
+        classes[k][1].merge(stats[4])
+        errors[k] = errors.get(k, 0) + stats[1]
+        short = short or bucket < seconds
+        b = interval / bucket * bucket
+        if not k + (b,) in timeline:
+            timeline[k + (b,)] = stresstest_histogram.Histogram()
+        timeline[k + (b,)].merge(stats[4])
+    if short:
+        sys.stderr.write('WARNING: buckets of %d seconds are shorter than the snapshot intervals of the results\n' % bucket)
+    errors_file = os.path.splitext(results_file)[0] + '.err'
+    if os.path.isfile(errors_file):
+        failed = count_failed(errors_file, test)
+        errors = dict([ (k, failed.get((k[0], k[2]), 0)) for k in classes ])
+    for k in classes:
+        classes[k][0] = errors[k]
+    return classes, timeline
+
+def analyze(files, bucket):
+    timestamps = Timestamps()
+    classes  = dict()   # (test, role, class) -> [errors, histogram]
+    timeline = dict()   # (test, role, class, bucket) -> histogram
+    for test, role, qclass, ext, filename in files:
+        key = (test, role, qclass)
+        if not key in classes:
+            classes[key] = [0, stresstest_histogram.Histogram()]
+        if ext == 'err':
+            classes[key][0] += count_errors(filename)
+            continue
+        for epoch, qid, latency in read_samples(filename, role, timestamps):
+            classes[key][1].record(latency)
+            b = epoch / bucket * bucket
+            if not key + (b,) in timeline:
+                timeline[key + (b,)] = stresstest_histogram.Histogram()
+            timeline[key + (b,)].record(latency)
+    return classes, timeline
+
+def correlation(pairs):
+    n = len(pairs)
+    if n < 2:
+        return None
+    mx = sum([x for x, y in pairs]) / float(n)
+    my = sum([y for x, y in pairs]) / float(n)
+    sxy = sum([(x - mx) * (y - my) for x, y in pairs])
+    sxx = sum([(x - mx) ** 2 for x, y in pairs])
+    syy = sum([(y - my) ** 2 for x, y in pairs])
+    if sxx == 0 or syy == 0:
+        return None
+    return sxy / (sxx * syy) ** 0.5
+
+def interference(timeline, bucket):
+    # For each test compares the reader latencies of the buckets with and
+    # without the writers running
+    writes = dict()
+    for test, role, qclass, b in timeline:
+        if role == 'write':
+            writes[(test, b)] = writes.get((test, b), 0) + timeline[(test, role, qclass, b)].count
+    res = dict()
+    for test, role, qclass, b in timeline:
+        if role != 'read':
+            continue
+        if not (test, qclass) in res:
+            res[(test, qclass)] = [stresstest_histogram.Histogram(), stresstest_histogram.Histogram(), []]
+        hist = timeline[(test, role, qclass, b)]
+        nwrites = writes.get((test, b), 0)
+        if nwrites > 0:
+            res[(test, qclass)][0].merge(hist)
+        else:
+            res[(test, qclass)][1].merge(hist)
+        res[(test, qclass)][2].append((float(nwrites) / bucket, hist.mean()))
+    return res
+
+def read_telemetry(filename, bucket):
+    # Returns the value of each metric per bucket as (bucket, metric) -> value,
+    # lines are interval|seconds|host|metric|value
+    sums = dict()
+    f = open(filename, 'r')
+    for line in f:
+        fields = line.rstrip('\r\n').split('|')
+        try:
+            key = (int(fields[0]) / bucket * bucket, fields[3], fields[2])
+            value = float(fields[4])
+        except (IndexError, ValueError):
+            continue
+        if not key in sums:
+            sums[key] = [0.0, 0]
+        sums[key][0] += value
+        sums[key][1] += 1
+    f.close()
+    res = dict()
+    for (b, metric, host), (total, n) in sums.iteritems():
+        res[(b, metric)] = max(res.get((b, metric), 0.0), total / n)
+    return res
+
+def resource_correlation(timeline, resources):
+    # For each class and metric returns the correlation of the metric with the
+    # mean and p95 latency over the buckets, and the highest value of the metric
+    metrics = sorted(set([ m for b, m in resources ]))
+    series  = dict()
+    for test, role, qclass, b in timeline:
+        for m in metrics:
+            if (b, m) in resources:
+                if not (test, role, qclass, m) in series:
+                    series[(test, role, qclass, m)] = []
+                hist = timeline[(test, role, qclass, b)]
+                series[(test, role, qclass, m)].append((resources[(b, m)], hist.mean(), hist.percentile(0.95)))
+    res = dict()
+    for key, values in series.iteritems():
+        res[key] = (correlation([ (v, mean) for v, mean, p95 in values ]),
+                    correlation([ (v, p95) for v, mean, p95 in values ]),
+                    max([ v for v, mean, p95 in values ]))
+    return res
+
+def resource_summary(corr, out):
+    out.write('========== LATENCY VS RESOURCES ==========\n')
+    out.write('Test|Role|Class|Metric|Correlation with mean latency|Correlation with p95 latency|Max\n')
+    for key in sorted(corr.keys()):
+        cmean, cp95, peak = corr[key]
+        out.write('%s|%s|%s|%s|%s|%s|%.3f\n' % (key + ('n/a' if cmean is None else '%.3f' % cmean,
+                  'n/a' if cp95 is None else '%.3f' % cp95, peak)))
+    return
+
+def summary(classes, timeline, inter, bucket, out):
+    out.write('========== LATENCY PER CLASS ==========\n')
+    out.write('Test|Role|Class|Executed|Errors|Error rate|Mean|p50|p95|p99|Max\n')
+    for key in sorted(classes.keys()):
+        errors, hist = classes[key]
+        rate = float(errors) / max(errors + hist.count, 1)
+        out.write('%s|%s|%s|%d|%d|%.4f|%.6f|%.6f|%.6f|%.6f|%.6f\n' % (key + (hist.count, errors, rate,
+                  hist.mean(), hist.percentile(0.5), hist.percentile(0.95), hist.percentile(0.99), hist.maximum / 1e6)))
+    out.write('========== THROUGHPUT PER %d SECONDS ==========\n' % bucket)
+    out.write('Time|Test|Role|Class|Executed|Per second|p50|p95|p99\n')
+    for key in sorted(timeline.keys(), key=lambda k: (k[3], k[:3])):
+        hist = timeline[key]
+        out.write('%s|%s|%s|%s|%d|%.3f|%.6f|%.6f|%.6f\n' % (time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(key[3])),
+                  key[0], key[1], key[2], hist.count, float(hist.count) / bucket,
+                  hist.percentile(0.5), hist.percentile(0.95), hist.percentile(0.99)))
+    out.write('========== READER-VS-WRITER INTERFERENCE ==========\n')
+    out.write('Test|Class|Mean with writers|p95 with writers|Mean without writers|p95 without writers|Correlation of writes per second and mean latency\n')
+    for key in sorted(inter.keys()):
+        w, wo, pairs = inter[key]
+        corr = correlation(pairs)
+        out.write('%s|%s|%.6f|%.6f|%.6f|%.6f|%s\n' % (key[0], key[1], w.mean(), w.percentile(0.95),
+                  wo.mean(), wo.percentile(0.95), 'n/a' if corr is None else '%.3f' % corr))
+    return
+
+def write_csv(classes, timeline, inter, bucket, csvdir):
+    f = open(os.path.join(csvdir, 'latency.csv'), 'w')
+    f.write('test,role,class,executed,errors,mean,p50,p95,p99,max\n')
+    for key in sorted(classes.keys()):
+        errors, hist = classes[key]
+        f.write('%s,%s,%s,%d,%d,%f,%f,%f,%f,%f\n' % (key + (hist.count, errors, hist.mean(),
+                hist.percentile(0.5), hist.percentile(0.95), hist.percentile(0.99), hist.maximum / 1e6)))
+    f.close()
+    f = open(os.path.join(csvdir, 'timeline.csv'), 'w')
+    f.write('epoch,test,role,class,executed,per_second,p50,p95,p99\n')
+    for key in sorted(timeline.keys(), key=lambda k: (k[3], k[:3])):
+        hist = timeline[key]
+        f.write('%d,%s,%s,%s,%d,%f,%f,%f,%f\n' % (key[3], key[0], key[1], key[2], hist.count, float(hist.count) / bucket,
+                hist.percentile(0.5), hist.percentile(0.95), hist.percentile(0.99)))
+    f.close()
+    f = open(os.path.join(csvdir, 'interference.csv'), 'w')
+    f.write('test,class,mean_with_writers,p95_with_writers,mean_without_writers,p95_without_writers,correlation\n')
+    for key in sorted(inter.keys()):
+        w, wo, pairs = inter[key]
+        corr = correlation(pairs)
+        f.write('%s,%s,%f,%f,%f,%f,%s\n' % (key[0], key[1], w.mean(), w.percentile(0.95),
+                wo.mean(), wo.percentile(0.95), '' if corr is None else '%f' % corr))
+    f.close()
+    return
+
+def write_resources_csv(resources, corr, csvdir):
+    f = open(os.path.join(csvdir, 'resources.csv'), 'w')
+    f.write('epoch,metric,value\n')
+    for b, m in sorted(resources.keys()):
+        f.write('%d,%s,%f\n' % (b, m, resources[(b, m)]))
+    f.close()
+    f = open(os.path.join(csvdir, 'resource_correlation.csv'), 'w')
+    f.write('test,role,class,metric,correlation_mean,correlation_p95,max\n')
+    for key in sorted(corr.keys()):
+        cmean, cp95, peak = corr[key]
+        f.write('%s,%s,%s,%s,%s,%s,%f\n' % (key + ('' if cmean is None else '%f' % cmean,
+                '' if cp95 is None else '%f' % cp95, peak)))
+    f.close()
+    return
+
+def write_json(classes, timeline, inter, bucket, filename, resources=None, corr=None):
+    def stats(hist):
+        return { 'executed' : hist.count,
+                 'mean'     : hist.mean(),
+                 'p50'      : hist.percentile(0.5),
+                 'p95'      : hist.percentile(0.95),
+                 'p99'      : hist.percentile(0.99),
+                 'max'      : hist.maximum / 1e6 }
+    res = { 'bucket_seconds' : bucket, 'classes' : [], 'timeline' : [], 'interference' : [] }
+    for key in sorted(classes.keys()):
+        s = stats(classes[key][1])
+        s.update({ 'test' : key[0], 'role' : key[1], 'class' : key[2], 'errors' : classes[key][0] })
+        res['classes'].append(s)
+    for key in sorted(timeline.keys(), key=lambda k: (k[3], k[:3])):
+        s = stats(timeline[key])
+        s.update({ 'epoch' : key[3], 'test' : key[0], 'role' : key[1], 'class' : key[2],
+                   'per_second' : float(timeline[key].count) / bucket })
+        res['timeline'].append(s)
+    for key in sorted(inter.keys()):
+        w, wo, pairs = inter[key]
+        res['interference'].append({ 'test' : key[0], 'class' : key[1],
+                                     'with_writers' : stats(w), 'without_writers' : stats(wo),
+                                     'correlation' : correlation(pairs) })
+    if resources is not None:
+        res['resources'] = [ { 'epoch' : b, 'metric' : m, 'value' : resources[(b, m)] } for b, m in sorted(resources.keys()) ]
+        res['resource_correlation'] = [ { 'test' : key[0], 'role' : key[1], 'class' : key[2], 'metric' : key[3],
+                                          'correlation_mean' : corr[key][0], 'correlation_p95' : corr[key][1],
+                                          'max' : corr[key][2] } for key in sorted(corr.keys()) ]
+    f = open(filename, 'w')
+    json.dump(res, f, indent=4)
+    f.close()
+    return
+
+def main():
+    options = parseargs()
+    # Results file is always written, the per-thread files only with "raw_logs"
+    if os.path.isfile(options.results):
+        classes, timeline = analyze_results(options.results, options.test, options.bucket)
+    else:
+        files = []
+        if options.logdir:
+            files = find_files(options.logdir, options.test)
+        if len(files) == 0:
+            sys.exit('No results file %s and no per-thread result files found, give the "results_file" of the config '
+                     'with -r or run stresstest.py with "raw_logs": true' % options.results)
+        classes, timeline = analyze(files, options.bucket)
+    inter = interference(timeline, options.bucket)
+    summary(classes, timeline, inter, options.bucket, sys.stdout)
+    resources, corr = None, None
+    if options.telemetry:
+        resources = read_telemetry(options.telemetry, options.bucket)
+        corr = resource_correlation(timeline, resources)
+        resource_summary(corr, sys.stdout)
+    if options.csvdir:
+        write_csv(classes, timeline, inter, options.bucket, options.csvdir)
+        if resources is not None:
+            write_resources_csv(resources, corr, options.csvdir)
+    if options.json:
+        write_json(classes, timeline, inter, options.bucket, options.json, resources, corr)
+    return
+
+main()
@@ -1,5 +1,9 @@
 import sys
+import os
+import re
 import time
+import json
+import math
 from datetime import datetime
 try:
     from gppylib.db import dbconn
@@ -7,31 +11,183 @@ try:
 except ImportError, e:
     sys.exit('Cannot import modules. Please check that you have sourced greenplum_path.sh.  Detail: ' + str(e))
 
-def execute(dburl, query):
-    res = [['']]
+def execute(conn, query):
+    res = []
     try:
-        conn = dbconn.connect(dburl)
         curs = dbconn.execSQL(conn, query)
         rows = curs.fetchall()
         conn.commit()
-        conn.close()
         res = rows
     except Exception as ex:
         sys.stderr.write ('Exception during execute: %s' % str(ex))
         pass
     return res
 
+def sql_array(values, type):
+    return "array[%s]::%s[]" % (','.join(["'%s'" % str(v).replace("'", "''") for v in values]), type)
+
+def parse_array(text):
+    # Returns the elements of the one-dimensional array in its text form like
+    # {1,"a b",NULL}, NULL elements are None
+    if not text or not text.startswith('{') or not text.endswith('}'):
+        return []
+    values  = []
+    value   = ''
+    quoted  = False
+    escaped = False
+    was_quoted = False
+    for ch in text[1:-1]:
+        if escaped:
+            value  += ch
+            escaped = False
+        elif ch == '\\':
+            escaped = True
+        elif ch == '"':
+            quoted = not quoted
+            was_quoted = True
+        elif ch == ',' and not quoted:
+            values.append(None if value == 'NULL' and not was_quoted else value)
+            value, was_quoted = '', False
+        else:
+            value += ch
+    if value != '' or was_quoted:
+        values.append(None if value == 'NULL' and not was_quoted else value)
+    return values
+
+# Column statistics are cached in the file per database and table OID together
+# with the time of the last analyze of the table, the cached statistics are used
+# while the table is not analyzed again. Cache of the other version is rebuilt
+CACHE_VERSION = 2
+
+def load_cache(filename):
+    if not os.path.isfile(filename):
+        return dict()
+    try:
+        f = open(filename, 'r')
+        cache = json.load(f)
+        f.close()
+    except Exception as ex:
+        sys.stderr.write ('WARNING: Cannot read the statistics cache %s, it is rebuilt: %s\n' % (filename, str(ex)))
+        return dict()
+    if not isinstance(cache, dict) or cache.get('version') != CACHE_VERSION:
+        return dict()
+    return cache['databases']
+
+def save_cache(filename, databases):
+    f = open(filename + '.tmp', 'w')
+    json.dump({ 'version' : CACHE_VERSION, 'databases' : databases }, f)
+    f.close()
+    os.rename(filename + '.tmp', filename)
+    return
+
+# Selective queries hit these fractions of the table rows, the predicate for
+# each fraction is chosen among the ones estimated within SELECTIVITY_TOLERANCE
+# times of it. Queries expected to return at most SMALL_RESULT_ROWS rows fetch
+# them, the others count them
+TARGET_FRACTIONS      = [0.0001, 0.01, 0.1, 0.5]
+SELECTIVITY_TOLERANCE = 2.0
+SMALL_RESULT_ROWS     = 1000
+INTEGER_TYPES         = ['smallint', 'integer', 'bigint']
+FLOAT_TYPES           = ['real', 'double precision']
+# Dates and timestamps without time zone in ISO format sort as text the same
+# way as in the database
+ISO_TIME_TYPES        = ['date', 'timestamp without time zone']
+ISO_TIME              = re.compile(r'^\d{4}-\d\d-\d\d( \d\d:\d\d:\d\d(\.\d+)?)?$')
+
+def literal(value, type):
+    return "'%s'::%s" % (value.replace("'", "''"), type)
+
+def usable(value):
+    # Values are written to the query file as is, where "!" separates the fields
+    return value is not None and not '!' in value and not '\n' in value and not '\r' in value
+
+def column_predicates(column, reltuples):
+    # Returns the predicates on the column with their fractions of the table
+    # rows estimated from pg_stats the same way as the planner does: equality
+    # to the most common values has their frequency, equality to the other
+    # values shares the rest of the rows evenly, ranges over the histogram get
+    # the same share of these rows per bucket plus the most common values
+    # inside the range. Within a bucket ranges are interpolated for the numeric
+    # columns only. Most common values are ordered outside of the database for
+    # the numbers, dates and timestamps only, so there are no ranges on the
+    # other columns with the most common values
+    name, ndistinct, distkey, type, null_frac, mcv, mcf, hist = column
+    mcv  = parse_array(mcv)
+    mcf  = [ float(f) for f in parse_array(mcf) ]
+    hist = [ v for v in parse_array(hist) if v is not None ]
+    rest = max(1.0 - (null_frac or 0.0) - sum(mcf), 0.0)
+    numeric = type in INTEGER_TYPES or type in FLOAT_TYPES or type.startswith('numeric')
+    order   = None
+    if numeric:
+        order = float
+    elif type in ISO_TIME_TYPES and len([ v for v in mcv + hist if v is not None and not ISO_TIME.match(v) ]) == 0:
+        order = str
+    res = []
+    for value, freq in zip(mcv, mcf):
+        if usable(value):
+            res.append(('%s = %s' % (name, literal(value, type)), freq))
+    if ndistinct < 0:
+        ndistinct = -ndistinct * reltuples
+    others = ndistinct - len(mcv)
+    if others >= 1 and rest > 0 and len(hist) > 0 and usable(hist[len(hist) / 2]):
+        res.append(('%s = %s' % (name, literal(hist[len(hist) / 2], type)), rest / others))
+    if len(hist) < 2 or rest <= 0 or (order is None and len(mcv) > 0):
+        return res
+    buckets = len(hist) - 1
+    width   = rest / buckets
+    def mcv_inside(lo, hi, last):
+        if order is None:
+            return 0.0
+        return sum([ f for v, f in zip(mcv, mcf) if v is not None and order(v) >= lo and (order(v) < hi or last and order(v) == hi) ])
+    for target in TARGET_FRACTIONS:
+        n = int(round(target / width))
+        if n > buckets:
+            continue
+        if n >= 1:
+            # Whole buckets in the middle of the histogram
+            i = (buckets - n) / 2
+            lo, hi = hist[i], hist[i + n]
+            if not usable(lo) or not usable(hi):
+                continue
+            op = '<'
+            if i + n == buckets:
+                op = '<='
+            fraction = n * width
+            if order is not None:
+                fraction += mcv_inside(order(lo), order(hi), op == '<=')
+            res.append(('%s >= %s and %s %s %s' % (name, literal(lo, type), name, op, literal(hi, type)), fraction))
+        elif numeric:
+            # Part of the bucket in the middle of the histogram
+            i  = buckets / 2
+            b0 = float(hist[i])
+            b1 = float(hist[i + 1])
+            if b1 <= b0:
+                continue
+            lo = b0
+            hi = b0 + (b1 - b0) * target / width
+            if type in INTEGER_TYPES:
+                lo, hi = int(math.floor(lo)), int(math.ceil(hi))
+                if hi == lo:
+                    hi = lo + 1
+            fraction = width * (hi - lo) / (b1 - b0) + mcv_inside(lo, hi, False)
+            res.append(('%s >= %s and %s < %s' % (name, literal(repr(lo), type), name, literal(repr(hi), type)), fraction))
+    return res
+
 class WorkloadGenerator:
     input_filename  = ''
     output_filename = ''
+    cache_filename  = ''
     dburl           = None
     tables          = []
+    reltuples       = dict()
     
-    def __init__(self, filename_in, filename_out, dburl_in):
+    def __init__(self, filename_in, filename_out, dburl_in, cache_filename=None):
         self.input_filename  = filename_in
         self.output_filename = filename_out
+        self.cache_filename  = cache_filename
         self.dburl           = dburl_in
         self.tables          = []
+        self.reltuples       = dict()
         return
     
     def get_tables(self):
@@ -40,28 +196,79 @@ class WorkloadGenerator:
             self.tables.append(t.strip())
         return
 
+    # Statistics of all the tables are read over one connection: the OIDs, the
+    # number of rows and the last analyze times of the tables first, then the
+    # column statistics, the distribution keys, the most common values and the
+    # histograms of the tables missing from the cache or analyzed since they
+    # were cached, each with a single query
     def get_table_stats(self):
-        query = """
-            select a.attname, s.stadistinct
-                from pg_class as c,
-                     pg_namespace as n,
-                     pg_statistic as s,
-                     pg_attribute as a
-                where c.relnamespace = n.oid
-                    and s.starelid = c.oid
-                    and a.attrelid = c.oid
-                    and a.attnum = s.staattnum
-                    and n.nspname || '.' || c.relname = '%s'
-                order by s.stadistinct desc
+        query_tables = """
+            select n.nspname || '.' || c.relname, c.oid, coalesce(max(o.statime)::text, ''), c.reltuples
+                from pg_class as c
+                    inner join pg_namespace as n
+                        on c.relnamespace = n.oid
+                    left join pg_stat_last_operation as o
+                        on o.classid = 'pg_class'::regclass
+                            and o.objid = c.oid
+                            and o.staactionname = 'ANALYZE'
+                where n.nspname || '.' || c.relname = any(%s)
+                group by 1, 2, 4
+        """
+        query_stats = """
+            select s.starelid, a.attname, s.stadistinct, coalesce(a.attnum = any(d.attrnums), false),
+                   format_type(a.atttypid, a.atttypmod), st.null_frac, st.most_common_vals::text,
+                   st.most_common_freqs::text, st.histogram_bounds::text
+                from pg_statistic as s
+                    inner join pg_attribute as a
+                        on a.attrelid = s.starelid
+                            and a.attnum = s.staattnum
+                    inner join pg_class as c
+                        on c.oid = s.starelid
+                    inner join pg_namespace as n
+                        on n.oid = c.relnamespace
+                    left join pg_stats as st
+                        on st.schemaname = n.nspname
+                            and st.tablename = c.relname
+                            and st.attname = a.attname
+                    left join gp_distribution_policy as d
+                        on d.localoid = s.starelid
+                where s.starelid = any(%s)
+                order by s.starelid, s.stadistinct desc
         """
+        cache = dict()
+        if self.cache_filename:
+            cache = load_cache(self.cache_filename)
+        if not self.dburl.pgdb in cache:
+            cache[self.dburl.pgdb] = dict()
+        cached = cache[self.dburl.pgdb]
+        conn = dbconn.connect(self.dburl)
+        found = dict()
+        for name, oid, analyzed, reltuples in execute(conn, query_tables % sql_array(self.tables, 'text')):
+            found[name] = (str(oid), analyzed)
+            self.reltuples[name] = float(reltuples)
+        stale = [ oid for oid, analyzed in found.values() if not oid in cached or cached[oid]['analyzed'] != analyzed or analyzed == '' ]
+        if len(stale) > 0:
+            fetched = dict([ (oid, []) for oid in stale ])
+            for row in execute(conn, query_stats % sql_array(stale, 'oid')):
+                fetched[str(row[0])].append(tuple(row[1:]))
+            for oid, analyzed in found.values():
+                if oid in fetched:
+                    cached[oid] = { 'analyzed' : analyzed, 'columns' : fetched[oid] }
+        conn.close()
+        print 'Statistics of %d tables are read from the database, %d taken from the cache' % (len(stale), len(found) - len(stale))
         tables_out = dict()
         for t in self.tables:
-            res = execute(self.dburl, query % t)
+            if not t in found:
+                print 'ERROR: Table %s is not found' % t
+                continue
+            res = [ tuple([ v.encode('utf-8') if isinstance(v, unicode) else v for v in f ]) for f in cached[found[t][0]]['columns'] ]
             if len(res) >= 2:
                 tables_out[t] = res
             else:
                 print 'ERROR: Table %s does not have enough columns. %d columns returned' % (t, len(res))
         self.tables = tables_out
+        if self.cache_filename:
+            save_cache(self.cache_filename, cache)
         return
 
     def get_load_disk(self):
@@ -105,8 +312,33 @@ class WorkloadGenerator:
             query += 'from %s) as q;' % t
             queries.append(query)
         return queries
+
+    def get_load_selective(self):
+        # Returns (query, expected fraction of the rows) with the predicates of
+        # each table closest to the target fractions, for the index scans, the
+        # partition elimination and the small results
+        queries = []
+        for t in sorted(self.tables.keys()):
+            predicates = []
+            for column in self.tables[t]:
+                predicates += column_predicates(column, self.reltuples.get(t, 0.0))
+            for target in TARGET_FRACTIONS:
+                best = None
+                for predicate, fraction in predicates:
+                    if fraction <= 0:
+                        continue
+                    distance = abs(math.log(fraction / target))
+                    if distance <= math.log(SELECTIVITY_TOLERANCE) and (best is None or distance < best[0]):
+                        best = (distance, predicate, fraction)
+                if best is None:
+                    continue
+                if best[2] * self.reltuples.get(t, 0.0) <= SMALL_RESULT_ROWS:
+                    queries.append(('select * from %s where %s;' % (t, best[1]), best[2]))
+                else:
+                    queries.append(('select count(*) from %s where %s;' % (t, best[1]), best[2]))
+        return queries
     
-    def dump_queries(self, qdisk, qcpu, qnet, qmem):
+    def dump_queries(self, qdisk, qcpu, qnet, qmem, qsel):
         def output (f, desc, queries):
             for i in range(len(queries)):
                 f.write('%s!%d!%s\n' % (desc, i, queries[i]))
@@ -116,6 +348,10 @@ class WorkloadGenerator:
         output(f, 'cpu', qcpu)
         output(f, 'network', qnet)
         output(f, 'memory', qmem)
+        # Id of the selective query is tagged with its expected fraction of the
+        # rows, so the results can be reported by the selectivity
+        for i in range(len(qsel)):
+            f.write('selective!%d_%g!%s\n' % (i, qsel[i][1], qsel[i][0]))
         return
         
     def run (self):
@@ -125,17 +361,22 @@ class WorkloadGenerator:
         qcpu   = self.get_load_cpu()
         qnet   = self.get_load_network()
         qmem   = self.get_load_memory()
-        self.dump_queries(qdisk, qcpu, qnet, qmem)
+        qsel   = self.get_load_selective()
+        self.dump_queries(qdisk, qcpu, qnet, qmem, qsel)
 
 def main():
     dburl = dbconn.DbURL(hostname = '127.0.0.1',
                          port     = 5432,
                          dbname   = sys.argv[1],
                          username = 'gpadmin')
-    wg = WorkloadGenerator(sys.argv[2], sys.argv[3], dburl)
+    # Statistics cache is kept next to the output file unless given explicitly
+    cache_filename = os.path.join(os.path.dirname(sys.argv[3]) or '.', 'stresstest_table_stats.cache')
+    if len(sys.argv) > 4:
+        cache_filename = sys.argv[4]
+    wg = WorkloadGenerator(sys.argv[2], sys.argv[3], dburl, cache_filename)
     wg.run()
     return
     
 main()
 
-# python stresstest_generate.py dssprod conf/stresstest_table_list_big.csv conf/stresstest_queries_big.sql
+# python stresstest_generate.py dssprod conf/stresstest_table_list_big.csv conf/stresstest_queries_big.sql [stats_cache_file]
@@ -0,0 +1,196 @@
+import sys
+from datetime import datetime
+
+# Latency histogram with logarithmic buckets of the same relative width, like
+# HdrHistogram. Values are kept in microseconds, values below 2^PRECISION are
+# exact and the larger ones are within 1/2^(PRECISION-1) of the real value.
+# Histograms are merged by adding the counts of the buckets, so the histograms
+# of different threads, hosts and intervals can be combined in any order
+PRECISION = 7
+
+class Histogram:
+    buckets = dict()
+    count   = 0
+    total   = 0
+    maximum = 0
+
+    def __init__(self):
+        self.buckets = dict()
+        self.count   = 0
+        self.total   = 0
+        self.maximum = 0
+        return
+
+    def record(self, seconds, n=1):
+        value = max(int(seconds * 1e6), 0)
+        index = bucket_index(value)
+        self.buckets[index] = self.buckets.get(index, 0) + n
+        self.count  += n
+        self.total  += value * n
+        self.maximum = max(self.maximum, value)
+        return
+
+    def merge(self, other):
+        for index, n in other.buckets.iteritems():
+            self.buckets[index] = self.buckets.get(index, 0) + n
+        self.count  += other.count
+        self.total  += other.total
+        self.maximum = max(self.maximum, other.maximum)
+        return
+
+    # Returns the latency in seconds below which the given share of the values
+    # is, as the upper bound of the bucket
+    def percentile(self, share):
+        if self.count == 0:
+            return 0.0
+        target = max(int(self.count * share + 0.5), 1)
+        seen   = 0
+        for index in sorted(self.buckets.keys()):
+            seen += self.buckets[index]
+            if seen >= target:
+                return min(bucket_upper(index), self.maximum) / 1e6
+        return self.maximum / 1e6
+
+    def mean(self):
+        if self.count == 0:
+            return 0.0
+        return float(self.total) / self.count / 1e6
+
+    def encode(self):
+        return '%d|%d|%d|%s' % (self.count, self.total, self.maximum,
+               ','.join(['%d:%d' % (i, self.buckets[i]) for i in sorted(self.buckets.keys())]))
+
+def decode(fields):
+    # fields are count, sum, max and buckets as produced by Histogram.encode()
+    h = Histogram()
+    h.count   = int(fields[0])
+    h.total   = int(fields[1])
+    h.maximum = int(fields[2])
+    if fields[3] != '':
+        for b in fields[3].split(','):
+            index, n = b.split(':')
+            h.buckets[int(index)] = int(n)
+    return h
+
+def bucket_index(value):
+    sub = 1 << PRECISION
+    if value < sub:
+        return value
+    shift = value.bit_length() - PRECISION
+    return sub + (shift - 1) * (sub >> 1) + ((value >> shift) - (sub >> 1))
+
+def bucket_upper(index):
+    sub = 1 << PRECISION
+    if index < sub:
+        return index
+    shift = (index - sub) / (sub >> 1) + 1
+    top   = (index - sub) % (sub >> 1) + (sub >> 1)
+    return ((top + 1) << shift) - 1
+
+# Results file has one line per interval and key:
+#   interval|seconds|test|class|query|threads|rate|executed|errors|late|dropped|failures|count|sum|max|buckets
+# where interval is the epoch of the interval start, seconds is its length,
+# threads and rate are the load level the queries were started at (rate is 0
+# in closed-loop mode), executed is the number of the successful queries
+# started in the interval, failures are the failed attempts by error category
+# like "deadlock:2,timeout:1" (including the retried ones) and
+# the histogram of their latencies in microseconds follows. The same interval and key can appear on several lines, which are
+# merged when reading
+def format_record(interval, seconds, key, stats):
+    test, qclass, query, threads, rate = key
+    executed, errors, late, dropped, hist, failures = stats
+    return '%d|%d|%s|%s|%s|%d|%.3f|%d|%d|%d|%d|%s|%s\n' % (interval, seconds, test, qclass, query, threads, rate,
+                                                         executed, errors, late, dropped, encode_failures(failures), hist.encode())
+
+def parse_record(line):
+    f = line.rstrip('\r\n').split('|')
+    if len(f) != 16:
+        return None
+    return int(f[0]), int(f[1]), (f[2], f[3], f[4], int(f[5]), float(f[6])), [int(f[7]), int(f[8]), int(f[9]), int(f[10]), decode(f[12:16]), decode_failures(f[11])]
+
+def encode_failures(failures):
+    return ','.join(['%s:%d' % (c, failures[c]) for c in sorted(failures.keys())])
+
+def decode_failures(field):
+    failures = dict()
+    if field != '':
+        for f in field.split(','):
+            category, n = f.split(':')
+            failures[category] = int(n)
+    return failures
+
+def new_stats():
+    return [0, 0, 0, 0, Histogram(), dict()]
+
+def merge_stats(stats, other):
+    for i in range(4):
+        stats[i] += other[i]
+    stats[4].merge(other[4])
+    for category, n in other[5].iteritems():
+        stats[5][category] = stats[5].get(category, 0) + n
+    return
+
+def read_results(filename):
+    f = open(filename, 'r')
+    for line in f:
+        rec = parse_record(line)
+        if rec is not None:
+            yield rec
+    f.close()
+
+KEY_FIELDS = ['interval', 'test', 'class', 'query', 'threads', 'rate']
+
+def report(filename, fields, out):
+    # Merges the records by the given key fields, keeping only the merged
+    # histograms in memory. Without "interval" the records of all the intervals
+    # are merged, e.g. "test,class,threads,rate" gives the latency per load level
+    merged = dict()
+    spans  = dict()
+    for interval, seconds, key, stats in read_results(filename):
+        values = (interval,) + key
+        k = tuple([values[KEY_FIELDS.index(f)] for f in fields])
+        if k not in merged:
+            merged[k] = new_stats()
+            spans[k]  = set()
+        merge_stats(merged[k], stats)
+        spans[k].add((interval, seconds))
+    out.write('%s|Executed|Per second|Errors|Late|Dropped|Failures|Mean|p50|p95|p99|Max\n' % '|'.join([f.capitalize() for f in fields]))
+    for k in sorted(merged.keys()):
+        executed, errors, late, dropped, hist, failures = merged[k]
+        labels = [ str(v) for v in k ]
+        if 'interval' in fields:
+            labels[fields.index('interval')] = datetime.fromtimestamp(k[fields.index('interval')]).strftime('%Y-%m-%d %H:%M:%S')
+        if 'rate' in fields:
+            labels[fields.index('rate')] = '%.3f' % k[fields.index('rate')]
+        out.write('%s|%d|%.3f|%d|%d|%d|%s|%.6f|%.6f|%.6f|%.6f|%.6f\n' % ('|'.join(labels),
+                  executed, float(executed) / max(sum([s for i, s in spans[k]]), 1), errors, late, dropped, encode_failures(failures),
+                  hist.mean(), hist.percentile(0.5), hist.percentile(0.95), hist.percentile(0.99), hist.maximum / 1e6))
+    return
+
+def main():
+    if len(sys.argv) < 2 or sys.argv[1] in ('-h', '--help'):
+        print """Script prints the latency percentiles and the number of queries per interval
+from the results file of stresstest.py
+Usage:
+python stresstest_histogram.py results_file [key_field,...]
+    key_field - fields to report the results by, any of interval, test, class,
+                query, threads and rate (default is interval,test,class),
+                without interval the results of the whole run are merged, so
+                test,class,threads,rate gives the latency per load level
+Output:
+<key fields>|Executed|Per second|Errors|Late|Dropped|Failures|Mean|p50|p95|p99|Max
+where the latencies are in seconds and failures are the failed attempts by
+error category (oom, resource_queue, deadlock, timeout, cancel, connection,
+other)"""
+        sys.exit(0)
+    fields = ['interval', 'test', 'class']
+    if len(sys.argv) > 2:
+        fields = sys.argv[2].split(',')
+        for f in fields:
+            if f not in KEY_FIELDS:
+                sys.exit('Unknown key field "%s"' % f)
+    report(sys.argv[1], fields, sys.stdout)
+    return
+
+if __name__ == '__main__':
+    main()
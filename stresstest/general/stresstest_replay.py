@@ -0,0 +1,262 @@
+import sys
+import re
+import csv
+import time
+import hashlib
+import datetime as dt
+from optparse import OptionParser
+from multiprocessing import Process, Queue as ProcessQueue
+import Queue
+import stresstest_histogram
+try:
+    from pygresql import pg
+except ImportError, e:
+    sys.exit('Cannot import modules. Please check that you have sourced greenplum_path.sh.  Detail: ' + str(e))
+
+# Columns of the CSV log, the same as in maintenance/read_gp_logfile.sql
+COL_TIME     = 0
+COL_USER     = 1
+COL_DATABASE = 2
+COL_SESSION  = 9
+COL_SEVERITY = 16
+COL_MESSAGE  = 18
+
+def parseargs():
+    parser = OptionParser()
+    parser.remove_option('-h')
+    parser.add_option('-h', '-?', '--help', action='store_true')
+    parser.add_option('-d', '--database', type='string')
+    parser.add_option('-u', '--user',     type='string')
+    parser.add_option('-U', '--connuser', type='string')
+    parser.add_option('-s', '--speedup',  type='float')
+    parser.add_option('-n', '--nsessions', type='int')
+    parser.add_option('-o', '--outfile',  type='string')
+    parser.add_option('--start',          type='string')
+    parser.add_option('--end',            type='string')
+    parser.add_option('--late',           type='float')
+    (options, args) = parser.parse_args()
+    if options.help:
+        print """
+Script replays the statements logged by the Greenplum master (log_statement=all)
+with one connection per original session, keeping their relative timing
+Usage:
+python stresstest_replay.py [-d database] [-u user] [-U connect_user]
+                            [-s speedup] [-n max_sessions] [-o outfile]
+                            [--start time] [--end time] [--late seconds]
+                            logfile.csv [logfile.csv ...]
+    -d | --database  - replay only the sessions of this database
+    -u | --user      - replay only the sessions of this user
+    -U | --connuser  - connect as this user instead of the original one
+    -s | --speedup   - replay this number of times faster than the original
+                       (default is 1.0)
+    -n | --nsessions - maximal number of sessions replayed at the same time, the
+                       later sessions wait for a free slot (default is 100)
+    -o | --outfile   - write the report to this file instead of stdout
+    --start, --end   - replay only the statements logged in this time window,
+                       given as YYYY-MM-DD HH:MI:SS
+    --late           - statement starting later than scheduled by more than this
+                       number of seconds is counted as late (default is 0.1)
+Log files are the CSV files from $MASTER_DATA_DIRECTORY/pg_log. Statements are
+taken from the "statement: " messages and grouped by gp_session_id. Each session
+connects to the original database under the original user and runs its statements
+one after another, each not earlier than its original time relative to the start
+of the log (divided by the speedup). Latency is reported per statement
+fingerprint, which is the statement with the literals replaced by "?":
+Fingerprint|Executed|Errors|Late|Total seconds|Mean|p50|p95|p99|Max|Statement
+"""
+        sys.exit(0)
+    if len(args) == 0:
+        sys.exit('You must specify the log files to replay')
+    if not options.speedup:
+        options.speedup = 1.0
+    if options.speedup <= 0:
+        sys.exit('Speedup (-s) should be positive')
+    if not options.nsessions:
+        options.nsessions = 100
+    if options.late is None:
+        options.late = 0.1
+    for opt in ('start', 'end'):
+        if getattr(options, opt):
+            try:
+                setattr(options, opt, time.mktime(time.strptime(getattr(options, opt), '%Y-%m-%d %H:%M:%S')))
+            except ValueError:
+                sys.exit('Time window should be given as YYYY-MM-DD HH:MI:SS, got "%s"' % getattr(options, opt))
+    return options, args
+
+def parse_time(value):
+    # 2015-12-01 10:00:00.123456 MSK, the time zone is the same for the whole log
+    value = value.split(' ')
+    ts = dt.datetime.strptime(value[0] + ' ' + value[1].split('.')[0], '%Y-%m-%d %H:%M:%S')
+    frac = 0.0
+    if '.' in value[1]:
+        frac = float('0.' + value[1].split('.')[1])
+    return time.mktime(ts.timetuple()) + frac
+
+NUMBER  = re.compile(r'\b\d+(\.\d+)?\b')
+STRING  = re.compile(r"'(?:[^']|'')*'")
+INLIST  = re.compile(r'\(\s*\?(\s*,\s*\?)+\s*\)')
+SPACES  = re.compile(r'\s+')
+
+def fingerprint(sql):
+    norm = STRING.sub('?', sql)
+    norm = NUMBER.sub('?', norm)
+    norm = INLIST.sub('(?)', norm)
+    norm = SPACES.sub(' ', norm).strip().lower()
+    return hashlib.md5(norm).hexdigest()[:12], norm
+
+def read_sessions(filenames, options):
+    # Returns the list of sessions as (session id, database, user, statements)
+    # ordered by their first statement, statements are (time, fingerprint, sql)
+    csv.field_size_limit(sys.maxsize)
+    sessions = dict()
+    texts    = dict()
+    for filename in filenames:
+        f = open(filename, 'rb')
+        for row in csv.reader(f, delimiter=',', quotechar='"', escapechar=None):
+            if len(row) <= COL_MESSAGE or row[COL_SEVERITY] != 'LOG' or not row[COL_MESSAGE].startswith('statement: '):
+                continue
+            if options.database and row[COL_DATABASE] != options.database:
+                continue
+            if options.user and row[COL_USER] != options.user:
+                continue
+            try:
+                ts = parse_time(row[COL_TIME])
+            except (ValueError, IndexError):
+                continue
+            if (options.start and ts < options.start) or (options.end and ts > options.end):
+                continue
+            sql = row[COL_MESSAGE][len('statement: '):]
+            fp, norm = fingerprint(sql)
+            if not fp in texts:
+                texts[fp] = norm[:200]
+            key = (row[COL_SESSION], row[COL_DATABASE], row[COL_USER])
+            if not key in sessions:
+                sessions[key] = []
+            sessions[key].append((ts, fp, sql))
+        f.close()
+    res = []
+    for key in sessions:
+        sessions[key].sort()
+        res.append((sessions[key][0][0], key[0], key[1], key[2], sessions[key]))
+    res.sort()
+    return [ r[1:] for r in res ], texts
+
+def replay_session(session_id, database, username, statements, t0, l0, speedup, late, queue):
+    stats = dict()
+    db    = None
+    for ts, fp, sql in statements:
+        if not fp in stats:
+            stats[fp] = stresstest_histogram.new_stats()
+        due = t0 + (ts - l0) / speedup
+        now = time.time()
+        if now < due:
+            time.sleep(due - now)
+        start = time.time()
+        if start - due > late:
+            stats[fp][2] += 1
+        try:
+            if db is None:
+                db = pg.DB(dbname=database, user=username)
+            n1  = time.time()
+            res = db.query(sql)
+            if hasattr(res, 'getresult'):
+                res.getresult()
+            stats[fp][0] += 1
+            stats[fp][4].record(time.time() - n1)
+        except Exception, ex:
+            stats[fp][1] += 1
+            queue.put(('E', session_id, fp, ' '.join(str(ex).split())))
+            # Reconnect if the session was lost, the statement errors like
+            # in the original session are expected and kept as is
+            if db is not None and 'connection' in str(ex).lower():
+                try:
+                    db.close()
+                except Exception:
+                    pass
+                db = None
+    if db is not None:
+        db.close()
+    queue.put(('S', session_id, stats))
+    return
+
+def drain(queue, totals, errors):
+    while True:
+        try:
+            msg = queue.get(timeout=0.1)
+        except Queue.Empty:
+            return
+        if msg[0] == 'S':
+            for fp, stats in msg[2].iteritems():
+                if not fp in totals:
+                    totals[fp] = stresstest_histogram.new_stats()
+                stresstest_histogram.merge_stats(totals[fp], stats)
+        elif len(errors) < 1000:
+            errors.append(msg[1:])
+
+def replay(sessions, options):
+    queue   = ProcessQueue()
+    totals  = dict()
+    errors  = []
+    running = []
+    l0 = sessions[0][3][0][0]
+    # Sessions connect a second before their first statement is due
+    t0 = time.time() + 1.0
+    delayed = 0
+    for session_id, database, username, statements in sessions:
+        due = t0 + (statements[0][0] - l0) / options.speedup
+        while True:
+            for p in running[:]:
+                if not p.is_alive():
+                    p.join()
+                    running.remove(p)
+            drain(queue, totals, errors)
+            if len(running) < options.nsessions and time.time() >= due - 1.0:
+                break
+            time.sleep(0.01)
+        if time.time() > due:
+            delayed += 1
+        p = Process(target=replay_session, args=(session_id, database, options.connuser or username, statements,
+                                                 t0, l0, options.speedup, options.late, queue))
+        p.start()
+        running.append(p)
+    while len(running) > 0:
+        for p in running[:]:
+            if not p.is_alive():
+                p.join()
+                running.remove(p)
+        drain(queue, totals, errors)
+    drain(queue, totals, errors)
+    return totals, errors, delayed
+
+def report(totals, errors, texts, delayed, nsessions, out):
+    out.write('Sessions replayed: %d, started late because of the session limit: %d, errors: %d\n' % (
+              nsessions, delayed, sum([s[1] for s in totals.values()])))
+    out.write('Fingerprint|Executed|Errors|Late|Total seconds|Mean|p50|p95|p99|Max|Statement\n')
+    order = sorted(totals.keys(), key=lambda fp: totals[fp][4].total, reverse=True)
+    for fp in order:
+        executed, errs, late, dropped, hist = totals[fp][:5]
+        out.write('%s|%d|%d|%d|%.3f|%.6f|%.6f|%.6f|%.6f|%.6f|%s\n' % (fp, executed, errs, late, hist.total / 1e6,
+                  hist.mean(), hist.percentile(0.5), hist.percentile(0.95), hist.percentile(0.99), hist.maximum / 1e6, texts[fp]))
+    if len(errors) > 0:
+        out.write('First %d errors:\n' % len(errors))
+        for session_id, fp, message in errors:
+            out.write('%s|%s|%s\n' % (session_id, fp, message))
+    return
+
+def main():
+    options, filenames = parseargs()
+    sessions, texts = read_sessions(filenames, options)
+    if len(sessions) == 0:
+        sys.exit('No statements found in the log files')
+    print 'Replaying %d statements of %d sessions at speedup %.2f' % (sum([len(s[3]) for s in sessions]),
+                                                                      len(sessions), options.speedup)
+    totals, errors, delayed = replay(sessions, options)
+    out = sys.stdout
+    if options.outfile:
+        out = open(options.outfile, 'w')
+    report(totals, errors, texts, delayed, len(sessions), out)
+    if options.outfile:
+        out.close()
+    return
+
+main()
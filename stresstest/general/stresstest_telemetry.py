@@ -0,0 +1,222 @@
+import sys
+import re
+import time
+import socket
+from optparse import OptionParser
+try:
+    from pygresql import pg
+except ImportError, e:
+    sys.exit('Cannot import modules. Please check that you have sourced greenplum_path.sh.  Detail: ' + str(e))
+
+# Counters of each segment host are read from /proc by the web external table
+# executed once per host, each line is prefixed with the host and the source
+EXT_TABLE    = 'public.stresstest_telemetry_ext'
+PROC_COMMAND = ('h=`hostname`; head -1 /proc/stat | sed "s/^/$h|stat|/"; sed "s/^/$h|meminfo|/" /proc/meminfo; '
+                'sed "s/^/$h|diskstats|/" /proc/diskstats; sed "s/^/$h|net|/" /proc/net/dev')
+SESSIONS_QUERY = """
+    select  coalesce(sum(case when current_query <> '<IDLE>' then 1 else 0 end), 0),
+            coalesce(sum(case when waiting then 1 else 0 end), 0)
+        from pg_stat_activity
+        where procpid <> pg_backend_pid()"""
+# Whole disks only, partitions and device mapper volumes would count the same
+# I/O twice
+DISK = re.compile(r'^(sd[a-z]+|vd[a-z]+|xvd[a-z]+|hd[a-z]+|nvme\d+n\d+|cciss/c\d+d\d+)$')
+METRICS = ['cpu_pct', 'iowait_pct', 'mem_used_pct', 'disk_read_mbs', 'disk_write_mbs', 'disk_busy_pct',
+           'net_rx_mbs', 'net_tx_mbs', 'active_sessions', 'waiting_sessions']
+
+def parseargs():
+    parser = OptionParser()
+    parser.remove_option('-h')
+    parser.add_option('-h', '-?', '--help', action='store_true')
+    parser.add_option('-d', '--database', type='string')
+    parser.add_option('-u', '--username', type='string')
+    parser.add_option('-i', '--interval', type='int')
+    parser.add_option('-s', '--seconds',  type='int')
+    parser.add_option('-o', '--outfile',  type='string')
+    parser.add_option('--local',          action='store_true')
+    (options, args) = parser.parse_args()
+    if options.help:
+        print """
+Script samples the resource usage of the cluster hosts and the number of the
+active and waiting sessions at fixed intervals, the same way as stresstest.py
+does with "telemetry" in its config
+Usage:
+python stresstest_telemetry.py -o outfile [-d database] [-u username]
+                               [-i interval_seconds] [-s seconds] [--local]
+    -d | --database - database to connect to (default is template1)
+    -u | --username - user to connect as (default is gpadmin)
+    -i | --interval - seconds between the samples, samples are taken at the
+                      multiples of the interval like the snapshots of
+                      stresstest.py (default is 10)
+    -s | --seconds  - stop after this number of seconds (default is to run
+                      until interrupted)
+    -o | --outfile  - file to append the samples to
+    --local         - read /proc of this host instead of the segment hosts and
+                      do not connect to the database, e.g. for testing
+Segment hosts are read through the web external table %s
+executed on each host, it is created by the sampler and dropped when it stops.
+Output has one line per interval, host and metric:
+interval|seconds|host|metric|value
+where interval is the epoch of the interval start, host is "cluster" for the
+session counts and the metrics are
+%s
+CPU, disk and network metrics are the averages over the interval, memory and
+sessions are taken at its end. Disk busy is the one of the busiest disk.
+""" % (EXT_TABLE, ', '.join(METRICS))
+        sys.exit(0)
+    if not options.outfile:
+        sys.exit('You must specify the output file (-o)')
+    if not options.database:
+        options.database = 'template1'
+    if not options.username:
+        options.username = 'gpadmin'
+    if not options.interval:
+        options.interval = 10
+    return options
+
+def create_ext_table(db):
+    db.query('drop external table if exists %s' % EXT_TABLE)
+    db.query("""
+        create external web table %s (
+            host    text,
+            source  text,
+            line    text
+        )
+        execute E'%s' on host
+        format 'text' (delimiter '|')""" % (EXT_TABLE, PROC_COMMAND.replace("'", "''")))
+    return
+
+def read_proc_local():
+    host  = socket.gethostname()
+    lines = []
+    for source, filename in (('stat', '/proc/stat'), ('meminfo', '/proc/meminfo'),
+                             ('diskstats', '/proc/diskstats'), ('net', '/proc/net/dev')):
+        f = open(filename, 'r')
+        content = f.read().splitlines()
+        f.close()
+        if source == 'stat':
+            content = content[:1]
+        lines += [ (host, source, line) for line in content ]
+    return lines
+
+def parse_counters(lines):
+    # Returns the counters of each host from the (host, source, line) of /proc
+    hosts = dict()
+    for host, source, line in lines:
+        if not host in hosts:
+            hosts[host] = { 'cpu' : None, 'mem' : dict(), 'disks' : dict(), 'rx' : 0, 'tx' : 0 }
+        c = hosts[host]
+        f = line.split()
+        if source == 'stat' and len(f) > 5 and f[0] == 'cpu':
+            # user nice system idle iowait irq softirq steal
+            values = [ int(v) for v in f[1:9] ]
+            c['cpu'] = (sum(values), values[3], values[4])
+        elif source == 'meminfo' and len(f) >= 2:
+            c['mem'][f[0].rstrip(':')] = int(f[1])
+        elif source == 'diskstats' and len(f) >= 14 and DISK.match(f[2]):
+            # sectors read, sectors written, milliseconds spent doing I/O
+            c['disks'][f[2]] = (int(f[5]), int(f[9]), int(f[12]))
+        elif source == 'net' and ':' in line:
+            name, values = line.split(':', 1)
+            values = values.split()
+            if name.strip() != 'lo' and len(values) >= 9:
+                c['rx'] += int(values[0])
+                c['tx'] += int(values[8])
+    return hosts
+
+def host_metrics(prev, cur, seconds):
+    res = dict()
+    if prev['cpu'] is not None and cur['cpu'] is not None and cur['cpu'][0] > prev['cpu'][0]:
+        total  = cur['cpu'][0] - prev['cpu'][0]
+        idle   = cur['cpu'][1] - prev['cpu'][1]
+        iowait = cur['cpu'][2] - prev['cpu'][2]
+        res['cpu_pct']    = 100.0 * (total - idle - iowait) / total
+        res['iowait_pct'] = 100.0 * iowait / total
+    mem = cur['mem']
+    if mem.get('MemTotal', 0) > 0:
+        available = mem.get('MemAvailable', mem.get('MemFree', 0) + mem.get('Buffers', 0) + mem.get('Cached', 0))
+        res['mem_used_pct'] = 100.0 * (mem['MemTotal'] - available) / mem['MemTotal']
+    disks = [ d for d in cur['disks'] if d in prev['disks'] ]
+    if len(disks) > 0:
+        res['disk_read_mbs']  = sum([ cur['disks'][d][0] - prev['disks'][d][0] for d in disks ]) * 512.0 / 1048576 / seconds
+        res['disk_write_mbs'] = sum([ cur['disks'][d][1] - prev['disks'][d][1] for d in disks ]) * 512.0 / 1048576 / seconds
+        res['disk_busy_pct']  = min(max([ cur['disks'][d][2] - prev['disks'][d][2] for d in disks ]) / (seconds * 10.0), 100.0)
+    res['net_rx_mbs'] = (cur['rx'] - prev['rx']) / 1048576.0 / seconds
+    res['net_tx_mbs'] = (cur['tx'] - prev['tx']) / 1048576.0 / seconds
+    return res
+
+def sampler(database, username, filename, interval, local, stop, seconds=None):
+    # Takes the samples at the multiples of the interval till the stop event is
+    # set, the metrics computed from two samples belong to the interval started
+    # by the first one, the same as the intervals of the stresstest results
+    db = None
+    if not local:
+        db = pg.DB(dbname=database, user=username)
+        create_ext_table(db)
+    out  = open(filename, 'a')
+    prev = None
+    end  = None
+    if seconds:
+        end = time.time() + seconds
+    try:
+        while not stop.is_set() and (end is None or time.time() < end):
+            now = time.time()
+            stop.wait(interval - now % interval)
+            if stop.is_set():
+                break
+            ts = int(round(time.time() / interval)) * interval
+            try:
+                if local:
+                    lines    = read_proc_local()
+                    sessions = None
+                else:
+                    lines    = db.query('select host, source, line from %s' % EXT_TABLE).getresult()
+                    sessions = db.query(SESSIONS_QUERY).getresult()[0]
+            except Exception, ex:
+                sys.stderr.write('telemetry: sampling failed: %s\n' % ' '.join(str(ex).split()))
+                prev = None
+                continue
+            cur = (ts, parse_counters(lines))
+            if prev is not None:
+                start = prev[0]
+                for host in sorted(cur[1].keys()):
+                    if host in prev[1]:
+                        metrics = host_metrics(prev[1][host], cur[1][host], float(ts - start))
+                        for m in METRICS:
+                            if m in metrics:
+                                out.write('%d|%d|%s|%s|%f\n' % (start, ts - start, host, m, metrics[m]))
+                if sessions is not None:
+                    out.write('%d|%d|cluster|active_sessions|%d\n' % (start, ts - start, int(sessions[0])))
+                    out.write('%d|%d|cluster|waiting_sessions|%d\n' % (start, ts - start, int(sessions[1])))
+                out.flush()
+            prev = cur
+    finally:
+        out.close()
+        if db is not None:
+            try:
+                db.query('drop external table if exists %s' % EXT_TABLE)
+            except Exception:
+                pass
+            db.close()
+    return
+
+class NoStop:
+    # Stands for the stop event when run from the command line
+    def is_set(self):
+        return False
+
+    def wait(self, seconds):
+        time.sleep(seconds)
+        return False
+
+def main():
+    options = parseargs()
+    try:
+        sampler(options.database, options.username, options.outfile, options.interval,
+                options.local, NoStop(), options.seconds)
+    except KeyboardInterrupt:
+        pass
+    return
+
+if __name__ == '__main__':
+    main()
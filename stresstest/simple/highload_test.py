@@ -4,6 +4,11 @@ import random
 from multiprocessing import Process
 import subprocess
 import os
+import itertools
+
+# Files pre-generated for each thread by --generate, the thread starts over
+# from the first one when it runs all of them
+FILES_PER_THREAD = 10000
 
 def execute_for_timing(fout, ferr, thread_id, filename, database):
     try:
@@ -22,28 +27,83 @@ def execute_for_timing(fout, ferr, thread_id, filename, database):
         ferr.write(str(ex) + '\n')
         return 0.0
 
-def run_benchmark(thread_id, seconds, proc_files, database):
-    random.seed()
+def thread_seed(seed, thread_id):
+    if seed is None:
+        return None
+    return '%s|%d' % (seed, thread_id)
+
+def run_benchmark(thread_id, seconds, proc_files, database, seed, sequence):
+    # Runs random files, or the files of the replayed sequence one after another
+    random.seed(seed)
+    if sequence:
+        files = itertools.cycle(sequence)
+    else:
+        files = iter(lambda: proc_files[random.randint(0, len(proc_files)-1)], None)
     n1 = dt.datetime.now()
     fout = open('/home/gpadmin/audit_201411/data/thread_%d.stdout' % thread_id, 'w')
     ferr = open('/home/gpadmin/audit_201411/data/thread_%d.stderr' % thread_id, 'w')
     while (dt.datetime.now() - n1).seconds < seconds:
-        ind = random.randint(0, len(proc_files)-1)
-        t = execute_for_timing(fout, ferr, thread_id, proc_files[ind], database)
-        print '%d|%s|%f' % (thread_id, proc_files[ind], t)
+        filename = files.next()
+        t = execute_for_timing(fout, ferr, thread_id, filename, database)
+        print '%d|%s|%f' % (thread_id, filename, t)
     fout.close()
     ferr.close()
     return
         
+def generate(filename, n_threads, proc_files, seed):
+    # Writes the files each thread runs, one line "thread|file" per run
+    fsched = open(filename, 'w')
+    for i in range(n_threads):
+        rnd = random.Random(thread_seed(seed, i))
+        for j in range(FILES_PER_THREAD):
+            fsched.write('%d|%s\n' % (i, proc_files[rnd.randint(0, len(proc_files)-1)]))
+    fsched.close()
+    return
+
+def load_sequences(filename, proc_files):
+    sequences = dict()
+    fsched = open(filename, 'r')
+    for line in fsched:
+        thread_id, f = line.rstrip('\r\n').split('|')
+        if not f in proc_files:
+            sys.exit('File "%s" of the schedule %s is not in the SQL directory' % (f, filename))
+        if not int(thread_id) in sequences:
+            sequences[int(thread_id)] = []
+        sequences[int(thread_id)].append(f)
+    fsched.close()
+    return sequences
+
+# python highload_test.py n_threads n_seconds database [seed] [--generate file | --replay file]
+# With the seed the threads run the same files in the same order in each run,
+# --generate writes the files of each thread to the file and exits, --replay
+# runs the files written by --generate
 def main():
     n_threads = int(sys.argv[1])
     n_seconds = int(sys.argv[2])
     database  = sys.argv[3]
-    proc_files = [f for f in os.listdir('/home/gpadmin/audit_201411/sql')]
+    seed, generate_file, replay_file = None, None, None
+    args = sys.argv[4:]
+    while len(args) > 0:
+        if args[0] == '--generate' and len(args) > 1:
+            generate_file = args[1]
+            args = args[2:]
+        elif args[0] == '--replay' and len(args) > 1:
+            replay_file = args[1]
+            args = args[2:]
+        else:
+            seed = args[0]
+            args = args[1:]
+    proc_files = sorted([f for f in os.listdir('/home/gpadmin/audit_201411/sql')])
     print proc_files
+    if generate_file:
+        generate(generate_file, n_threads, proc_files, seed)
+        return
+    sequences = dict()
+    if replay_file:
+        sequences = load_sequences(replay_file, proc_files)
     proc_list  = []
     for i in range(n_threads):
-        p = Process(target=run_benchmark, args=(i,n_seconds,proc_files,database,))
+        p = Process(target=run_benchmark, args=(i,n_seconds,proc_files,database,thread_seed(seed, i),sequences.get(i),))
         p.start()
         proc_list.append(p)
     for p in proc_list: